@@ -0,0 +1,204 @@
+import hashlib
+import logging
+import threading
+import time
+from protocol import Connection
+from storage import RecordBatch, encode_value
+
+DEFAULT_RANGE_SIZE = 128
+DIGEST_FANOUT = 16  # Sub-ranges compared per round while narrowing down a divergence
+
+logger = logging.getLogger(__name__)
+
+
+def range_digests(log, from_offset, end_offset, range_size=DEFAULT_RANGE_SIZE):
+    """Digest consecutive ranges of `range_size` offsets in [from_offset, end_offset).
+
+    Returns [(start, end, hex digest)]. Two logs holding the same messages at
+    the same offsets produce the same digests.
+    """
+    digests = []
+    start = from_offset
+    while start < end_offset:
+        end = min(start + range_size, end_offset)
+        digest = hashlib.blake2b(digest_size=16)
+        offset = start
+        while offset < end:
+            records, offset = log.read(offset, max_messages=end - offset, end_offset=end)
+            if not records:
+                break
+            for _, message in records:
+                digest.update(encode_value(message))
+        digests.append((start, end, digest.hexdigest()))
+        start = end
+    return digests
+
+
+class Throttle:
+    """Token bucket that keeps catch-up transfers under `bytes_per_sec` (0 disables it)."""
+
+    def __init__(self, bytes_per_sec):
+        self.rate = bytes_per_sec
+        self.allowance = bytes_per_sec
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= size
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
+class AntiEntropy:
+    """Brings a node's topics up to date with its peers after it rejoins.
+
+    The node asks every peer for its per-topic offsets, picks the peer with
+    the highest high watermark for each topic it should hold, compares range
+    digests over the last `verify_window` common offsets to find where the
+    logs diverged (truncating the local log there), and then pulls only the
+    missing tail in throttled `chunk_bytes` pages over a dedicated connection.
+    """
+
+    def __init__(self, node, bytes_per_sec=8 * 1024 * 1024, chunk_bytes=256 * 1024,
+                 range_size=DEFAULT_RANGE_SIZE, verify_window=100000, timeout=5.0):
+        self.node = node
+        self.bytes_per_sec = bytes_per_sec
+        self.chunk_bytes = chunk_bytes
+        self.range_size = range_size
+        self.verify_window = verify_window
+        self.timeout = timeout
+        self.last_report = None
+        self.lock = threading.Lock()  # One catch-up at a time
+
+    def start(self, peers=None):
+        """Run `catch_up` in the background."""
+        threading.Thread(target=self.catch_up, args=(peers,), daemon=True).start()
+
+    def catch_up(self, peers=None):
+        """Pull missing and divergent ranges from `peers` (default: every other peer).
+
+        Returns a report with the time it took to become consistent.
+        """
+        if peers is None:
+            peers = [peer for peer in self.node.peer_list if peer[0] != self.node.node_id]
+        with self.lock:
+            started = time.monotonic()
+            report = {"status": "ok", "peers": {}, "topics": {}, "messages_pulled": 0, "bytes_pulled": 0,
+                      "truncated_messages": 0}
+            self.node.replication_manager.add_peers(self.node.peer_list)
+            sources = {}  # {topic: (high_watermark, start_offset, connection, peer_id, leader)}
+            offers = []  # (topic, info, connection, peer_id) for every copy a peer has
+            connections = []
+            for peer_id, ip, port in peers:
+                connection = Connection(ip, port, timeout=self.timeout)
+                try:
+                    response = connection.request({"action": "topic_offsets"})
+                except (ConnectionError, TimeoutError):
+                    connection.close()
+                    report["peers"][peer_id] = "unreachable"
+                    continue
+                connections.append(connection)
+                report["peers"][peer_id] = "ok"
+                offers.extend((topic, info, connection, peer_id) for topic, info in response.get("topics", {}).items())
+            held = {topic for topic, info, _, _ in offers if self.should_hold(topic, info)}
+            for topic, info, connection, peer_id in offers:
+                if topic in held and info["high_watermark"] > sources.get(topic, (-1,))[0]:
+                    sources[topic] = (info["high_watermark"], info["start_offset"], connection, peer_id,
+                                      info.get("leader", peer_id))
+            throttle = Throttle(self.bytes_per_sec)
+            for topic, (high_watermark, start_offset, connection, peer_id, leader) in sorted(sources.items()):
+                topic_started = time.monotonic()
+                try:
+                    result = self.sync_topic(connection, peer_id, topic, high_watermark, start_offset, throttle,
+                                             leader)
+                except (ConnectionError, TimeoutError) as e:
+                    logger.warning("Lost node %s while catching up topic '%s': %s", peer_id, topic, e)
+                    result = {"status": "source_lost"}
+                result["duration_ms"] = (time.monotonic() - topic_started) * 1000
+                report["topics"][topic] = result
+                report["messages_pulled"] += result.get("messages_pulled", 0)
+                report["bytes_pulled"] += result.get("bytes_pulled", 0)
+                report["truncated_messages"] += result.get("truncated_messages", 0)
+            for connection in connections:
+                connection.close()
+            report["time_to_consistent_ms"] = (time.monotonic() - started) * 1000
+            self.last_report = report
+        logger.info("Caught up %d topics (%d messages) in %.1f ms.", len(report["topics"]),
+                    report["messages_pulled"], report["time_to_consistent_ms"])
+        return report
+
+    def should_hold(self, topic, info):
+        """Whether this node has `topic`, or a peer's `topic_offsets` entry names it the leader or a replica.
+
+        Placement comes from the catalogs, not the hash ring: the leader is
+        whichever node created the topic, and only it knows the replicas.
+        """
+        node_id = self.node.node_id
+        return topic in self.node.topics or node_id == info.get("leader") or node_id in info.get("replicas", ())
+
+    def sync_topic(self, connection, peer_id, topic, high_watermark, start_offset, throttle, leader=None):
+        """Pull one topic from `peer_id` up to `high_watermark`, truncating a diverged local copy first.
+
+        A missing topic is created as a replica of `leader`, the leader the
+        peer recorded (default: the peer). A topic this node leads is pulled
+        as a replica of the peer and taken back once it caught up.
+        """
+        leader = peer_id if leader is None else leader
+        log, topic_lock, _ = self.node.get_topic(topic)
+        if log is None:
+            self.node.create_topic(topic, replica_of=peer_id if leader == self.node.node_id else leader)
+            log, topic_lock, _ = self.node.get_topic(topic)
+        result = {"status": "ok", "source": peer_id, "messages_pulled": 0, "bytes_pulled": 0,
+                  "truncated_messages": 0}
+        common_end = min(log.next_offset, high_watermark)
+        common_start = max(log.start_offset, start_offset, common_end - self.verify_window)
+        diverged = self.find_divergence(connection, topic, log, common_start, common_end)
+        if diverged is not None:
+            with topic_lock:
+                result["truncated_messages"] = log.next_offset - diverged
+                log.truncate(diverged)
+                self.node.record_truncate(topic, log, diverged, result["truncated_messages"])
+        offset = log.next_offset
+        while offset < high_watermark:
+            response = connection.request({"action": "fetch_messages", "topic_name": topic, "from_offset": offset,
+                                           "max_bytes": self.chunk_bytes, "batches": True}, timeout=self.timeout)
+            batches = [RecordBatch.from_tuple(batch) for batch in response.get("batches") or []]
+            if not batches:
+                break
+            applied = self.node.replicate_append(topic, offset, batches=batches)
+            if applied.get("status") != "replicated":
+                result["status"] = applied.get("status")
+                break
+            size = sum(batch.size for batch in batches)
+            result["messages_pulled"] += applied["high_watermark"] - offset
+            result["bytes_pulled"] += size
+            offset = response["next_offset"]
+            throttle.consume(size)
+        result["high_watermark"] = log.next_offset
+        if leader == self.node.node_id and result["status"] == "ok":
+            self.node.set_leader(topic, leader)
+        return result
+
+    def find_divergence(self, connection, topic, log, start, end):
+        """First offset in [start, end) where the local and remote logs differ, or None.
+
+        Compares DIGEST_FANOUT range digests per round and descends into the
+        first mismatching range until ranges are `range_size` long.
+        """
+        while start < end:
+            range_size = max(self.range_size, -(-(end - start) // DIGEST_FANOUT))
+            response = connection.request({"action": "topic_digests", "topic_name": topic, "from_offset": start,
+                                           "end_offset": end, "range_size": range_size}, timeout=self.timeout)
+            remote = [tuple(digest) for digest in response.get("digests", [])]
+            local = range_digests(log, start, end, range_size)
+            mismatch = next((mine for mine, theirs in zip(local, remote) if mine != theirs), None)
+            if mismatch is None:
+                return None
+            if range_size == self.range_size:
+                return mismatch[0]
+            start, end = mismatch[0], mismatch[1]
+        return None
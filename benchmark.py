@@ -1,14 +1,16 @@
 import time
 import socket
-import pickle
 import threading
-import matplotlib.pyplot as plt
 from client import Client
+from protocol import client_handshake, recv_frame, send_frame
+from storage import RecordBatch
 
 class Benchmark:
     def __init__(self, client, topic_name="benchmark_topic"):
         self.client = client
         self.topic_name = topic_name
+        self.connection_mode_results = {}
+        self.compression_results = {}
         self.fault_tolerance_results = {
             'primary_success_count': 0,
             'primary_failure_count': 0,
@@ -26,11 +28,12 @@ class Benchmark:
         end_time = time.time()
         return end_time - start_time, response
 
-    def publish_messages(self, message_count=100):
+    def publish_messages(self, message_count=100, client=None):
         """Measure throughput for publishing messages."""
+        client = client or self.client
         start_time = time.time()
         for i in range(message_count):
-            self.client.send_request({
+            client.send_request({
                 "action": "publish",
                 "topic_name": self.topic_name,
                 "message": f"Benchmark Message {i}"
@@ -39,6 +42,62 @@ class Benchmark:
         throughput = message_count / (end_time - start_time)
         return throughput
 
+    def publish_messages_pipelined(self, message_count=100, window=32):
+        """Measure throughput when up to `window` publishes are in flight on one connection."""
+        start_time = time.time()
+        for start in range(0, message_count, window):
+            self.client.send_requests([{
+                "action": "publish",
+                "topic_name": self.topic_name,
+                "message": f"Benchmark Message {i}"
+            } for i in range(start, min(start + window, message_count))])
+        end_time = time.time()
+        return message_count / (end_time - start_time)
+
+    def compare_connection_modes(self, message_count=100):
+        """Compare publish throughput of connect-per-request, persistent and pipelined clients."""
+        per_request_client = Client(self.client.server_ip, self.client.server_port, persistent=False)
+        results = {
+            "connect_per_request": self.publish_messages(message_count, client=per_request_client),
+            "persistent": self.publish_messages(message_count),
+            "pipelined": self.publish_messages_pipelined(message_count),
+        }
+        print("\nPublish throughput by connection mode:")
+        for mode, throughput in results.items():
+            print(f"  {mode:<20} {throughput:10.2f} messages/sec")
+        speedup = results["persistent"] / results["connect_per_request"]
+        print(f"  Persistent connection speedup: {speedup:.2f}x")
+        return results
+
+    def compare_compression(self, message_count=5000, batch_size=500):
+        """Compare batch compression codecs: size ratio, CPU per batch and end-to-end publish throughput."""
+        messages = [f"Benchmark Message {i}" for i in range(message_count)]
+        batches = [messages[start:start + batch_size] for start in range(0, message_count, batch_size)]
+        raw_bytes = sum(len(RecordBatch.build(0, batch).payload) for batch in batches)
+        results = {}
+        print(f"\nBatch compression ({batch_size} messages per batch):")
+        print(f"  {'codec':<6} {'ratio':>7} {'build us':>10} {'decode us':>10} {'publish msg/s':>14}")
+        for compression in (None, "zlib", "lzma"):
+            cpu_start = time.process_time()
+            built = [RecordBatch.build(0, batch, compression=compression) for batch in batches]
+            build_time = (time.process_time() - cpu_start) / len(batches)
+            cpu_start = time.process_time()
+            for batch in built:
+                batch.records()
+            decode_time = (time.process_time() - cpu_start) / len(batches)
+            ratio = raw_bytes / sum(len(batch.payload) for batch in built)
+            topic_name = f"{self.topic_name}_{compression or 'none'}"
+            self.client.send_request({"action": "create_topic", "topic_name": topic_name})
+            start_time = time.time()
+            self.client.publish_many(topic_name, messages, batch_size=batch_size, compression=compression)
+            throughput = message_count / (time.time() - start_time)
+            name = compression or "none"
+            results[name] = {"ratio": ratio, "build_us": build_time * 1e6, "decode_us": decode_time * 1e6,
+                             "publish_throughput": throughput}
+            print(f"  {name:<6} {ratio:>7.2f} {build_time * 1e6:>10.1f} {decode_time * 1e6:>10.1f} "
+                  f"{throughput:>14.2f}")
+        return results
+
     def fetch_messages(self):
         """Measure latency for fetching messages."""
         start_time = time.time()
@@ -93,8 +152,9 @@ class Benchmark:
                             "action": "fetch_messages",
                             "topic_name": self.topic_name
                         }
-                        sock.sendall(pickle.dumps(request))
-                        response = sock.recv(4096)
+                        codec = client_handshake(sock)
+                        send_frame(sock, 1, request, codec)
+                        response = recv_frame(sock, codec)
                         
                         if response:
                             self.fault_tolerance_results['replica_failover_success_count'] += 1
@@ -122,10 +182,11 @@ class Benchmark:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                 sock.settimeout(2)
                 sock.connect(('localhost', primary_port))
-                request = {"action": "fetch_messages", "topic_name": self.topic_name}
-                sock.sendall(pickle.dumps(request))
-                response = pickle.loads(sock.recv(4096))
-                messages_by_node['primary'] = len(response) if isinstance(response, list) else 0
+                request = {"action": "fetch_messages", "topic_name": self.topic_name, "max_messages": 0}
+                codec = client_handshake(sock)
+                send_frame(sock, 1, request, codec)
+                _, response = recv_frame(sock, codec)
+                messages_by_node['primary'] = response.get('high_watermark', 0)
         except:
             messages_by_node['primary'] = None
         
@@ -135,10 +196,11 @@ class Benchmark:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                     sock.settimeout(2)
                     sock.connect(('localhost', replica_port))
-                    request = {"action": "fetch_messages", "topic_name": self.topic_name}
-                    sock.sendall(pickle.dumps(request))
-                    response = pickle.loads(sock.recv(4096))
-                    messages_by_node[f'replica_{idx}'] = len(response) if isinstance(response, list) else 0
+                    request = {"action": "fetch_messages", "topic_name": self.topic_name, "max_messages": 0}
+                    codec = client_handshake(sock)
+                    send_frame(sock, 1, request, codec)
+                    _, response = recv_frame(sock, codec)
+                    messages_by_node[f'replica_{idx}'] = response.get('high_watermark', 0)
             except:
                 messages_by_node[f'replica_{idx}'] = None
         
@@ -239,6 +301,9 @@ class Benchmark:
                     replica_ports=replica_ports
                 )
 
+        self.connection_mode_results = self.compare_connection_modes(message_count)
+        self.compression_results = self.compare_compression()
+
         return create_latencies, publish_throughputs, fetch_latencies, subscribe_responses
 
     def print_fault_tolerance_report(self):
@@ -255,8 +320,12 @@ class Benchmark:
         print(f"Data Consistency Invalid: {self.fault_tolerance_results['data_consistency_invalid']}")
         print("="*70 + "\n")
 
-    def plot_results(self, create_latencies, publish_throughputs, fetch_latencies):
-        """Generate and display benchmark graphs."""
+    def plot_results(self, create_latencies, publish_throughputs, fetch_latencies, path="benchmark_results.png"):
+        """Save benchmark graphs to `path`. Renders off-screen, so it never blocks or needs a display."""
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
         iterations = range(1, len(create_latencies) + 1)
 
         plt.figure(figsize=(15, 5))
@@ -286,7 +355,9 @@ class Benchmark:
         plt.legend()
 
         plt.tight_layout()
-        plt.show()
+        plt.savefig(path)
+        plt.close()
+        print(f"Benchmark graphs saved to {path}")
 
 if __name__ == "__main__":
     print("Starting Enhanced Benchmarking with Fault Tolerance Testing...")
@@ -316,4 +387,7 @@ if __name__ == "__main__":
     benchmark.print_fault_tolerance_report()
 
     # Plot the results
-    benchmark.plot_results(create_latencies, publish_throughputs, fetch_latencies)
\ No newline at end of file
+    try:
+        benchmark.plot_results(create_latencies, publish_throughputs, fetch_latencies)
+    except ImportError:
+        print("matplotlib is not installed; skipping the graphs.")
\ No newline at end of file
@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class TopicStats:
+    """Catalog entry of one topic, updated in place as the topic changes."""
+
+    __slots__ = ("topic_name", "messages", "size_bytes", "start_offset", "next_offset", "last_publish_time",
+                 "leader", "replicas", "subscribers")
+
+    def __init__(self, topic_name, log, leader=None):
+        self.topic_name = topic_name
+        self.messages = log.next_offset - log.start_offset
+        self.size_bytes = log.size_bytes
+        self.start_offset = log.start_offset
+        self.next_offset = log.next_offset
+        self.last_publish_time = None
+        self.leader = leader  # Node id of the topic's leader
+        self.replicas = ()  # Node ids the leader replicates to
+        self.subscribers = 0
+
+    def to_dict(self):
+        return {
+            "topic": self.topic_name,
+            "messages": self.messages,
+            "size_bytes": self.size_bytes,
+            "first_offset": self.start_offset,
+            "last_offset": self.next_offset - 1 if self.next_offset > self.start_offset else None,
+            "last_publish_time": self.last_publish_time,
+            "leader": self.leader,
+            "replicas": list(self.replicas),
+            "subscribers": self.subscribers,
+        }
+
+
+class TopicCatalog:
+    """Per-topic metadata kept current as messages arrive, so listing topics never reads their logs.
+
+    Appends update a topic's entry in O(1) from the batch just stored and
+    must be serialized per topic like the appends themselves. Names are kept
+    sorted, so a page of the topics sharing a prefix is found by bisection.
+    """
+
+    def __init__(self):
+        self.entries = {}  # {topic_name: TopicStats}
+        self.names = []  # Sorted topic names
+        self.lock = threading.Lock()  # Guards `names`; entries are updated under their topic's lock
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, topic_name, log, leader=None):
+        with self.lock:
+            stats = self.entries.get(topic_name)
+            if stats is None:
+                stats = self.entries[topic_name] = TopicStats(topic_name, log, leader)
+                bisect.insort(self.names, topic_name)
+            return stats
+
+    def get(self, topic_name):
+        return self.entries.get(topic_name)
+
+    def record_append(self, topic_name, batch):
+        stats = self.entries.get(topic_name)
+        if stats is not None:
+            stats.messages += batch.count
+            stats.size_bytes += batch.size
+            stats.next_offset = batch.next_offset
+            stats.last_publish_time = batch.timestamp
+
+    def record_removal(self, topic_name, log, messages):
+        """`messages` left the log through retention, compaction or truncation."""
+        stats = self.entries.get(topic_name)
+        if stats is not None:
+            stats.messages = max(0, stats.messages - messages)
+            stats.size_bytes = log.size_bytes
+            stats.start_offset = log.start_offset
+            stats.next_offset = log.next_offset
+
+    def set_placement(self, topic_name, leader, replicas):
+        stats = self.entries.get(topic_name)
+        if stats is not None:
+            stats.leader = leader
+            stats.replicas = tuple(replicas)
+
+    def set_subscribers(self, topic_name, count):
+        stats = self.entries.get(topic_name)
+        if stats is not None:
+            stats.subscribers = count
+
+    def list(self, prefix="", cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Return ([entry dicts], next_cursor) for topics named `prefix`..., in name order.
+
+        `cursor` is the `next_cursor` of the previous page: listing resumes
+        after that name, so topics created between pages are not skipped or
+        repeated. `next_cursor` is None on the last page.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.lock:
+            if cursor is not None and cursor >= prefix:
+                start = bisect.bisect_right(self.names, cursor)
+            else:
+                start = bisect.bisect_left(self.names, prefix)
+            names = self.names[start:start + limit + 1]
+        page = []
+        for name in names:
+            if not name.startswith(prefix):
+                break  # Names sharing the prefix are contiguous
+            page.append(name)
+        next_cursor = page[limit - 1] if len(page) > limit else None
+        return [self.entries[name].to_dict() for name in page[:limit]], next_cursor
@@ -1,31 +1,429 @@
-import socket
-import pickle
+import threading
+import time
+from partitions import partition_name
+from protocol import DEFAULT_CODECS, Connection, message_size
+from storage import CorruptRecordError, RecordBatch
+from topic_trie import is_pattern
+from topology import ClusterMap
 
 class Client:
-    def __init__(self, server_ip="localhost", server_port=5001):
+    def __init__(self, server_ip="localhost", server_port=5001, persistent=True, timeout=5.0, codecs=DEFAULT_CODECS,
+                 routing=False, refresh_interval=30.0):
         self.server_ip = server_ip
         self.server_port = server_port
+        self.persistent = persistent  # Reuse one connection instead of connecting per request
+        self.timeout = timeout
+        self.codecs = codecs  # Payload codecs offered to the server, most preferred first
+        self.connection = None
+        self.push_callbacks = {}  # {(topic_name, subscriber_id): callback}
+        self.cluster = None  # With `routing`, a ClusterMap sends topic requests to the nodes holding the topic
+        if routing:
+            self.cluster = ClusterMap([(server_ip, server_port)], timeout, codecs, self._handle_push,
+                                      refresh_interval)
+            self.cluster.start()
+
+    def _get_connection(self):
+        if not self.persistent:
+            return Connection(self.server_ip, self.server_port, timeout=self.timeout, codecs=self.codecs)
+        if self.connection is None:
+            self.connection = Connection(self.server_ip, self.server_port, timeout=self.timeout,
+                                         on_push=self._handle_push, codecs=self.codecs)
+        return self.connection
+
+    def _handle_push(self, notification):
+        subscription = notification.get("pattern", notification.get("topic"))
+        callback = self.push_callbacks.get((subscription, notification.get("subscriber_id")))
+        if callback is not None:
+            callback(notification["topic"], notification["messages"])
 
     def send_request(self, request):
-        """Send a request to the peer server."""
+        """Send a request to the peer server, or with routing to the node that serves it."""
+        if self.cluster is not None:
+            return self.cluster.request(request)
+        connection = self._get_connection()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((self.server_ip, self.server_port))
-                client.send(pickle.dumps(request))
-
-                # Receive and handle large data in chunks
-                data = b""
-                while True:
-                    chunk = client.recv(4096)  # Increase buffer size to 4096 bytes
-                    if not chunk:
-                        break
-                    data += chunk
-
-                print(f"Received {len(data)} bytes of data")  # Debug: Log data size
-                return pickle.loads(data)
-        except ConnectionError as e:
+            return connection.request(request, self.timeout + request.get("max_wait_ms", 0) / 1000)
+        except (ConnectionError, TimeoutError) as e:
             print(f"Connection error: {e}")
             return {"status": "connection_failed"}
+        finally:
+            if not self.persistent:
+                connection.close()
+
+    def send_requests(self, requests):
+        """Pipeline several requests over the connection and return their responses in order."""
+        if self.cluster is not None:
+            return self.cluster.request_many(requests)
+        connection = self._get_connection()
+        try:
+            pending = [connection.send(request) for request in requests]
+            return [waiter.wait(self.timeout) for waiter in pending]
+        except (ConnectionError, TimeoutError) as e:
+            print(f"Connection error: {e}")
+            return [{"status": "connection_failed"} for _ in requests]
+        finally:
+            if not self.persistent:
+                connection.close()
+
+    def publish_many(self, topic_name, messages, batch_size=500, batch_bytes=1024 * 1024, linger_ms=5,
+                     compression=None):
+        """Publish a stream of messages in size- or time-bounded batches.
+
+        A batch is sent as soon as it holds `batch_size` messages or
+        `batch_bytes` bytes, or `linger_ms` after its first message arrived.
+        With `compression` ("zlib" or "lzma") batches are compressed here and
+        stored and replicated by the server as they are.
+        """
+        with BatchPublisher(self, topic_name, batch_size, batch_bytes, linger_ms, compression) as publisher:
+            for message in messages:
+                publisher.send(message)
+        return publisher.summary()
+
+    def fetch_page(self, topic_name, from_offset=0, max_messages=1000, max_bytes=1024 * 1024, compression=None,
+                   max_wait_ms=0, min_messages=1, min_bytes=0):
+        """Fetch one page of (offset, message) pairs starting at `from_offset`.
+
+        With `compression` the server sends its stored record batches,
+        compressing the ones it stored uncompressed, and they are decoded here;
+        a batch holding anything but str, bytes or plain-data values makes the
+        page an "invalid_response".
+        With `max_wait_ms` the server holds the request until `min_messages`
+        messages (or `min_bytes` bytes) are available or the time is up.
+        """
+        request = {
+            "action": "fetch_messages",
+            "topic_name": topic_name,
+            "from_offset": from_offset,
+            "max_messages": max_messages,
+            "max_bytes": max_bytes,
+        }
+        if max_wait_ms:
+            request.update(max_wait_ms=max_wait_ms, min_messages=min_messages, min_bytes=min_bytes)
+        if compression is None:
+            return self.send_request(request)
+        response = self.send_request({**request, "batches": True, "compression": compression})
+        if response.get("status") != "ok":
+            return response
+        batches = [RecordBatch.from_tuple(fields) for fields in response.pop("batches")]
+        try:
+            for batch in batches:
+                batch.validate()  # Refuses pickled values before anything is decoded
+        except CorruptRecordError as e:
+            return {"status": "invalid_response", "error": str(e)}
+        messages = []
+        for batch in batches:
+            for offset, _, message, _ in batch.records():
+                if offset >= from_offset and len(messages) < max_messages:
+                    messages.append((offset, message))
+        if messages:
+            response["next_offset"] = messages[-1][0] + 1
+        response["messages"] = messages
+        return response
+
+    def iter_messages(self, topic_name, from_offset=0, max_messages=1000, max_bytes=1024 * 1024, compression=None,
+                      max_wait_ms=0):
+        """Yield (offset, message) pairs page by page until the end of the topic.
+
+        With `max_wait_ms` the end of the topic does not stop the iteration:
+        each fetch there is a long poll, so new messages are yielded as they
+        arrive until one waits `max_wait_ms` without any.
+        """
+        while True:
+            page = self.fetch_page(topic_name, from_offset, max_messages, max_bytes, compression, max_wait_ms)
+            if page.get("status") != "ok":
+                return
+            yield from page["messages"]
+            from_offset = page["next_offset"]
+            if not page["messages"] or (not max_wait_ms and from_offset >= page["high_watermark"]):
+                return
+
+    def partitions(self, topic_name):
+        """Leader of each partition of a partitioned topic, or None if the topic is not partitioned."""
+        if self.cluster is not None:
+            return self.cluster.partitions.get(topic_name) if self.cluster.partition_count(topic_name) else None
+        response = self.send_request({"action": "metadata", "topics": [topic_name]})
+        return (response.get("partitions") or {}).get(topic_name)
+
+    def fetch_partitions(self, topic_name, offsets=None, max_messages=1000, max_bytes=1024 * 1024):
+        """Fetch one page from every partition of a partitioned topic.
+
+        `offsets` holds the offset to start at in each partition (default all
+        0). The response's "partitions" lists one page per partition with its
+        "partition", "messages" and "next_offset"; pass the next offsets back
+        to continue. Order holds only within a partition.
+        """
+        request = {"action": "fetch_messages", "topic_name": topic_name, "max_messages": max_messages,
+                   "max_bytes": max_bytes}
+        if offsets is not None:
+            request["offsets"] = list(offsets)
+        return self.send_request(request)
+
+    def list_topics(self, prefix="", cursor=None, limit=100):
+        """One page of topic stats for topics named `prefix`...; pass `next_cursor` back for the next page."""
+        request = {"action": "list_topics", "prefix": prefix, "limit": limit}
+        if cursor is not None:
+            request["cursor"] = cursor
+        return self.send_request(request)
+
+    def iter_topics(self, prefix="", limit=100):
+        """Yield the stats of every topic named `prefix`..., page by page."""
+        cursor = None
+        while True:
+            page = self.list_topics(prefix, cursor, limit)
+            if page.get("status") != "ok":
+                return
+            yield from page["topics"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def subscribe(self, topic_name, subscriber_id, callback, max_queue=1000, overflow_policy="drop_oldest"):
+        """Subscribe with push delivery over this client's persistent connection.
+
+        `callback(topic_name, messages)` receives lists of (offset, message)
+        pairs on the connection's reader thread, so it should return quickly.
+        `topic_name` may be a pattern such as "metrics.*.cpu" or "logs.#"; the
+        callback then gets the name of the topic each batch came from.
+        The server keeps at most `max_queue` undelivered messages and applies
+        `overflow_policy` ("block", "drop_oldest" or "disconnect") beyond that.
+
+        On a partitioned topic the callback gets each partition's topic name.
+        With routing every partition is subscribed at the node that leads it;
+        otherwise the node subscribes the partitions it holds a copy of.
+        """
+        if not self.persistent:
+            return {"status": "push_requires_connection"}
+        leaders = None if is_pattern(topic_name) else self.partitions(topic_name)
+        if leaders:
+            names = [partition_name(topic_name, partition) for partition in range(len(leaders))]
+            if self.cluster is not None:
+                responses = [self.subscribe(name, subscriber_id, callback, max_queue, overflow_policy)
+                             for name in names]
+                failed = [response for response in responses if response.get("status") != "subscribed"]
+                return failed[0] if failed else {"status": "subscribed", "topic": topic_name, "push": True,
+                                                 "partitions": list(range(len(names)))}
+            for name in names:
+                self.push_callbacks[(name, subscriber_id)] = callback
+        self.push_callbacks[(topic_name, subscriber_id)] = callback
+        response = self.send_request({
+            "action": "subscribe",
+            "topic_name": topic_name,
+            "subscriber_id": subscriber_id,
+            "push": True,
+            "max_queue": max_queue,
+            "overflow_policy": overflow_policy,
+        })
+        if response.get("status") != "subscribed":
+            self.push_callbacks.pop((topic_name, subscriber_id), None)
+        return response
+
+    def unsubscribe(self, topic_name, subscriber_id):
+        """Stop push delivery for a subscription."""
+        leaders = None if is_pattern(topic_name) else self.partitions(topic_name)
+        if leaders and self.cluster is not None:
+            responses = [self.unsubscribe(partition_name(topic_name, partition), subscriber_id)
+                         for partition in range(len(leaders))]
+            failed = [response for response in responses if response.get("status") != "unsubscribed"]
+            return failed[0] if failed else {"status": "unsubscribed", "topic": topic_name}
+        for partition in range(len(leaders or ())):
+            self.push_callbacks.pop((partition_name(topic_name, partition), subscriber_id), None)
+        self.push_callbacks.pop((topic_name, subscriber_id), None)
+        return self.send_request({"action": "unsubscribe", "topic_name": topic_name, "subscriber_id": subscriber_id})
+
+    def group_consumer(self, group_id, topic_name, member_id=None, max_messages=500, max_wait_ms=1000,
+                       session_timeout=10.0):
+        """Join a consumer group on a topic; see `GroupConsumer`."""
+        return GroupConsumer(self, group_id, topic_name, member_id, max_messages, max_wait_ms, session_timeout)
+
+    def close(self):
+        """Close the persistent connection, if one is open."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.cluster is not None:
+            self.cluster.close()
+
+class BatchPublisher:
+    """Accumulates messages for one topic and flushes them as `publish_batch` requests.
+
+    With `compression` each batch is encoded and compressed here and sent as a
+    `publish_records` request instead.
+    """
+
+    def __init__(self, client, topic_name, batch_size=500, batch_bytes=1024 * 1024, linger_ms=5, compression=None):
+        self.client = client
+        self.topic_name = topic_name
+        self.compression = compression
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.linger = linger_ms / 1000
+        self.batch = []
+        self.keys = []
+        self.pending_bytes = 0
+        self.batch_started = None
+        self.published = 0
+        self.batches = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.linger_thread = threading.Thread(target=self._linger_loop, daemon=True)
+        self.linger_thread.start()
+
+    def send(self, message, key=None):
+        """Add a message to the current batch, flushing it if a size bound is reached.
+
+        On compacted topics only the latest message per `key` is kept.
+        """
+        with self.lock:
+            if not self.batch:
+                self.batch_started = time.monotonic()
+                self.wakeup.notify()
+            self.batch.append(message)
+            self.keys.append(key)
+            self.pending_bytes += message_size(message)
+            if len(self.batch) >= self.batch_size or self.pending_bytes >= self.batch_bytes:
+                self._flush_locked()
+
+    def flush(self):
+        """Send whatever is currently batched."""
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        """Flush the last batch and stop the linger timer."""
+        with self.lock:
+            self._flush_locked()
+            self.closed = True
+            self.wakeup.notify()
+        self.linger_thread.join()
+
+    def summary(self):
+        status = "messages_published" if not self.failures else "partial_failure"
+        return {"status": status, "count": self.published, "batches": self.batches, "failures": self.failures}
+
+    def _flush_locked(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        keys, self.keys = self.keys, []
+        if all(key is None for key in keys):
+            keys = None
+        self.pending_bytes = 0
+        self.batch_started = None
+        if self.compression:
+            records = RecordBatch.build(0, batch, keys, compression=self.compression)
+            request = {"action": "publish_records", "topic_name": self.topic_name, "batch": records.to_tuple()}
+        else:
+            request = {"action": "publish_batch", "topic_name": self.topic_name, "messages": batch}
+            if keys is not None:
+                request["keys"] = keys
+        response = self.client.send_request(request)
+        self.batches += 1
+        if response.get("status") == "batch_published":
+            self.published += len(batch)
+        else:
+            self.failures.append(response)
+
+    def _linger_loop(self):
+        with self.lock:
+            while not self.closed:
+                if self.batch_started is None:
+                    self.wakeup.wait()
+                    continue
+                remaining = self.batch_started + self.linger - time.monotonic()
+                if remaining > 0:
+                    self.wakeup.wait(remaining)
+                    continue
+                self._flush_locked()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GroupConsumer:
+    """One member of a consumer group, consuming its share of a topic.
+
+    Each `poll` returns the messages of the next range the node leased to
+    this member. The range is committed with the following `poll`, once the
+    caller is done with its messages, so commits ride along with fetches.
+    Messages are delivered at least once: a range whose member stops before
+    committing it is delivered to another member. A member the group
+    dropped after a session timeout joins again under a new id.
+    """
+
+    def __init__(self, client, group_id, topic_name, member_id=None, max_messages=500, max_wait_ms=1000,
+                 session_timeout=10.0):
+        self.client = client
+        self.group_id = group_id
+        self.topic_name = topic_name
+        self.member_id = member_id
+        self.max_messages = max_messages
+        self.max_wait_ms = max_wait_ms  # Long poll: how long an empty poll waits for new messages
+        self.session_timeout = session_timeout
+        self.generation = None
+        self.committed = None  # The group's committed offset, as of the last response
+        self.pending = []  # [start, end] leases handed out but not committed yet
+        self.consumed = 0
+        self.rejoins = 0
+        self.join()
+
+    def _request(self, action, **fields):
+        return self.client.send_request({"action": action, "group_id": self.group_id, "topic_name": self.topic_name,
+                                         "member_id": self.member_id, **fields})
+
+    def join(self):
+        response = self._request("join_group", session_timeout=self.session_timeout)
+        if response.get("status") == "joined":
+            self.member_id = response["member_id"]
+            self.generation = response["generation"]
+            self.committed = response["committed"]
+        return response
+
+    def poll(self):
+        """Commit the previous poll's messages and return the next [(offset, message)] share, possibly empty."""
+        response = self._request("group_fetch", commit=self.pending, max_messages=self.max_messages,
+                                 max_wait_ms=self.max_wait_ms)
+        if response.get("status") == "unknown_member":
+            self.pending = []  # Revoked: these ranges go to other members
+            self.rejoins += 1
+            self.join()
+            return []
+        if response.get("status") != "ok":
+            return []
+        self.pending = [response["lease"]] if response["lease"] else []
+        self.generation = response["generation"]
+        self.committed = response["committed"]
+        self.consumed += len(response["messages"])
+        return response["messages"]
+
+    def commit(self):
+        """Commit what the last `poll` returned now instead of with the next one."""
+        if not self.pending:
+            return {"status": "committed", "committed": self.committed}
+        response = self._request("commit_offsets", ranges=self.pending)
+        if response.get("status") == "committed":
+            self.pending = []
+            self.committed = response["committed"]
+        return response
+
+    def close(self):
+        """Commit what was consumed and leave the group, handing anything else to the other members."""
+        response = self._request("leave_group", commit=self.pending)
+        self.pending = []
+        if response.get("status") == "left":
+            self.committed = response["committed"]
+        return response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 if __name__ == "__main__":
     print("Welcome to the Pub/Sub Client!")
@@ -58,21 +456,38 @@ if __name__ == "__main__":
 
         elif choice == "3":
             topic_name = input("Enter the topic name: ").strip()
-            response = client.send_request({"action": "fetch_messages", "topic_name": topic_name})
-            print(f"Messages: {response}")
+            from_offset = int(input("Enter the offset to read from (default: 0): ").strip() or 0)
+            response = client.fetch_page(topic_name, from_offset)
+            if response.get("status") == "ok":
+                print(f"Messages: {response['messages']}")
+                print(f"Next offset: {response['next_offset']} (high watermark {response['high_watermark']})")
+            else:
+                print(f"Response: {response}")
 
         elif choice == "4":
             topic_name = input("Enter the topic name to subscribe: ").strip()
             subscriber_id = input("Enter your subscriber ID: ").strip()
-            response = client.send_request({"action": "subscribe", "topic_name": topic_name, "subscriber_id": subscriber_id})
+            response = client.subscribe(
+                topic_name, subscriber_id,
+                lambda topic, messages: print(f"\n[{topic}] New messages: {messages}"))
             print(f"Response: {response}")
 
         elif choice == "5":
-            response = client.send_request({"action": "fetch_topics"})
-            print(f"Available Topics: {list(response.keys())}")
+            prefix = input("Enter a topic name prefix (default: all topics): ").strip()
+            response = client.list_topics(prefix)
+            if response.get("status") == "ok":
+                for topic in response["topics"]:
+                    print(f"{topic['topic']}: {topic['messages']} messages, {topic['size_bytes']} bytes, "
+                          f"offsets {topic['first_offset']}-{topic['last_offset']}, "
+                          f"{topic['subscribers']} subscribers, replicas {topic['replicas']}")
+                if response["next_cursor"] is not None:
+                    print(f"More topics after '{response['next_cursor']}'")
+            else:
+                print(f"Response: {response}")
 
         elif choice == "6":
             print("Exiting Pub/Sub Client. Goodbye!")
+            client.close()
             break
 
         else:
@@ -0,0 +1,859 @@
+import argparse
+import json
+import os
+import queue
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from protocol import Connection
+
+PEER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "peer.py")
+NODE_MODES = ("process", "inprocess")
+PROCESS_ONLY_STEPS = ("kill", "restart", "pause", "resume")
+
+SCENARIOS = {
+    "kill-leader": {
+        "description": "SIGKILL the topic's leader under load, then restart it",
+        "steps": [["wait", 5], ["kill", "leader"], ["wait", 10], ["restart", "leader"], ["wait", 10]],
+    },
+    "kill-replica": {
+        "description": "SIGKILL a replica under load, then restart it",
+        "steps": [["wait", 5], ["kill", "replica"], ["wait", 10], ["restart", "replica"], ["wait", 10]],
+    },
+    "pause-leader": {
+        "description": "Freeze the leader with SIGSTOP, as a long GC or VM pause would, then resume it",
+        "steps": [["wait", 5], ["pause", "leader"], ["wait", 10], ["resume", "leader"], ["wait", 10]],
+    },
+    "isolate-leader": {
+        "description": "Partition the leader from every other node; clients can still reach it",
+        "steps": [["wait", 5], ["isolate", "leader"], ["wait", 10], ["heal"], ["wait", 10]],
+    },
+    "slow-links": {
+        "description": "Add 50-100 ms to every link between nodes",
+        "steps": [["wait", 5], ["degrade", "*", "*", 0.05, 0.05, 0.0], ["wait", 10], ["heal"], ["wait", 5]],
+    },
+    "lossy-gossip": {
+        "description": "Drop half of the heartbeat datagrams on every link",
+        "steps": [["wait", 5], ["degrade", "*", "*", 0.0, 0.0, 0.5], ["wait", 10], ["heal"], ["wait", 5]],
+    },
+}
+
+
+class LinkProxy:
+    """Carries one node's connections and gossip to another node, with injectable faults.
+
+    Node `src` is configured to reach node `dst` at this proxy's port, which
+    forwards TCP connections and UDP datagrams to `dst`'s own port. `block`
+    blackholes the link: whatever is sent either way is silently discarded,
+    as in a network partition. `configure` delays every chunk and datagram by
+    `delay` plus up to `jitter` seconds and drops datagrams with probability
+    `loss`. `reset` closes open connections. Connections that lost data while
+    the link was blocked are closed on `heal`, since their byte stream has a
+    hole in it.
+    """
+
+    def __init__(self, port, target_port, host="localhost", seed=None):
+        self.port = port
+        self.host = host
+        self.target = (host, target_port)
+        self.blocked = False
+        self.delay = 0.0
+        self.jitter = 0.0
+        self.loss = 0.0
+        self.random = random.Random(seed)
+        self.connections = set()  # {_ProxiedConnection}
+        self.stats = {"forwarded_bytes": 0, "dropped_bytes": 0, "forwarded_datagrams": 0, "dropped_datagrams": 0}
+        self.lock = threading.Lock()
+        self.running = False
+        self.tcp = None
+        self.udp = None
+
+    def start(self):
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((self.host, self.port))
+        self.tcp.listen(128)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((self.host, self.port))
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._datagram_loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for sock in (self.tcp, self.udp):
+            if sock is not None:
+                sock.close()
+        self.reset()
+
+    def block(self):
+        with self.lock:
+            self.blocked = True
+
+    def heal(self):
+        """Unblock the link and remove any delay or loss."""
+        with self.lock:
+            self.blocked = False
+            self.delay = self.jitter = self.loss = 0.0
+            damaged = [connection for connection in self.connections if connection.damaged]
+        for connection in damaged:
+            connection.close()
+
+    def configure(self, delay=0.0, jitter=0.0, loss=0.0):
+        with self.lock:
+            self.delay = delay
+            self.jitter = jitter
+            self.loss = loss
+
+    def reset(self):
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def admit(self, size, datagram=False):
+        """When data entering the link now should be delivered, or None if the link drops it."""
+        with self.lock:
+            if self.blocked or (datagram and self.loss and self.random.random() < self.loss):
+                self.stats["dropped_datagrams" if datagram else "dropped_bytes"] += 1 if datagram else size
+                return None
+            self.stats["forwarded_datagrams" if datagram else "forwarded_bytes"] += 1 if datagram else size
+            delay = self.delay + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        return time.monotonic() + delay
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.tcp.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._open, args=(client,), daemon=True).start()
+
+    def _open(self, client):
+        upstream = None
+        if not self.blocked:  # Over a blocked link the connection opens but nothing gets through
+            try:
+                upstream = socket.create_connection(self.target, timeout=1.0)
+                upstream.settimeout(None)
+            except OSError:
+                client.close()
+                return
+        connection = _ProxiedConnection(self, client, upstream)
+        with self.lock:
+            self.connections.add(connection)
+        connection.start()
+
+    def _datagram_loop(self):
+        while self.running:
+            try:
+                data, _ = self.udp.recvfrom(65535)
+            except OSError:
+                return
+            due = self.admit(len(data), datagram=True)
+            if due is None:
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                threading.Timer(delay, self._send_datagram, (data,)).start()
+            else:
+                self._send_datagram(data)
+
+    def _send_datagram(self, data):
+        try:
+            self.udp.sendto(data, self.target)
+        except OSError:
+            pass
+
+
+class _ProxiedConnection:
+    """A client connection through a LinkProxy: one reader and one delayed writer per direction."""
+
+    def __init__(self, proxy, client, upstream):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.damaged = upstream is None  # Set once the link dropped some of its data
+        self.closed = False
+
+    def start(self):
+        self._pipe(self.client, self.upstream)
+        if self.upstream is not None:
+            self._pipe(self.upstream, self.client)
+
+    def _pipe(self, source, sink):
+        chunks = queue.Queue() if sink is not None else None
+        threading.Thread(target=self._read, args=(source, chunks), daemon=True).start()
+        if chunks is not None:
+            threading.Thread(target=self._write, args=(sink, chunks), daemon=True).start()
+
+    def _read(self, source, chunks):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            due = self.proxy.admit(len(data))
+            if due is None or chunks is None:
+                self.damaged = True
+            else:
+                chunks.put((due, data))
+        if chunks is None:
+            self.close()
+        else:
+            chunks.put(None)  # The writer closes once the delayed data has gone out
+
+    def _write(self, sink, chunks):
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            due, data = item
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                sink.sendall(data)
+            except OSError:
+                break
+        self.close()
+
+    def close(self):
+        with self.proxy.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.proxy.connections.discard(self)
+        for sock in (self.client, self.upstream):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+
+class LocalNode:
+    """One node of a LocalCluster: a `peer.py` subprocess, or a PeerNode in this process.
+
+    Only subprocesses can be killed, paused and restarted (with POSIX signals).
+    """
+
+    def __init__(self, node_id, port, peer_list, mode="process", options=None, data_dir=None):
+        if mode not in NODE_MODES:
+            raise ValueError(f"Unknown node mode '{mode}', expected one of {NODE_MODES}")
+        self.node_id = node_id
+        self.port = port
+        self.peer_list = peer_list  # As this node sees the cluster: peers' addresses may be proxies
+        self.mode = mode
+        self.options = options or {}  # peer.py options, e.g. {"storage": "disk", "gossip_interval": 0.5}
+        self.data_dir = data_dir
+        self.process = None
+        self.peer = None
+        self.log = None
+        self.state = "stopped"  # "running", "paused", "killed" or "stopped"
+
+    def arguments(self):
+        arguments = ["--node-id", str(self.node_id), "--port", str(self.port), "--data-dir", self.data_dir,
+                     "--peers", *(f"{peer_id}:{ip}:{port}" for peer_id, ip, port in self.peer_list)]
+        for name, value in self.options.items():
+            if value is True:
+                arguments.append(f"--{name.replace('_', '-')}")
+            elif value is not False:
+                arguments += [f"--{name.replace('_', '-')}", str(value)]
+        return arguments
+
+    def start(self):
+        if self.mode == "process":
+            self.log = open(os.path.join(os.path.dirname(self.data_dir), f"node{self.node_id}.log"), "ab")
+            self.process = subprocess.Popen([sys.executable, PEER_SCRIPT, *self.arguments()],
+                                            stdin=subprocess.DEVNULL, stdout=self.log, stderr=subprocess.STDOUT)
+        else:
+            from peer import PeerNode
+            options = dict(self.options)
+            gossip_options = {"interval": options.pop("gossip_interval")} if "gossip_interval" in options else None
+            membership_options = ({"phi_threshold": options.pop("phi_threshold")}
+                                  if "phi_threshold" in options else None)
+            self.peer = PeerNode(self.node_id, self.port, self.peer_list, data_dir=self.data_dir,
+                                 gossip_options=gossip_options, membership_options=membership_options, **options)
+            self.peer.start_server()
+            self.peer.start_catch_up()
+            self.peer.start_heartbeat_sender()
+        self.state = "running"
+
+    def wait_ready(self, timeout=10.0):
+        """Wait until the node accepts connections."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError(f"Node {self.node_id} exited with code {self.process.returncode}")
+            try:
+                socket.create_connection(("localhost", self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f"Node {self.node_id} did not start listening on port {self.port} within {timeout}s")
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+        self.process.wait()
+        self.log.close()
+        self.state = "killed"
+
+    def pause(self):
+        self._signal(signal.SIGSTOP)
+        self.state = "paused"
+
+    def resume(self):
+        self._signal(signal.SIGCONT)
+        self.state = "running"
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            if self.state == "paused":
+                self.process.send_signal(signal.SIGCONT)
+            self.process.kill()
+            self.process.wait()
+        if self.log is not None:
+            self.log.close()
+        self.state = "stopped"
+
+    def _signal(self, signum):
+        if self.process is None:
+            raise ValueError(f"Node {self.node_id} runs in this process; only subprocess nodes take signals")
+        self.process.send_signal(signum)
+
+
+class LocalCluster:
+    """`size` nodes on localhost, each link between two nodes running through its own LinkProxy.
+
+    Node i listens on `base_port` + i and reaches node j at `base_port` +
+    100 * i + j, the port of the proxy of link i->j, so any link can be
+    blocked, delayed or made lossy on its own and in one direction only.
+    Clients connect to nodes directly. Node data and logs go to `data_dir`
+    (a fresh temporary directory by default).
+    """
+
+    def __init__(self, size=3, base_port=7000, mode="process", proxied=True, data_dir=None, seed=0,
+                 **node_options):
+        if not 1 <= size < 100:
+            raise ValueError("A local cluster has 1 to 99 nodes")
+        self.size = size
+        self.base_port = base_port
+        self.proxied = proxied
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix="pubsub-cluster-")
+        self.proxies = {}  # {(src, dst): LinkProxy}
+        self.nodes = {}  # {node_id: LocalNode}
+        for src in self.node_ids:
+            peer_list = [(dst, "localhost", self.link_port(src, dst)) for dst in self.node_ids]
+            self.nodes[src] = LocalNode(src, self.port(src), peer_list, mode, node_options,
+                                        os.path.join(self.data_dir, f"node{src}"))
+            if proxied:
+                for dst in self.node_ids:
+                    if dst != src:
+                        self.proxies[src, dst] = LinkProxy(self.link_port(src, dst), self.port(dst),
+                                                           seed=seed * 10000 + src * 100 + dst)
+
+    @property
+    def node_ids(self):
+        return range(1, self.size + 1)
+
+    def port(self, node_id):
+        return self.base_port + node_id
+
+    def link_port(self, src, dst):
+        """Port at which node `src` reaches node `dst`."""
+        if src == dst or not self.proxied:
+            return self.port(dst)
+        return self.base_port + 100 * src + dst
+
+    def start(self, timeout=10.0):
+        for proxy in self.proxies.values():
+            proxy.start()
+        for node in self.nodes.values():
+            node.start()
+        for node in self.nodes.values():
+            node.wait_ready(timeout)
+
+    def stop(self):
+        """Kill node subprocesses and close the proxies. In-process nodes stop with this process."""
+        for node in self.nodes.values():
+            node.stop()
+        for proxy in self.proxies.values():
+            proxy.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def connect(self, node_id, timeout=1.0):
+        return Connection("localhost", self.port(node_id), timeout=timeout)
+
+    def kill(self, node_id):
+        """SIGKILL a node: no shutdown, its sockets are reset by the kernel."""
+        self.nodes[node_id].kill()
+
+    def restart(self, node_id, timeout=10.0):
+        """Start a killed node again on the same port and data directory; it catches up from its peers."""
+        node = self.nodes[node_id]
+        node.start()
+        node.wait_ready(timeout)
+
+    def pause(self, node_id):
+        """SIGSTOP a node: its connections stay open but nothing is answered, like a long GC pause."""
+        self.nodes[node_id].pause()
+
+    def resume(self, node_id):
+        self.nodes[node_id].resume()
+
+    def links(self, sources, destinations):
+        return [proxy for (src, dst), proxy in self.proxies.items() if src in sources and dst in destinations]
+
+    def partition(self, *groups):
+        """Block every link between nodes of different groups. Nodes not named form one more group."""
+        groups = [set(group) for group in groups]
+        rest = set(self.node_ids).difference(*groups)
+        if rest:
+            groups.append(rest)
+        for i, group in enumerate(groups):
+            for other in groups[i + 1:]:
+                for proxy in self.links(group, other) + self.links(other, group):
+                    proxy.block()
+
+    def block(self, src, dst):
+        """Drop everything node `src` sends to node `dst` over its connections and gossip (one way)."""
+        self.proxies[src, dst].block()
+
+    def degrade(self, sources, destinations, delay=0.0, jitter=0.0, loss=0.0):
+        for proxy in self.links(sources, destinations):
+            proxy.configure(delay, jitter, loss)
+
+    def heal(self):
+        """Remove every link fault."""
+        for proxy in self.proxies.values():
+            proxy.heal()
+
+
+def _first_at_or_after(timeline, start, predicate):
+    return next((t for t, value in timeline if t >= start and predicate(value)), None)
+
+
+class ScenarioRun:
+    """Runs scripted faults against a LocalCluster while a producer and a consumer keep it loaded.
+
+    The producer publishes to one topic's leader at `rate` messages/sec and
+    the consumer reads it back, moving on to the topic's replicas whenever its
+    node stops answering. Every node is polled for its membership view and
+    the topic's high watermark. Each fault is reported with the time until
+    the other nodes marked the faulty ones offline, the time until reads and
+    writes succeeded again, and, once it is repaired, the time until the
+    nodes saw each other again and the topic's copies had caught up.
+    Acknowledged messages missing from every node at the end are counted as
+    lost.
+
+    A step is a list: ["wait", seconds], ["kill" | "restart" | "pause" |
+    "resume" | "isolate", node], ["partition", [nodes], [nodes], ...],
+    ["block", src, dst], ["degrade", src, dst, delay, jitter, loss] or
+    ["heal"]. Nodes are ids, "leader", "replica" (the first replica) or, for
+    degrade, "*" for every node.
+    """
+
+    def __init__(self, cluster, steps, topic="failover", rate=200.0, message_size=100, poll_interval=0.1,
+                 settle=5.0, timeout=1.0):
+        if cluster.nodes[1].mode != "process" and any(step[0] in PROCESS_ONLY_STEPS for step in steps):
+            raise ValueError(f"Steps {PROCESS_ONLY_STEPS} need nodes running as subprocesses")
+        self.cluster = cluster
+        self.steps = steps
+        self.topic = topic
+        self.rate = rate
+        self.message_size = message_size
+        self.poll_interval = poll_interval
+        self.settle = settle  # Seconds after the last step before the copies are compared
+        self.timeout = timeout
+        self.leader = None
+        self.replicas = []
+        self.started = None
+        self.running = False
+        self.incidents = []
+        self.membership = {node_id: [] for node_id in cluster.node_ids}  # {observer: [(t, {node: status})]}
+        self.watermarks = {node_id: [] for node_id in cluster.node_ids}  # {node: [(t, high watermark)]}
+        self.publishes = []  # [(t, ok)]
+        self.reads = []  # [(t, ok)]
+        self.acked = set()
+        self.quorum_acked = set()
+        self.read_sequences = set()
+        self.published = 0
+
+    def now(self):
+        return time.monotonic() - self.started
+
+    def setup(self, leader=1):
+        connection = self.cluster.connect(leader, timeout=5.0)
+        try:
+            connection.request({"action": "create_topic", "topic_name": self.topic})
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                status = connection.request({"action": "replication_status", "topic_name": self.topic})
+                streams = status["replicas"].get(self.topic, {})
+                if streams and all(stream["state"] == "online" for stream in streams.values()):
+                    break
+                time.sleep(0.1)
+            topics = connection.request({"action": "list_topics", "prefix": self.topic})["topics"]
+        finally:
+            connection.close()
+        entry = next(entry for entry in topics if entry["topic"] == self.topic)
+        self.leader, self.replicas = entry["leader"], list(entry["replicas"])
+
+    def resolve(self, node):
+        if node == "leader":
+            return self.leader
+        if node == "replica":
+            return self.replicas[0]
+        if node == "*":
+            return list(self.cluster.node_ids)
+        return int(node)
+
+    def run(self):
+        if self.leader is None:
+            self.setup()
+        self.started = time.monotonic()
+        self.running = True
+        threads = [threading.Thread(target=self._produce, daemon=True),
+                   threading.Thread(target=self._consume, daemon=True)]
+        threads += [threading.Thread(target=self._watch, args=(node_id,), daemon=True)
+                    for node_id in self.cluster.node_ids]
+        for thread in threads:
+            thread.start()
+        for step in self.steps:
+            self.apply(step)
+        time.sleep(self.settle)
+        self.running = False
+        for thread in threads:
+            thread.join(self.timeout + 1)
+        return self.report()
+
+    def apply(self, step):
+        action, *args = step
+        cluster = self.cluster
+        if action == "wait":
+            time.sleep(args[0])
+            return
+        at = self.now()
+        if action in ("kill", "pause"):
+            node = self.resolve(args[0])
+            getattr(cluster, action)(node)
+            self._open_incident(action, [node], at,
+                                [(observer, node) for observer in cluster.node_ids if observer != node])
+        elif action in ("restart", "resume"):
+            node = self.resolve(args[0])
+            getattr(cluster, action)(node)
+            self._close_incidents(lambda incident: node in incident["nodes"] and incident["fault"] in ("kill", "pause"),
+                                  self.now(), [node])
+        elif action in ("isolate", "partition"):
+            groups = [[self.resolve(args[0])]] if action == "isolate" else [[self.resolve(n) for n in g] for g in args]
+            cluster.partition(*groups)
+            grouped = {node for group in groups for node in group}
+            groups.append([node for node in cluster.node_ids if node not in grouped])
+            side = {node: i for i, group in enumerate(groups) for node in group}
+            pairs = [(a, b) for a in cluster.node_ids for b in cluster.node_ids if side[a] != side[b]]
+            self._open_incident(action, sorted(grouped), at, pairs)
+        elif action == "block":
+            src, dst = self.resolve(args[0]), self.resolve(args[1])
+            cluster.block(src, dst)
+            self._open_incident(action, [src, dst], at, [(dst, src)])
+        elif action == "degrade":
+            sources, destinations = (self._as_list(self.resolve(node)) for node in args[:2])
+            cluster.degrade(sources, destinations, *args[2:])
+            self._open_incident(action, sorted(set(sources) | set(destinations)), at, [], list(args[2:]))
+        elif action == "heal":
+            cluster.heal()
+            self._close_incidents(lambda incident: incident["fault"] in ("isolate", "partition", "block", "degrade"),
+                                  self.now(), [])
+        else:
+            raise ValueError(f"Unknown step '{action}'")
+
+    @staticmethod
+    def _as_list(nodes):
+        return nodes if isinstance(nodes, list) else [nodes]
+
+    def _open_incident(self, fault, nodes, at, pairs, parameters=None):
+        self.incidents.append({"fault": fault, "nodes": nodes, "at_s": at, "pairs": pairs,
+                               "parameters": parameters, "repaired_at_s": None, "catch_up_target": None})
+
+    def _close_incidents(self, matches, at, repaired_nodes):
+        """Mark matching incidents repaired. Their copies have caught up once they hold what the
+        other copies held at this moment."""
+        sources = [node for node in [self.leader, *self.replicas]
+                   if node not in repaired_nodes and self.cluster.nodes[node].state == "running"]
+        target = max((self._watermark(node, at) or 0 for node in sources), default=0)
+        for incident in self.incidents:
+            if incident["repaired_at_s"] is None and matches(incident):
+                incident["repaired_at_s"] = at
+                incident["catch_up_target"] = target
+
+    def _watermark(self, node, at):
+        """Latest high watermark polled from `node` at or before `at`."""
+        value = None
+        for t, high_watermark in self.watermarks[node]:
+            if t > at:
+                break
+            value = high_watermark
+        return value
+
+    def _produce(self):
+        connection = self.cluster.connect(self.leader, self.timeout)
+        interval = 1.0 / self.rate
+        padding = "x" * max(0, self.message_size - 12)
+        next_send = time.monotonic()
+        while self.running:
+            sequence = self.published
+            self.published += 1
+            try:
+                response = connection.request({"action": "publish", "topic_name": self.topic,
+                                               "message": f"{sequence}:{padding}"})
+                ok = response.get("status") == "message_published"
+            except (ConnectionError, TimeoutError):
+                connection.close()
+                ok = False
+                response = {}
+            self.publishes.append((self.now(), ok))
+            if ok:
+                self.acked.add(sequence)
+                if response.get("quorum"):
+                    self.quorum_acked.add(sequence)
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1.0:
+                next_send = time.monotonic()  # Far behind after an outage: resume the rate instead of bursting
+        connection.close()
+
+    def _consume(self):
+        nodes = [self.leader, *self.replicas]
+        current = 0
+        connection = self.cluster.connect(nodes[current], self.timeout)
+        offset = 0
+        while self.running:
+            try:
+                response = connection.request({"action": "fetch_messages", "topic_name": self.topic,
+                                               "from_offset": offset, "max_messages": 1000})
+                ok = response.get("status") == "ok"
+            except (ConnectionError, TimeoutError):
+                ok = False
+            self.reads.append((self.now(), ok))
+            if not ok:
+                connection.close()
+                current = (current + 1) % len(nodes)
+                connection = self.cluster.connect(nodes[current], self.timeout)
+                continue
+            for _, message in response["messages"]:
+                self.read_sequences.add(int(message.split(":", 1)[0]))
+            offset = response["next_offset"]
+            if not response["messages"]:
+                time.sleep(self.poll_interval)
+        connection.close()
+
+    def _watch(self, node_id):
+        connection = self.cluster.connect(node_id, min(self.timeout, 0.5))
+        while self.running:
+            if self.cluster.nodes[node_id].state == "running":
+                try:
+                    membership = connection.send({"action": "membership"})
+                    offsets = connection.send({"action": "topic_offsets"})
+                    nodes = membership.wait(connection.timeout)["nodes"]
+                    topics = offsets.wait(connection.timeout)["topics"]
+                    at = self.now()
+                    self.membership[node_id].append((at, {int(node): info["status"] for node, info in nodes.items()}))
+                    if self.topic in topics:
+                        self.watermarks[node_id].append((at, topics[self.topic]["high_watermark"]))
+                except (ConnectionError, TimeoutError):
+                    connection.close()
+            time.sleep(self.poll_interval)
+        connection.close()
+
+    def verify(self):
+        """The sequence numbers every reachable copy of the topic holds: {node: set}."""
+        copies = {}
+        for node_id in [self.leader, *self.replicas]:
+            if self.cluster.nodes[node_id].state != "running":
+                continue
+            connection = self.cluster.connect(node_id, timeout=5.0)
+            sequences = set()
+            offset = 0
+            try:
+                while True:
+                    response = connection.request({"action": "fetch_messages", "topic_name": self.topic,
+                                                   "from_offset": offset, "max_messages": 1000})
+                    if response.get("status") != "ok":
+                        break
+                    sequences.update(int(message.split(":", 1)[0]) for _, message in response["messages"])
+                    if not response["messages"] or response["next_offset"] >= response["high_watermark"]:
+                        break
+                    offset = response["next_offset"]
+            except (ConnectionError, TimeoutError):
+                continue
+            finally:
+                connection.close()
+            copies[node_id] = sequences
+        return copies
+
+    def measure(self, incident, end):
+        """Detection, outage and catch-up times of one incident, in seconds from the fault or repair."""
+        at, repaired = incident["at_s"], incident["repaired_at_s"]
+        window_end = repaired if repaired is not None else end
+        detections = []
+        for observer, subject in incident["pairs"]:
+            detected = _first_at_or_after(self.membership[observer], at, lambda view: view.get(subject) == "offline")
+            detections.append(None if detected is None or detected > window_end else detected - at)
+        expected = set(incident["pairs"])
+        false_suspicions = sorted({(observer, node) for observer, timeline in self.membership.items()
+                                   for t, view in timeline if at <= t <= window_end
+                                   for node, status in view.items()
+                                   if status == "offline" and (observer, node) not in expected})
+        result = {
+            "fault": incident["fault"],
+            "nodes": incident["nodes"],
+            "at_s": round(at, 3),
+            "detected_first_s": min((d for d in detections if d is not None), default=None),
+            "detected_all_s": max(detections) if detections and None not in detections else None,
+            "false_suspicions": [list(pair) for pair in false_suspicions],
+            "read_failover_s": self._outage(self.reads, at, window_end),
+            "write_outage_s": self._outage(self.publishes, at, window_end),
+            "repaired_at_s": None if repaired is None else round(repaired, 3),
+            "rejoined_s": None,
+            "catch_up_s": None,
+        }
+        if incident["parameters"]:
+            result["delay_s"], result["jitter_s"], result["loss"] = incident["parameters"]
+        if repaired is not None:
+            rejoins = [_first_at_or_after(self.membership[observer], repaired,
+                                          lambda view: view.get(subject) == "online")
+                       for observer, subject in incident["pairs"]]
+            if incident["pairs"] and None not in rejoins:
+                result["rejoined_s"] = max(rejoins) - repaired
+            target = incident["catch_up_target"]
+            caught_up = [_first_at_or_after(self.watermarks[node], repaired, lambda hw: hw >= target)
+                         for node in [self.leader, *self.replicas]]
+            if None not in caught_up:
+                result["catch_up_s"] = max(caught_up) - repaired
+        return result
+
+    @staticmethod
+    def _outage(timeline, at, window_end):
+        """Seconds from `at` until requests succeeded again after the first one that failed, 0.0 if none failed."""
+        failed = _first_at_or_after(timeline, at, lambda ok: not ok)
+        if failed is None or failed > window_end:
+            return 0.0
+        recovered = _first_at_or_after(timeline, failed, lambda ok: ok)
+        return None if recovered is None else recovered - at
+
+    def report(self):
+        end = self.now()
+        copies = self.verify()
+        everywhere = set.intersection(*copies.values()) if copies else set()
+        anywhere = set.union(*copies.values()) if copies else set()
+        return {
+            "leader": self.leader,
+            "replicas": self.replicas,
+            "duration_s": round(end, 3),
+            "incidents": [self.measure(incident, end) for incident in self.incidents],
+            "published": self.published,
+            "acked": len(self.acked),
+            "quorum_acked": len(self.quorum_acked),
+            "publish_errors": sum(1 for _, ok in self.publishes if not ok),
+            "read_errors": sum(1 for _, ok in self.reads if not ok),
+            "messages_read": len(self.read_sequences),
+            "copies": {node_id: len(sequences) for node_id, sequences in copies.items()},
+            "lost_acked": len(self.acked - anywhere),
+            "lost_quorum_acked": len(self.quorum_acked - anywhere),
+            "acked_missing_on_some_copy": len(self.acked - everywhere),
+        }
+
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def print_report(name, report):
+    print(f"\nScenario {name}: leader {report['leader']}, replicas {report['replicas']}, "
+          f"{report['duration_s']:.1f}s")
+    print(f"  {'fault':<22} {'at':>7} {'detect 1st':>10} {'detect all':>10} {'read f/o':>9} {'write out':>9} "
+          f"{'rejoined':>9} {'catch-up':>9}")
+    for incident in report["incidents"]:
+        fault = f"{incident['fault']} {','.join(map(str, incident['nodes']))}"
+        print(f"  {fault:<22} {incident['at_s']:>6.1f}s {_seconds(incident['detected_first_s']):>10} "
+              f"{_seconds(incident['detected_all_s']):>10} {_seconds(incident['read_failover_s']):>9} "
+              f"{_seconds(incident['write_outage_s']):>9} {_seconds(incident['rejoined_s']):>9} "
+              f"{_seconds(incident['catch_up_s']):>9}")
+        if incident["false_suspicions"]:
+            print(f"  {'':<22} wrongly marked offline (observer, node): {incident['false_suspicions']}")
+    print(f"  Published {report['published']}, acked {report['acked']} ({report['quorum_acked']} with quorum), "
+          f"{report['publish_errors']} publish errors, {report['read_errors']} read errors")
+    print(f"  Copies {report['copies']}; lost: {report['lost_acked']} acked, {report['lost_quorum_acked']} "
+          f"quorum-acked; {report['acked_missing_on_some_copy']} acked messages missing from some copy")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fault-injection scenarios against a local cluster")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Built-in scenario to run; repeat for several (default: all)")
+    parser.add_argument("--scenario-file", help='JSON file: {"steps": [...]} plus optional "nodes", "rate", '
+                                                '"seed" and "node_options"')
+    parser.add_argument("--list", action="store_true", help="List the built-in scenarios")
+    parser.add_argument("--nodes", type=int)
+    parser.add_argument("--mode", choices=NODE_MODES, default="process")
+    parser.add_argument("--base-port", type=int, default=7000)
+    parser.add_argument("--rate", type=float, help="Messages/sec published during the scenario (default: 200)")
+    parser.add_argument("--seed", type=int, help="Seeds link delay jitter and datagram loss (default: 0)")
+    parser.add_argument("--settle", type=float, default=5.0, help="Seconds after the last step before verifying")
+    parser.add_argument("--storage", choices=("memory", "disk"))
+    parser.add_argument("--gossip-interval", type=float)
+    parser.add_argument("--phi-threshold", type=float)
+    parser.add_argument("--data-dir", help="Node data and logs (default: a new temporary directory per scenario)")
+    parser.add_argument("--json", help="Write the reports to this file")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, scenario in sorted(SCENARIOS.items()):
+            print(f"{name:<16} {scenario['description']}")
+        sys.exit(0)
+    if args.scenario_file:
+        with open(args.scenario_file) as f:
+            scenarios = {os.path.basename(args.scenario_file): json.load(f)}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in args.scenario or sorted(SCENARIOS)}
+
+    reports = {}
+    for name, scenario in scenarios.items():
+        node_options = dict(scenario.get("node_options", {}))
+        for option in ("storage", "gossip_interval", "phi_threshold"):
+            if getattr(args, option) is not None:
+                node_options[option] = getattr(args, option)
+        seed = args.seed if args.seed is not None else scenario.get("seed", 0)
+        data_dir = os.path.join(args.data_dir, name) if args.data_dir else None
+        cluster = LocalCluster(args.nodes or scenario.get("nodes", 3), args.base_port, args.mode, data_dir=data_dir,
+                               seed=seed, **node_options)
+        print(f"Running {name} on {cluster.size} nodes (data and logs in {cluster.data_dir})...")
+        with cluster:
+            run = ScenarioRun(cluster, scenario["steps"], rate=args.rate or scenario.get("rate", 200.0),
+                              settle=args.settle)
+            report = run.run()
+        report.update(scenario=name, nodes=cluster.size, seed=seed, node_options=node_options,
+                      steps=scenario["steps"])
+        reports[name] = report
+        print_report(name, report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"\nReports saved to {args.json}")
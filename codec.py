@@ -0,0 +1,350 @@
+import pickle
+import struct
+from array import array
+from itertools import accumulate
+
+# Binary codec: every value starts with a one-byte tag.
+#   0x80-0xff  small int 0-127 inline
+#   0x40-0x7f  well-known string from SYMBOLS (index 0-63) inline
+#   below 0x40 one of the tags below, followed by varint lengths / raw bytes
+NONE, FALSE, TRUE, INT, NEG_INT, FLOAT, STR, BYTES, LIST, TUPLE, DICT, SYMBOL, RECORD = range(13)
+# Bulk message bodies, encoded and decoded in a few C-level passes:
+#   STR_LIST / BYTES_LIST    count, body lengths as little-endian uint32s
+#                            (characters for str), blob size, bodies back to back
+#   STR_SPLIT / BYTES_SPLIT  count, blob size, bodies joined with NUL, used when
+#                            no body contains a NUL
+#   OFFSET_RUN               varint base offset followed by one of the above,
+#                            for [(offset, body)] with consecutive offsets
+STR_LIST, BYTES_LIST, OFFSET_RUN, STR_SPLIT, BYTES_SPLIT = 13, 14, 15, 16, 17
+BODY_LISTS = (STR_LIST, BYTES_LIST, STR_SPLIT, BYTES_SPLIT)
+BULK_MIN = 4  # Shorter lists go through the generic path
+SMALL_INT = 0x80
+INLINE_SYMBOL = 0x40
+FLOAT_STRUCT = struct.Struct("!d")
+LITTLE_ENDIAN = struct.pack("=I", 1) == struct.pack("<I", 1)
+
+# Field names, actions and statuses sent on every request. Append only: the
+# index is the wire representation.
+SYMBOLS = (
+    "action", "topic_name", "message", "messages", "status", "topic", "offset", "first_offset",
+    "count", "next_offset", "high_watermark", "from_offset", "max_messages", "max_bytes", "base_offset",
+    "leader", "replica_of", "subscriber_id", "push", "max_queue", "overflow_policy", "replicas_acked",
+    "quorum", "node_id", "error",
+    "create_topic", "publish", "publish_batch", "replicate_append", "fetch_messages", "subscribe",
+    "unsubscribe", "notification", "fetch_topics", "heartbeat", "replication_status", "topic_offsets",
+    "topic_digests",
+    "ok", "topic_created", "message_published", "batch_published", "replicated", "offset_gap",
+    "topic_not_found", "subscribed", "unsubscribed", "unknown_action", "invalid_request",
+    "batches", "batch", "publish_records", "compression", "config", "key", "keys", "cleaner_status",
+    "pattern", "matched_topics",
+    "list_topics", "topics", "prefix", "cursor", "limit", "next_cursor", "size_bytes", "last_offset",
+    "last_publish_time", "replicas", "subscribers",
+    "stats", "metrics", "format", "text",
+    "metadata", "nodes", "not_leader", "online", "offline", "min_messages", "min_bytes", "max_wait_ms",
+    "join_group", "group_fetch", "commit_offsets", "leave_group", "group_stats", "group_id", "member_id",
+    "generation", "lease", "commit", "committed", "refused", "session_timeout", "ranges", "groups", "members",
+    "joined", "left", "unknown_member",
+    "partitions", "partition", "partitioner", "offsets", "partition_map", "leaders", "failed", "failures",
+    "round_robin", "hash",
+)
+SYMBOL_IDS = {symbol: index for index, symbol in enumerate(SYMBOLS)}
+
+# Record schemas: dicts with exactly these keys, in this order, are sent as
+# a schema id followed by the values only. Append only, like SYMBOLS.
+SCHEMAS = (
+    ("action", "topic_name", "message"),
+    ("action", "topic_name", "messages"),
+    ("action", "topic_name", "base_offset", "messages", "leader"),
+    ("action", "topic_name", "from_offset", "max_messages", "max_bytes"),
+    ("status", "topic", "messages", "next_offset", "high_watermark"),
+    ("status", "offset"),
+    ("status", "offset", "replicas_acked", "quorum"),
+    ("status", "count", "first_offset"),
+    ("status", "count", "first_offset", "replicas_acked", "quorum"),
+    ("status", "high_watermark"),
+    ("action", "topic", "subscriber_id", "messages"),
+    ("status",),
+    ("action", "topic_name", "base_offset", "batches", "leader"),
+    ("action", "topic_name", "batch"),
+    ("status", "topic", "batches", "next_offset", "high_watermark"),
+    ("action", "topic_name", "message", "key"),
+    ("action", "topic_name", "messages", "keys"),
+    ("action", "topic", "subscriber_id", "pattern", "messages"),
+    ("status", "topics", "next_cursor"),
+    ("topic", "messages", "size_bytes", "first_offset", "last_offset", "last_publish_time", "leader", "replicas",
+     "subscribers"),
+    ("leader", "replicas"),
+)
+SCHEMA_IDS = {fields: index for index, fields in enumerate(SCHEMAS)}
+
+
+class CodecError(ValueError):
+    """Raised for values the binary codec cannot represent and for malformed payloads."""
+
+
+class Codec:
+    """A named payload serialization that connections negotiate in their handshake."""
+
+    def __init__(self, name, codec_id, encode, decode):
+        self.name = name
+        self.codec_id = codec_id
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode(value, out):
+    kind = type(value)
+    if kind is str:
+        symbol = SYMBOL_IDS.get(value)
+        if symbol is not None:
+            if symbol < 0x40:
+                out.append(INLINE_SYMBOL | symbol)
+            else:
+                out.append(SYMBOL)
+                _varint(symbol, out)
+            return
+        data = value.encode("utf-8")
+        out.append(STR)
+        _varint(len(data), out)
+        out += data
+    elif kind is int:
+        if 0 <= value < 0x80:
+            out.append(SMALL_INT | value)
+        elif value >= 0:
+            out.append(INT)
+            _varint(value, out)
+        else:
+            out.append(NEG_INT)
+            _varint(-value, out)
+    elif kind is dict:
+        schema = SCHEMA_IDS.get(tuple(value))
+        if schema is not None:
+            out.append(RECORD)
+            out.append(schema)
+            for item in value.values():
+                _encode(item, out)
+            return
+        out.append(DICT)
+        _varint(len(value), out)
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    elif kind is list or kind is tuple:
+        if kind is list and len(value) >= BULK_MIN and _encode_bulk(value, out):
+            return
+        out.append(LIST if kind is list else TUPLE)
+        _varint(len(value), out)
+        for item in value:
+            _encode(item, out)
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        out.append(BYTES)
+        _varint(len(value), out)
+        out += value
+    elif value is None:
+        out.append(NONE)
+    elif kind is bool:
+        out.append(TRUE if value else FALSE)
+    elif kind is float:
+        out.append(FLOAT)
+        out += FLOAT_STRUCT.pack(value)
+    else:
+        for base in (str, int, float, bytes, list, tuple, dict):
+            if isinstance(value, base):  # Subclasses such as IntEnum go over the wire as their base type
+                _encode(base(value), out)
+                return
+        raise CodecError(f"The binary codec cannot encode {kind.__name__} values; "
+                         f"send str, bytes, numbers, lists or dicts, or negotiate the pickle codec")
+
+
+def _encode_bodies(bodies, out):
+    """Encode a sequence of all-str or all-bytes bodies; False if it is neither."""
+    types = set(map(type, bodies))
+    if types == {str}:
+        joined = "\0".join(bodies)
+        if joined.count("\0") == len(bodies) - 1:
+            out.append(STR_SPLIT)
+            return _encode_blob(len(bodies), joined.encode("utf-8"), out)
+        out.append(STR_LIST)
+        blob = "".join(bodies).encode("utf-8")
+    elif types == {bytes}:
+        joined = b"\0".join(bodies)
+        if joined.count(b"\0") == len(bodies) - 1:
+            out.append(BYTES_SPLIT)
+            return _encode_blob(len(bodies), joined, out)
+        out.append(BYTES_LIST)
+        blob = b"".join(bodies)
+    else:
+        return False
+    lengths = array("I", map(len, bodies))
+    if not LITTLE_ENDIAN:
+        lengths.byteswap()
+    _varint(len(bodies), out)
+    out += lengths.tobytes()
+    _varint(len(blob), out)
+    out += blob
+    return True
+
+
+def _encode_blob(count, blob, out):
+    _varint(count, out)
+    _varint(len(blob), out)
+    out += blob
+    return True
+
+
+def _encode_bulk(value, out):
+    """Bulk-encode a list of message bodies or of (offset, body) pairs with consecutive offsets."""
+    first = value[0]
+    if type(first) is tuple:
+        if not all(type(item) is tuple and len(item) == 2 and type(item[0]) is int for item in value) or first[0] < 0:
+            return False
+        offsets, bodies = zip(*value)
+        if offsets != tuple(range(first[0], first[0] + len(offsets))):
+            return False
+        mark = len(out)
+        out.append(OFFSET_RUN)
+        _varint(first[0], out)
+        if _encode_bodies(bodies, out):
+            return True
+        del out[mark:]
+        return False
+    return _encode_bodies(value, out)
+
+
+def _decode_bodies(buf, pos):
+    tag = buf[pos]
+    count, pos = _read_varint(buf, pos + 1)
+    if tag == STR_SPLIT or tag == BYTES_SPLIT:
+        size, pos = _read_varint(buf, pos)
+        end = pos + size
+        if end > len(buf):
+            raise CodecError("Truncated body list")
+        bodies = str(buf[pos:end], "utf-8").split("\0") if tag == STR_SPLIT else bytes(buf[pos:end]).split(b"\0")
+        if len(bodies) != count:
+            raise CodecError("Body count does not match the body list")
+        return bodies, end
+    lengths = array("I")
+    lengths.frombytes(buf[pos:pos + 4 * count])
+    if not LITTLE_ENDIAN:
+        lengths.byteswap()
+    pos += 4 * count
+    size, pos = _read_varint(buf, pos)
+    end = pos + size
+    if len(lengths) != count or end > len(buf):
+        raise CodecError("Truncated body list")
+    blob = str(buf[pos:end], "utf-8") if tag == STR_LIST else bytes(buf[pos:end])
+    ends = list(accumulate(lengths))
+    if ends and ends[-1] != len(blob):
+        raise CodecError("Body lengths do not match the body list")
+    starts = [0] + ends[:-1]
+    return list(map(blob.__getitem__, map(slice, starts, ends))), end
+
+
+def _decode(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag >= SMALL_INT:
+        return tag & 0x7F, pos
+    if tag >= INLINE_SYMBOL:
+        return SYMBOLS[tag & 0x3F], pos
+    if tag == STR:
+        length, pos = _read_varint(buf, pos)
+        end = pos + length
+        if end > len(buf):
+            raise CodecError("Truncated string")
+        return str(buf[pos:end], "utf-8"), end
+    if tag == RECORD:
+        fields = SCHEMAS[buf[pos]]
+        pos += 1
+        record = {}
+        for field in fields:
+            record[field], pos = _decode(buf, pos)
+        return record, pos
+    if tag == INT:
+        return _read_varint(buf, pos)
+    if tag == LIST or tag == TUPLE:
+        count, pos = _read_varint(buf, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _decode(buf, pos)
+            items.append(item)
+        return (items if tag == LIST else tuple(items)), pos
+    if tag == BYTES:
+        length, pos = _read_varint(buf, pos)
+        end = pos + length
+        if end > len(buf):
+            raise CodecError("Truncated bytes")
+        return bytes(buf[pos:end]), end
+    if tag == DICT:
+        count, pos = _read_varint(buf, pos)
+        result = {}
+        for _ in range(count):
+            key, pos = _decode(buf, pos)
+            result[key], pos = _decode(buf, pos)
+        return result, pos
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE or tag == FALSE:
+        return tag == TRUE, pos
+    if tag == NEG_INT:
+        value, pos = _read_varint(buf, pos)
+        return -value, pos
+    if tag == FLOAT:
+        return FLOAT_STRUCT.unpack_from(buf, pos)[0], pos + FLOAT_STRUCT.size
+    if tag in BODY_LISTS:
+        return _decode_bodies(buf, pos - 1)
+    if tag == OFFSET_RUN:
+        base, pos = _read_varint(buf, pos)
+        if buf[pos] not in BODY_LISTS:
+            raise CodecError("Offset run without a body list")
+        bodies, pos = _decode_bodies(buf, pos)
+        return list(zip(range(base, base + len(bodies)), bodies)), pos
+    if tag == SYMBOL:
+        index, pos = _read_varint(buf, pos)
+        return SYMBOLS[index], pos
+    raise CodecError(f"Unknown tag {tag:#x}")
+
+
+def encode(value):
+    """Encode plain data (None, bool, int, float, str, bytes, list, tuple, dict) to bytes."""
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def decode(payload):
+    """Decode a payload produced by `encode`. Message bodies are sliced straight out of it."""
+    try:
+        value, pos = _decode(payload, 0)
+    except (IndexError, KeyError, TypeError, ValueError, struct.error, RecursionError) as e:
+        raise CodecError(f"Malformed payload: {e!r}") from e
+    if pos != len(payload):
+        raise CodecError(f"{len(payload) - pos} trailing bytes after payload")
+    return value
+
+
+BINARY = Codec("binary", 1, encode, decode)
+PICKLE = Codec("pickle", 2, lambda value: pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads)
+CODECS = {codec.name: codec for codec in (BINARY, PICKLE)}
+CODEC_IDS = {codec.codec_id: codec for codec in CODECS.values()}
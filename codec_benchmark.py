@@ -0,0 +1,46 @@
+import argparse
+import pickle
+import timeit
+from codec import BINARY, PICKLE
+
+
+def sample_frames(message_bytes=100, batch=1000):
+    """Representative payloads for the hot request and response types."""
+    body = "x" * message_bytes
+    messages = [f"{i:08d}{body[8:]}" for i in range(batch)]
+    return {
+        "publish": {"action": "publish", "topic_name": "orders", "message": body},
+        "publish response": {"status": "message_published", "offset": 123456},
+        "fetch request": {"action": "fetch_messages", "topic_name": "orders", "from_offset": 123456,
+                          "max_messages": 1000, "max_bytes": 1024 * 1024},
+        f"fetch response ({batch})": {"status": "ok", "topic": "orders",
+                                      "messages": [(123456 + i, m) for i, m in enumerate(messages)],
+                                      "next_offset": 123456 + batch, "high_watermark": 200000},
+        f"replicate_append ({batch})": {"action": "replicate_append", "topic_name": "orders",
+                                        "base_offset": 123456, "messages": messages, "leader": 1},
+        "replication ack": {"status": "replicated", "high_watermark": 124456},
+    }
+
+
+def measure(codec, payload, repeat):
+    encoded = codec.encode(payload)
+    assert codec.decode(encoded) == payload
+    encode_time = min(timeit.repeat(lambda: codec.encode(payload), number=repeat, repeat=3)) / repeat
+    decode_time = min(timeit.repeat(lambda: codec.decode(encoded), number=repeat, repeat=3)) / repeat
+    return len(encoded), encode_time, decode_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binary codec vs pickle: encode/decode time and frame size")
+    parser.add_argument("--message-bytes", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=1000, help="Messages in fetch and replication frames")
+    parser.add_argument("--repeat", type=int, default=2000, help="Iterations per small frame measurement")
+    args = parser.parse_args()
+
+    print(f"pickle protocol {pickle.HIGHEST_PROTOCOL}")
+    print(f"{'frame':<26} {'codec':<7} {'bytes':>9} {'encode us':>10} {'decode us':>10}")
+    for name, payload in sample_frames(args.message_bytes, args.batch).items():
+        repeat = args.repeat if "messages" not in payload else max(1, args.repeat // 100)
+        for codec in (BINARY, PICKLE):
+            size, encode_time, decode_time = measure(codec, payload, repeat)
+            print(f"{name:<26} {codec.name:<7} {size:>9} {encode_time * 1e6:>10.2f} {decode_time * 1e6:>10.2f}")
@@ -0,0 +1,89 @@
+import argparse
+import contextlib
+import io
+import shutil
+import tempfile
+import threading
+import time
+from peer import PeerNode
+
+
+def run_contention(topic_count, publishers_per_topic, messages_per_publisher, storage="memory",
+                   fsync_policy="message", global_lock=False, data_root=None):
+    """Publish from `topic_count` x `publishers_per_topic` threads into one in-process node.
+
+    Returns (messages/sec, p99 latency of fetches on an idle topic during the run).
+    With `global_lock`, every topic shares one lock to reproduce a node-wide lock.
+    """
+    data_dir = tempfile.mkdtemp(prefix="contention-", dir=data_root)
+    node = PeerNode(node_id=1, port=0, peer_list=[], storage=storage, data_dir=data_dir,
+                    storage_options={"fsync_policy": fsync_policy} if storage == "disk" else None)
+    topics = [f"topic_{i}" for i in range(topic_count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for topic_name in topics + ["idle_topic"]:
+            node.create_topic(topic_name)
+        node.publish_message("idle_topic", "idle")
+    if global_lock:
+        shared = threading.Lock()
+        for topic_name in node.topic_locks:
+            node.topic_locks[topic_name] = shared
+
+    start_barrier = threading.Barrier(topic_count * publishers_per_topic + 1)
+    stop_reading = threading.Event()
+    fetch_latencies = []
+
+    def publish(topic_name):
+        start_barrier.wait()
+        for i in range(messages_per_publisher):
+            node.publish_message(topic_name, f"Benchmark Message {i}")
+
+    def read_idle_topic():
+        while not stop_reading.is_set():
+            started = time.perf_counter()
+            node.fetch_messages("idle_topic")
+            fetch_latencies.append(time.perf_counter() - started)
+            time.sleep(0.001)
+
+    publishers = [threading.Thread(target=publish, args=(topic_name,))
+                  for topic_name in topics for _ in range(publishers_per_topic)]
+    reader = threading.Thread(target=read_idle_topic)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in publishers:
+            thread.start()
+        reader.start()
+        start_barrier.wait()
+        started = time.perf_counter()
+        for thread in publishers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stop_reading.set()
+        reader.join()
+
+    for log in node.topics.values():
+        log.close()
+    shutil.rmtree(data_dir, ignore_errors=True)
+    total = topic_count * publishers_per_topic * messages_per_publisher
+    fetch_latencies.sort()
+    p99 = fetch_latencies[int(len(fetch_latencies) * 0.99)] if fetch_latencies else 0.0
+    return total / elapsed, p99
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="N topics x M publisher threads lock contention benchmark")
+    parser.add_argument("--topics", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--publishers", type=int, default=2, help="Publisher threads per topic")
+    parser.add_argument("--messages", type=int, default=500, help="Messages per publisher thread")
+    parser.add_argument("--storage", choices=["memory", "disk"], default="disk")
+    parser.add_argument("--fsync", choices=["message", "batch", "interval"], default="message")
+    parser.add_argument("--data-dir", default=None, help="Where disk topics are written (default: system temp)")
+    args = parser.parse_args()
+
+    print(f"{'topics':>6} {'threads':>7} {'per-topic msg/s':>16} {'node-wide msg/s':>16} "
+          f"{'speedup':>8} {'idle fetch p99':>15}")
+    for topic_count in args.topics:
+        per_topic, fetch_p99 = run_contention(topic_count, args.publishers, args.messages,
+                                              args.storage, args.fsync, data_root=args.data_dir)
+        node_wide, _ = run_contention(topic_count, args.publishers, args.messages,
+                                      args.storage, args.fsync, global_lock=True, data_root=args.data_dir)
+        print(f"{topic_count:>6} {topic_count * args.publishers:>7} {per_topic:>16.0f} {node_wide:>16.0f} "
+              f"{per_topic / node_wide:>7.2f}x {fetch_p99 * 1000:>12.3f} ms")
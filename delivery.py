@@ -0,0 +1,479 @@
+import asyncio
+import heapq
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from codec import BINARY, CodecError
+from protocol import PUSH_ID, encode_frame, encode_response
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "disconnect")
+MAX_PUSH_BATCH = 500  # Messages per notification frame
+
+
+class SubscriberQueue:
+    """Bounded outbound queue of messages waiting to be pushed to one subscriber.
+
+    Publishers only ever enqueue; the connection's I/O layer drains the queue
+    and writes notification frames, so a slow consumer only fills its own
+    queue. What happens when the queue is full depends on `overflow_policy`:
+
+    - "block": the entries are queued past `max_size`, and the publisher
+      that delivered them then waits, outside the topic's dispatch lock, up
+      to `block_timeout` seconds for the queue to drain back to `max_size`;
+      a subscriber that does not is disconnected
+    - "drop_oldest": the oldest queued message is discarded
+    - "disconnect": the subscriber is disconnected immediately
+
+    A queue with a `pattern` serves a wildcard subscription: it is fed by
+    every matching topic and its entries remember which topic they came from.
+    """
+
+    def __init__(self, topic_name, subscriber_id, max_size=1000, overflow_policy="drop_oldest", block_timeout=5.0,
+                 pattern=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}', expected one of {OVERFLOW_POLICIES}")
+        self.topic_name = topic_name
+        self.pattern = pattern
+        self.subscriber_id = subscriber_id
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.items = deque()  # [(offset, message, enqueued_at, topic_name)]
+        self.condition = threading.Condition()
+        self.closed = False
+        self.delivered = 0
+        self.dropped = 0
+        self.last_enqueued_offset = None
+        self.last_delivered_offset = None
+        self.on_ready = None  # Called (without the lock) after new items are queued
+        self.on_overflow = None  # Called when the overflow policy disconnects the subscriber
+
+    def offer(self, entries, topic_name=None):
+        """Enqueue [(offset, message)] entries of `topic_name` without waiting.
+
+        Returns False once the subscriber is disconnected. A "block" queue
+        may end up over `max_size`; see `wait_for_room`.
+        """
+        disconnect = False
+        with self.condition:
+            if self.closed:
+                return False
+            now = time.monotonic()
+            for offset, message in entries:
+                if len(self.items) >= self.max_size and not self._make_room():
+                    disconnect = True
+                    break
+                self.items.append((offset, message, now, topic_name))
+                self.last_enqueued_offset = offset
+            self.condition.notify_all()
+        if disconnect:
+            self._overflow()
+            return False
+        if self.on_ready is not None:
+            self.on_ready()
+        return True
+
+    def _make_room(self):
+        if self.overflow_policy == "drop_oldest":
+            self.items.popleft()
+            self.dropped += 1
+            return True
+        return self.overflow_policy == "block"  # Waited for by `wait_for_room`, without the dispatch lock
+
+    def over_capacity(self):
+        return len(self.items) > self.max_size
+
+    def wait_for_room(self, deadline):
+        """Wait until the queue is back within `max_size`, disconnecting the subscriber at `deadline`."""
+        with self.condition:
+            while len(self.items) > self.max_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            overflow = len(self.items) > self.max_size and not self.closed
+        if overflow:
+            self._overflow()
+
+    def _overflow(self):
+        self.close()
+        if self.on_overflow is not None:
+            self.on_overflow(self)
+
+    def take(self, max_items=MAX_PUSH_BATCH, timeout=None):
+        """Pop up to `max_items` queued entries, waiting up to `timeout` seconds for the first one."""
+        with self.condition:
+            if timeout is not None and not self.items and not self.closed:
+                self.condition.wait(timeout)
+            batch = []
+            while self.items and len(batch) < max_items:
+                batch.append(self.items.popleft())
+            if batch:
+                self.condition.notify_all()  # Wake publishers blocked on a full queue
+            return batch
+
+    def mark_delivered(self, batch):
+        with self.condition:
+            self.delivered += len(batch)
+            self.last_delivered_offset = batch[-1][0]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.on_ready is not None:
+            self.on_ready()
+
+    def metrics(self):
+        """Return queue depth, drop counts and lag for this subscriber."""
+        with self.condition:
+            oldest = self.items[0][2] if self.items else None
+            if self.pattern is not None:
+                lag_messages = len(self.items)  # Offsets of different topics cannot be compared
+            elif self.last_enqueued_offset is None:
+                lag_messages = 0
+            elif self.last_delivered_offset is None:
+                lag_messages = len(self.items)
+            else:
+                lag_messages = self.last_enqueued_offset - self.last_delivered_offset
+            return {
+                "queue_depth": len(self.items),
+                "max_queue": self.max_size,
+                "overflow_policy": self.overflow_policy,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "last_enqueued_offset": self.last_enqueued_offset,
+                "last_delivered_offset": self.last_delivered_offset,
+                "lag_messages": lag_messages,
+                "lag_ms": 0.0 if oldest is None else (time.monotonic() - oldest) * 1000,
+            }
+
+
+def notification_frame(queue, batch, codec=BINARY):
+    """Encode queued entries as notification frames, one per run of entries from the same topic."""
+    if queue.pattern is None:
+        return encode_frame(PUSH_ID, {
+            "action": "notification",
+            "topic": queue.topic_name,
+            "subscriber_id": queue.subscriber_id,
+            "messages": [(offset, message) for offset, message, _, _ in batch],
+        }, codec)
+    frames = []
+    start = 0
+    for end in range(1, len(batch) + 1):
+        if end == len(batch) or batch[end][3] != batch[start][3]:
+            frames.append(encode_frame(PUSH_ID, {
+                "action": "notification",
+                "topic": batch[start][3],
+                "subscriber_id": queue.subscriber_id,
+                "pattern": queue.pattern,
+                "messages": [(offset, message) for offset, message, _, _ in batch[start:end]],
+            }, codec))
+            start = end
+    return b"".join(frames)
+
+
+class TopicFanout:
+    """Fans published messages out to the push subscribers of one topic.
+
+    Publishers stage messages while they still hold the lock that assigned
+    their offsets, so staged entries are in offset order. `dispatch` runs after the lock is released
+    and hands them to the subscriber queues; whichever publisher gets the
+    dispatch lock delivers everything staged so far, so order is preserved
+    without publishers waiting on each other.
+    """
+
+    def __init__(self, topic_name):
+        self.topic_name = topic_name
+        self.queues = {}  # {subscriber_id: SubscriberQueue}
+        self.pattern_queues = {}  # {(pattern, subscriber_id): SubscriberQueue} of matching wildcard subscriptions
+        self.staged = deque()
+        self.dispatch_lock = threading.Lock()
+        self.parked = []  # [(ParkedFetch, on_ready)] fetches waiting for new messages
+        self.parked_lock = threading.Lock()
+
+    def add(self, queue):
+        previous = self.queues.get(queue.subscriber_id)
+        self.queues[queue.subscriber_id] = queue
+        if previous is not None:
+            previous.close()
+
+    def remove(self, queue):
+        if queue.pattern is not None:
+            if self.pattern_queues.get((queue.pattern, queue.subscriber_id)) is queue:
+                del self.pattern_queues[(queue.pattern, queue.subscriber_id)]
+        elif self.queues.get(queue.subscriber_id) is queue:
+            del self.queues[queue.subscriber_id]
+
+    def add_pattern(self, queue):
+        self.pattern_queues[(queue.pattern, queue.subscriber_id)] = queue
+
+    def stage(self, first_offset, messages):
+        """Record newly appended messages. Must be called while holding the append lock."""
+        if self.queues or self.pattern_queues:
+            self.staged.append([(first_offset + i, message) for i, message in enumerate(messages)])
+
+    def stage_batch(self, batch):
+        """Like `stage` for a stored batch; it is only decoded when someone is subscribed."""
+        if self.queues or self.pattern_queues:
+            self.staged.append([(offset, message) for offset, _, message, _ in batch.records()])
+
+    def park(self, fetch, on_ready):
+        """Call `on_ready(fetch)` once an append makes `fetch` ready. Fetches already claimed are dropped."""
+        with self.parked_lock:
+            self.parked = [entry for entry in self.parked if not entry[0].claimed]
+            self.parked.append((fetch, on_ready))
+
+    def wake(self):
+        """Hand parked fetches that new messages satisfy to their `on_ready`."""
+        with self.parked_lock:
+            ready = [entry for entry in self.parked if not entry[0].claimed and entry[0].ready()]
+            self.parked = [entry for entry in self.parked if not entry[0].claimed and entry not in ready]
+        for fetch, on_ready in ready:
+            on_ready(fetch)
+
+    def dispatch(self):
+        """Deliver staged messages to subscriber queues and wake parked fetches.
+
+        Must be called after the append lock is released. Queues are offered
+        messages without waiting; the caller then waits, with the dispatch
+        lock released, for any "block" queue it overfilled to drain.
+        """
+        if self.parked:
+            self.wake()
+        full = set()
+        while self.staged:
+            if not self.dispatch_lock.acquire(blocking=False):
+                break  # The current holder re-checks `staged` before it leaves
+            try:
+                while self.staged:
+                    entries = self.staged.popleft()
+                    for queue in list(self.queues.values()):
+                        queue.offer(entries)
+                        if queue.over_capacity():
+                            full.add(queue)
+                    for queue in list(self.pattern_queues.values()):
+                        queue.offer(entries, self.topic_name)
+                        if queue.over_capacity():
+                            full.add(queue)
+            finally:
+                self.dispatch_lock.release()
+        started = time.monotonic()
+        for queue in full:
+            queue.wait_for_room(started + queue.block_timeout)
+
+    def metrics(self):
+        metrics = {subscriber_id: queue.metrics() for subscriber_id, queue in list(self.queues.items())}
+        for (pattern, subscriber_id), queue in list(self.pattern_queues.items()):
+            metrics[f"{subscriber_id} ({pattern})"] = queue.metrics()
+        return metrics
+
+
+class ParkedFetch:
+    """A fetch waiting for messages to be appended, see `PeerNode.fetch_messages`.
+
+    `ready()` tells whether enough messages are available and `read()` builds
+    the response. No thread waits on a parked fetch: whoever claims it first,
+    an append that made it ready or the scheduler at `deadline`, completes it
+    and runs its callbacks.
+    """
+
+    __slots__ = ("ready", "read", "deadline", "claimed", "response", "callbacks", "lock", "event")
+
+    def __init__(self, ready, read, deadline):
+        self.ready = ready
+        self.read = read
+        self.deadline = deadline  # time.monotonic() at which the fetch is answered with what there is
+        self.claimed = False
+        self.response = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def claim(self):
+        """Return True for the first caller only, who must then call `complete`."""
+        with self.lock:
+            if self.claimed:
+                return False
+            self.claimed = True
+            return True
+
+    def complete(self):
+        response = self.read()
+        with self.lock:
+            self.response = response
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(response)
+
+    def add_done_callback(self, callback):
+        """Call `callback(response)` once the fetch completes."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self.response)
+
+    def wait(self):
+        """Block until the fetch completes and return its response, for callers without a connection."""
+        self.event.wait()
+        return self.response
+
+
+class FetchScheduler:
+    """Completes parked fetches without a thread per fetch.
+
+    One timer thread answers fetches whose deadline passed, and a small pool
+    reads and sends the responses, so neither a publisher nor the timer
+    waits on a slow consumer's socket.
+    """
+
+    def __init__(self, workers=4):
+        self.deadlines = []  # Heap of (deadline, sequence, ParkedFetch)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+        self.timer = None
+
+    def park(self, fetch, fanout):
+        """Wait for `fetch` to become ready on `fanout` or for its deadline."""
+        with self.condition:
+            if self.timer is None:
+                self.timer = threading.Thread(target=self._expire, daemon=True)
+                self.timer.start()
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (fetch.deadline, self.sequence, fetch))
+            if self.deadlines[0][2] is fetch:
+                self.condition.notify()
+        fanout.park(fetch, self.complete)
+        if fetch.ready():  # Messages appended before the fetch was parked do not wake it
+            self.complete(fetch)
+
+    def complete(self, fetch):
+        if fetch.claim():
+            self.pool.submit(fetch.complete)
+
+    def _expire(self):
+        while True:
+            with self.condition:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    self.condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                _, _, fetch = heapq.heappop(self.deadlines)
+            self.complete(fetch)
+
+
+class ThreadedSession:
+    """A client connection served by a dedicated thread."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.codec = BINARY  # Replaced by the codec negotiated in the handshake
+        self.negotiated = False
+        self.send_lock = threading.Lock()
+        self.queues = []
+        self.on_close = None  # Called with each attached queue when the connection ends
+        self.bytes_out = None  # Counter of bytes written, if set
+        self.closed = False
+
+    def send(self, request_id, response):
+        frame = encode_response(request_id, response, self.codec)
+        with self.send_lock:
+            self.sock.sendall(frame)
+        if self.bytes_out is not None:
+            self.bytes_out.inc(len(frame))
+
+    def attach(self, queue):
+        """Start pushing a subscriber queue's messages over this connection."""
+        self.queues.append(queue)
+        queue.on_overflow = lambda _: self.close()
+        threading.Thread(target=self._drain, args=(queue,), daemon=True).start()
+
+    def _drain(self, queue):
+        while not queue.closed:
+            batch = queue.take(timeout=1.0)
+            if not batch:
+                continue
+            try:
+                frame = notification_frame(queue, batch, self.codec)
+                with self.send_lock:
+                    self.sock.sendall(frame)
+            except (OSError, CodecError):
+                queue.close()
+                return
+            if self.bytes_out is not None:
+                self.bytes_out.inc(len(frame))
+            queue.mark_delivered(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        except OSError:
+            pass
+        for queue in self.queues:
+            queue.close()
+            if self.on_close is not None:
+                self.on_close(queue)
+
+
+class AsyncSession:
+    """A client connection served by the asyncio event loop."""
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.codec = BINARY
+        self.negotiated = False
+        self.queues = []
+        self.on_close = None
+        self.bytes_out = None
+        self.closed = False
+
+    def send(self, request_id, response):
+        """Write a response from any thread; the write itself happens on the event loop."""
+        frame = encode_response(request_id, response, self.codec)
+        self.loop.call_soon_threadsafe(self.writer.write, frame)
+        if self.bytes_out is not None:
+            self.bytes_out.inc(len(frame))
+
+    def attach(self, queue):
+        """Start pushing a subscriber queue's messages from a task on the event loop."""
+        self.queues.append(queue)
+        queue.on_overflow = lambda _: self.close()
+        ready = asyncio.Event()
+        queue.on_ready = lambda: self.loop.call_soon_threadsafe(ready.set)
+        asyncio.run_coroutine_threadsafe(self._drain(queue, ready), self.loop)
+
+    async def _drain(self, queue, ready):
+        while not queue.closed:
+            ready.clear()
+            batch = queue.take()
+            if not batch:
+                await ready.wait()
+                continue
+            try:
+                frame = notification_frame(queue, batch, self.codec)
+                self.writer.write(frame)
+                await self.writer.drain()
+            except (OSError, CodecError):
+                queue.close()
+                return
+            if self.bytes_out is not None:
+                self.bytes_out.inc(len(frame))
+            queue.mark_delivered(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.writer.close)
+        for queue in self.queues:
+            queue.close()
+            if self.on_close is not None:
+                self.on_close(queue)
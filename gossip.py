@@ -0,0 +1,130 @@
+import json
+import random
+import socket
+import threading
+import time
+
+MAX_DATAGRAM = 65507
+
+
+class Gossiper:
+    """Spreads heartbeats over UDP with a push gossip protocol.
+
+    Every `interval` seconds a node bumps its own heartbeat counter and sends
+    its view of the cluster (its own entry plus up to `max_entries - 1`
+    others) to `fanout` random peers. Receivers keep the newest
+    (incarnation, counter) per node and report every advance to
+    `on_heartbeat`, so heartbeats reach everyone in O(log N) rounds while each
+    node sends a fixed number of bounded datagrams per round, whatever the
+    cluster size. Datagrams are JSON, never unpickled.
+    """
+
+    def __init__(self, node_id, host, port, peer_list, on_heartbeat, interval=1.0, fanout=3, max_entries=64):
+        self.node_id = node_id
+        self.host = host
+        self.port = port  # UDP, same number as the node's TCP port
+        self.on_heartbeat = on_heartbeat
+        self.interval = interval
+        self.fanout = fanout
+        self.max_entries = max_entries
+        self.incarnation = int(time.time() * 1000)  # Lets peers tell a restarted node from a stale entry
+        self.counter = 0
+        self.members = {}  # {node_id: [ip, port, incarnation, counter]}
+        self.advertised = {}  # {node_id: (ip, port)} each node sends for itself, for clients to connect to
+        for peer_id, ip, peer_port in peer_list:
+            if peer_id != node_id:
+                self.members[peer_id] = [ip, peer_port, 0, -1]
+        self.sock = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+        self.running = True
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._send_loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+
+    def set_peers(self, peer_list):
+        """Make sure every peer in `peer_list` is gossiped to."""
+        with self.lock:
+            for peer_id, ip, port in peer_list:
+                if peer_id != self.node_id and peer_id not in self.members:
+                    self.members[peer_id] = [ip, port, 0, -1]
+
+    def addresses(self):
+        with self.lock:
+            return dict(self.advertised)
+
+    def stats(self):
+        with self.lock:
+            return {"members": len(self.members), "datagrams_sent": self.datagrams_sent,
+                    "bytes_sent": self.bytes_sent}
+
+    def _send_loop(self):
+        while self.running:
+            try:
+                self.gossip_round()
+            except OSError:
+                if not self.running:
+                    return
+            time.sleep(self.interval * random.uniform(0.9, 1.1))
+
+    def gossip_round(self):
+        with self.lock:
+            self.counter += 1
+            others = list(self.members.items())
+            entries = [[self.node_id, self.host, self.port, self.incarnation, self.counter]]
+            sample = random.sample(others, min(len(others), self.max_entries - 1))
+            entries.extend([member_id, *member] for member_id, member in sample)
+            targets = random.sample(others, min(len(others), self.fanout))
+        data = json.dumps({"from": self.node_id, "members": entries}, separators=(",", ":")).encode()
+        for _, (ip, port, _, _) in targets:
+            self.sock.sendto(data[:MAX_DATAGRAM], (ip, port))
+        with self.lock:
+            self.datagrams_sent += len(targets)
+            self.bytes_sent += len(data) * len(targets)
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+                self.merge(message["members"], message.get("from"))
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def merge(self, entries, sender=None):
+        """Keep the newest heartbeat per node and report the ones that advanced.
+
+        Addresses are only learned for nodes not known yet: a configured peer
+        keeps its address, which may be a proxy or forwarded port rather than
+        the one the node advertises. What `sender` says about itself is kept
+        in `advertised` for clients.
+        """
+        advanced = []
+        with self.lock:
+            for node_id, ip, port, incarnation, counter in entries:
+                if node_id == self.node_id:
+                    continue
+                if node_id == sender:
+                    self.advertised[node_id] = (ip, port)  # Others relay configured addresses, not advertised ones
+                known = self.members.get(node_id)
+                if known is None:
+                    self.members[node_id] = [ip, port, incarnation, counter]
+                    advanced.append(node_id)
+                elif (incarnation, counter) > (known[2], known[3]):
+                    known[2], known[3] = incarnation, counter
+                    advanced.append(node_id)
+        for node_id in advanced:
+            self.on_heartbeat(node_id)
@@ -0,0 +1,234 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+DEFAULT_SESSION_TIMEOUT = 10.0  # Seconds a member may go without a request before its leases are revoked
+MAX_SESSION_TIMEOUT = 300.0
+
+logger = logging.getLogger(__name__)
+
+
+class ConsumerGroup:
+    """The members of one group consuming one topic, what they hold and how far they got.
+
+    Members share the topic message by message rather than owning it: each
+    fetch leases the next range of offsets no one holds to the member that
+    asked, so adding members adds consumers working in parallel. Acking a
+    lease (committing it) makes its range done; the committed offset is the
+    end of the contiguous done prefix, where a restarted group resumes.
+
+    A member that leaves or stays silent past its session timeout has its
+    leases revoked; their ranges are leased again before new offsets. Every
+    join, leave or timeout starts a new generation. A revoked lease can no
+    longer be committed by its old holder, so every range is committed once.
+    Ranges are delivered at least once: a member that processed a lease but
+    timed out before committing it will see it redelivered elsewhere.
+    """
+
+    def __init__(self, group_id, topic_name, committed=0):
+        self.group_id = group_id
+        self.topic_name = topic_name
+        self.generation = 0
+        self.members = {}  # {member_id: [session_timeout, last_seen]}
+        self.committed = committed  # Every offset below this one is done
+        self.cursor = committed  # Offsets from here on were never leased
+        self.leases = {}  # {start: (end, member_id)}
+        self.acked = {}  # {start: end} of done ranges past `committed`
+        self.returned = []  # Heap of revoked (start, end) ranges, leased again first
+        self.lock = threading.Lock()
+
+    def join(self, member_id, session_timeout):
+        self.members[member_id] = [session_timeout, time.monotonic()]
+        self.generation += 1
+
+    def leave(self, member_id):
+        if self.members.pop(member_id, None) is not None:
+            self._revoke(member_id)
+            self.generation += 1
+
+    def touch(self, member_id):
+        """Record that a member is alive. False if it is not (or no longer) a member."""
+        member = self.members.get(member_id)
+        if member is None:
+            return False
+        member[1] = time.monotonic()
+        return True
+
+    def expire(self):
+        """Remove members past their session timeout. Returns their ids."""
+        now = time.monotonic()
+        expired = [member_id for member_id, (timeout, last_seen) in self.members.items() if now - last_seen > timeout]
+        for member_id in expired:
+            self.leave(member_id)
+        return expired
+
+    def _revoke(self, member_id):
+        for start, (end, holder) in list(self.leases.items()):
+            if holder == member_id:
+                del self.leases[start]
+                heapq.heappush(self.returned, (start, end))
+
+    def has_work(self, log):
+        return bool(self.returned) or max(self.cursor, log.start_offset) < log.next_offset
+
+    def lease(self, member_id, log, max_messages, max_bytes):
+        """Lease the next range to `member_id` and read it. Returns (start, end, messages), or None if there is none.
+
+        Ranges that retention or compaction emptied are counted as done, so
+        the committed offset moves past them.
+        """
+        while self.returned:
+            start, end = heapq.heappop(self.returned)
+            if end <= log.start_offset:
+                self._ack(start, end)
+                continue
+            if start < log.start_offset:
+                self._ack(start, log.start_offset)
+                start = log.start_offset
+            page, next_offset = log.read(start, min(max_messages, end - start), max_bytes, end_offset=end)
+            next_offset = next_offset if page else end
+            if next_offset < end:
+                heapq.heappush(self.returned, (next_offset, end))  # The rest goes to the next fetch
+            return self._grant(member_id, start, next_offset, page)
+        if self.cursor < log.start_offset:
+            self._ack(self.cursor, log.start_offset)
+            self.cursor = log.start_offset
+        if self.cursor >= log.next_offset:
+            return None
+        start, end = self.cursor, log.next_offset
+        page, next_offset = log.read(start, max_messages, max_bytes, end_offset=end)
+        self.cursor = next_offset if page else end
+        return self._grant(member_id, start, self.cursor, page)
+
+    def _grant(self, member_id, start, end, page):
+        if page:
+            self.leases[start] = (end, member_id)
+        else:
+            self._ack(start, end)  # Only compacted-away offsets: nothing to process
+        return start, end, page
+
+    def commit(self, member_id, ranges):
+        """Mark leased [start, end) ranges done. Returns how many were refused because `member_id` lost them."""
+        refused = 0
+        for start, end in ranges:
+            if self.leases.get(start) != (end, member_id):
+                refused += 1
+                continue
+            del self.leases[start]
+            self._ack(start, end)
+        return refused
+
+    def _ack(self, start, end):
+        if end <= self.committed:
+            return
+        self.acked[start] = end
+        while self.committed in self.acked:
+            self.committed = self.acked.pop(self.committed)
+
+    def stats(self, log=None):
+        return {
+            "group_id": self.group_id,
+            "topic": self.topic_name,
+            "generation": self.generation,
+            "members": sorted(self.members),
+            "committed": self.committed,
+            "leased_ranges": len(self.leases),
+            "leased_messages": sum(end - start for start, (end, _) in self.leases.items()),
+            "returned_ranges": len(self.returned),
+            "lag": None if log is None else max(0, log.next_offset - self.committed),
+        }
+
+
+class GroupCoordinator:
+    """Consumer groups served by one node and their committed offsets.
+
+    Groups are kept per (group_id, topic_name). Commits only update memory;
+    with a `path`, the committed offsets are written there by a background
+    thread at most every `flush_interval` seconds and read back on startup,
+    so groups resume where they stopped after the node restarts. A crash
+    can lose the last interval's commits, whose ranges are then delivered again.
+    """
+
+    def __init__(self, path=None, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.groups = {}  # {(group_id, topic_name): ConsumerGroup}
+        self.offsets = {}  # {(group_id, topic_name): committed offset} loaded from `path`
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.flushed = {}  # Offsets as last written
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read committed offsets from %s: %s", self.path, e)
+            return
+        self.offsets = {(group_id, topic_name): offset for group_id, topic_name, offset in entries}
+        self.flushed = dict(self.offsets)
+
+    def start(self):
+        if self.path is not None and self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("Could not write committed offsets to %s: %s", self.path, e)
+
+    def committed_offsets(self):
+        with self.lock:
+            groups = list(self.groups.values())
+            offsets = dict(self.offsets)
+        offsets.update({(group.group_id, group.topic_name): group.committed for group in groups})
+        return offsets
+
+    def flush(self):
+        """Write the committed offsets if they changed since the last write."""
+        offsets = self.committed_offsets()
+        if offsets == self.flushed:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump([[group_id, topic_name, offset] for (group_id, topic_name), offset in sorted(offsets.items())], f)
+        os.replace(temporary, self.path)
+        self.flushed = offsets
+
+    def get(self, group_id, topic_name, create=False):
+        key = (group_id, topic_name)
+        group = self.groups.get(key)
+        if group is None and create:
+            with self.lock:
+                group = self.groups.get(key)
+                if group is None:
+                    group = self.groups[key] = ConsumerGroup(group_id, topic_name, self.offsets.pop(key, 0))
+        return group
+
+    def join(self, group_id, topic_name, member_id=None, session_timeout=DEFAULT_SESSION_TIMEOUT):
+        group = self.get(group_id, topic_name, create=True)
+        member_id = member_id or uuid.uuid4().hex
+        with group.lock:
+            group.expire()
+            group.join(member_id, max(0.1, min(session_timeout, MAX_SESSION_TIMEOUT)))
+            logger.info("Member %s joined group '%s' on '%s' (generation %d, %d members).", member_id, group_id,
+                        topic_name, group.generation, len(group.members))
+        return group, member_id
+
+    def groups_of(self, topic_name=None):
+        with self.lock:
+            return [group for (_, name), group in sorted(self.groups.items())
+                    if topic_name is None or name == topic_name]
@@ -0,0 +1,93 @@
+import bisect
+import hashlib
+
+DEFAULT_VNODES = 128
+
+
+def hash_key(key):
+    """Stable 64-bit position on the ring; the same on every node and client."""
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes.
+
+    Each node is placed on the ring `vnodes * weight` times. A topic belongs to
+    the first distinct nodes found walking clockwise from the topic's hash, so
+    adding or removing a node only moves the topics next to its points.
+    """
+
+    def __init__(self, nodes=None, vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.weights = {}  # {node_id: weight}
+        self.points = []  # Sorted ring positions
+        self.owners = []  # Node id at each position in `points`
+        for node_id in nodes or []:
+            self.add_node(node_id)
+
+    def __contains__(self, node_id):
+        return node_id in self.weights
+
+    def __len__(self):
+        return len(self.weights)
+
+    def add_node(self, node_id, weight=1):
+        self.weights[node_id] = weight
+        self._rebuild()
+
+    def remove_node(self, node_id):
+        if self.weights.pop(node_id, None) is not None:
+            self._rebuild()
+
+    def copy(self):
+        ring = HashRing(vnodes=self.vnodes)
+        ring.weights = dict(self.weights)
+        ring.points = list(self.points)
+        ring.owners = list(self.owners)
+        return ring
+
+    def _rebuild(self):
+        ring = sorted((hash_key(f"{node_id}#{i}"), node_id)
+                      for node_id, weight in self.weights.items()
+                      for i in range(max(1, int(self.vnodes * weight))))
+        self.points = [point for point, _ in ring]
+        self.owners = [node_id for _, node_id in ring]
+
+    def nodes_for(self, key, count):
+        """The first `count` distinct nodes clockwise from `key`; the primary comes first."""
+        count = min(count, len(self.weights))
+        nodes = []
+        if not count:
+            return nodes
+        start = bisect.bisect(self.points, hash_key(key))
+        for i in range(len(self.points)):
+            node_id = self.owners[(start + i) % len(self.points)]
+            if node_id not in nodes:
+                nodes.append(node_id)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+    def primary(self, key):
+        nodes = self.nodes_for(key, 1)
+        return nodes[0] if nodes else None
+
+
+def plan_rebalance(old_ring, new_ring, topics, count):
+    """Placement changes for `topics` when the ring changes from `old_ring` to `new_ring`.
+
+    Returns {topic: {"old": [...], "new": [...], "add": [...], "remove": [...]}} for
+    the topics whose node set or primary changed; every other topic stays put.
+    """
+    plan = {}
+    for topic in topics:
+        old = old_ring.nodes_for(topic, count)
+        new = new_ring.nodes_for(topic, count)
+        if old != new and (set(old) != set(new) or old[:1] != new[:1]):
+            plan[topic] = {
+                "old": old,
+                "new": new,
+                "add": [node_id for node_id in new if node_id not in old],
+                "remove": [node_id for node_id in old if node_id not in new],
+            }
+    return plan
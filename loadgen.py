@@ -0,0 +1,472 @@
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from client import Client
+
+SUB_BUCKETS = 1024  # Values per power of two above LINEAR_LIMIT: about 0.1% precision
+LINEAR_LIMIT = 2 * SUB_BUCKETS  # Values below this are recorded exactly
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+WORKER_KINDS = ("producer", "consumer", "subscriber", "churn")
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds.
+
+    Values are exact below 2048us and within 0.1% above, memory grows only
+    with the number of distinct buckets hit, and histograms from different
+    threads and processes merge by adding counts.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})  # {bucket index: count}
+
+    @staticmethod
+    def _index(value):
+        if value < LINEAR_LIMIT:
+            return value
+        shift = value.bit_length() - 11  # value >> shift falls in [SUB_BUCKETS, 2 * SUB_BUCKETS)
+        return LINEAR_LIMIT + (shift - 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def _value(index):
+        """Highest value recorded in bucket `index`."""
+        if index < LINEAR_LIMIT:
+            return index
+        shift, sub_bucket = divmod(index - LINEAR_LIMIT, SUB_BUCKETS)
+        return ((sub_bucket + SUB_BUCKETS + 1) << (shift + 1)) - 1
+
+    def record(self, seconds, count=1):
+        index = self._index(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, p):
+        """Latency in milliseconds at or below which `p` percent of the values fall."""
+        total = self.total
+        if not total:
+            return 0.0
+        rank = max(1, round(p / 100 * total))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self._value(index) / 1000
+        return self._value(max(self.counts)) / 1000
+
+    def corrected(self, expected_interval):
+        """A copy with coordinated omission corrected, like HdrHistogram's copyCorrectedForCoordinatedOmission.
+
+        A closed-loop client that waited `value` for one response did not
+        send the requests it would have sent every `expected_interval`
+        seconds meanwhile. Each of those is added with the latency it would
+        have seen: value - interval, value - 2 * interval, ...
+        """
+        corrected = LatencyHistogram(self.counts)
+        interval = int(expected_interval * 1e6)
+        if interval <= 0:
+            return corrected
+        for index, count in self.counts.items():
+            missing = self._value(index) - interval
+            while missing >= interval:
+                corrected.record(missing / 1e6, count)
+                missing -= interval
+        return corrected
+
+    def summary(self):
+        total = self.total
+        summary = {f"p{p:g}": self.percentile(p) for p in PERCENTILES}
+        summary["max"] = self._value(max(self.counts)) / 1000 if total else 0.0
+        summary["mean"] = sum(self._value(i) * c for i, c in self.counts.items()) / total / 1000 if total else 0.0
+        return summary
+
+
+class OperationStats:
+    """What one worker observed for one operation."""
+
+    def __init__(self):
+        self.service = LatencyHistogram()  # Request sent -> response received
+        self.response = LatencyHistogram()  # Intended send time -> response received, for open-loop work
+        self.count = 0
+        self.errors = 0
+        self.messages = 0
+
+    def merge(self, other):
+        self.service.merge(other.service)
+        self.response.merge(other.response)
+        self.count += other.count
+        self.errors += other.errors
+        self.messages += other.messages
+
+
+def make_message(size):
+    """A message stamped with its send time, so consumers can measure end-to-end latency."""
+    stamp = f"{time.time():.6f} "
+    return stamp + "x" * max(0, size - len(stamp))
+
+
+def message_age(message, now):
+    try:
+        return now - float(message.split(" ", 1)[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+class Worker:
+    """One load-generating thread with its own connection."""
+
+    def __init__(self, kind, worker_id, config, start_at):
+        self.kind = kind
+        self.worker_id = worker_id
+        self.config = config
+        self.start_at = start_at
+        self.measure_from = start_at + config["warmup"]
+        self.end_at = start_at + config["warmup"] + config["duration"]
+        self.topic = f"{config['topic_prefix']}{worker_id % config['topics']}"
+        ports = config["ports"]
+        self.client = Client(config["host"], ports[(worker_id % config["topics"]) % len(ports)],
+                             timeout=config["timeout"], routing=config["routing"])
+        self.stats = {}  # {operation: OperationStats}
+
+    def op(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = OperationStats()
+        return stats
+
+    def timed(self, name, request, intended=None, ok=("ok",), messages=0):
+        """Send one request and record it if it was sent inside the measured window."""
+        sent = time.time()
+        try:
+            response = self.client.send_request(request)
+        except (OSError, ValueError):
+            response = {"status": "connection_error"}
+            self.client.close()
+        done = time.time()
+        if self.measure_from <= sent < self.end_at:
+            stats = self.op(name)
+            stats.count += 1
+            if response.get("status") not in ok:
+                stats.errors += 1
+            else:
+                stats.messages += messages
+            stats.service.record(done - sent)
+            if intended is not None:
+                stats.response.record(done - intended)
+        return response
+
+    def run(self):
+        time.sleep(max(0.0, self.start_at - time.time()))
+        try:
+            getattr(self, f"run_{self.kind}")()
+        finally:
+            self.client.close()
+
+    def run_producer(self):
+        config = self.config
+        batch_size = config["batch_size"]
+        ok = ("message_published", "batch_published")
+        interval = config["producers"] * batch_size / config["rate"] if config["mode"] == "open" else None
+        sent = 0
+        while True:
+            if interval is not None:
+                intended = self.start_at + sent * interval  # Fixed schedule: falling behind shows up as latency
+                if intended >= self.end_at:
+                    return
+                time.sleep(max(0.0, intended - time.time()))
+            elif time.time() >= self.end_at:
+                return
+            else:
+                intended = None
+            if batch_size == 1:
+                request = {"action": "publish", "topic_name": self.topic,
+                           "message": make_message(config["message_size"])}
+            else:
+                request = {"action": "publish_batch", "topic_name": self.topic,
+                           "messages": [make_message(config["message_size"]) for _ in range(batch_size)]}
+            self.timed("publish", request, intended, ok, messages=batch_size)
+            sent += 1
+
+    def run_consumer(self):
+        if self.config["partitions"]:
+            self.topic = f"{self.topic}:{self.worker_id // self.config['topics'] % self.config['partitions']}"
+        offset = None
+        while time.time() < self.end_at:
+            if offset is None:
+                response = self.timed("fetch", {"action": "fetch_messages", "topic_name": self.topic,
+                                                "from_offset": 0, "max_messages": 0})
+                offset = response.get("high_watermark")  # Start at the tail, like a live consumer
+                continue
+            request = {"action": "fetch_messages", "topic_name": self.topic, "from_offset": offset,
+                       "max_messages": self.config["fetch_messages"]}
+            if self.config["max_wait_ms"]:
+                request["max_wait_ms"] = self.config["max_wait_ms"]  # Long poll: the node answers when messages arrive
+            response = self.timed("fetch", request)
+            messages = response.get("messages") or []
+            now = time.time()
+            if now >= self.measure_from:
+                stats = self.op("fetch.end_to_end")
+                for _, message in messages:
+                    age = message_age(message, now)
+                    if age is not None:
+                        stats.service.record(age)
+                        stats.count += 1
+                self.op("fetch").messages += len(messages)
+            offset = response.get("next_offset", offset)
+            if not messages and not self.config["max_wait_ms"]:
+                time.sleep(self.config["poll_interval"])
+
+    def run_subscriber(self):
+        lock = threading.Lock()
+
+        def on_messages(topic_name, messages):
+            now = time.time()
+            if now < self.measure_from or now > self.end_at:
+                return
+            with lock:
+                stats = self.op("push.end_to_end")
+                for _, message in messages:
+                    age = message_age(message, now)
+                    if age is not None:
+                        stats.service.record(age)
+                        stats.count += 1
+                stats.messages += len(messages)
+
+        subscriber_id = f"loadgen-{self.config['run_id']}-{self.worker_id}"
+        response = self.client.subscribe(self.topic, subscriber_id, on_messages, max_queue=self.config["max_queue"])
+        if response.get("status") != "subscribed":
+            self.op("push.end_to_end").errors += 1
+            return
+        time.sleep(max(0.0, self.end_at - time.time()))
+        self.client.unsubscribe(self.topic, subscriber_id)
+
+    def run_churn(self):
+        """Create short-lived topics, publish to and list them: exercises topic creation and the catalog."""
+        prefix = f"{self.config['topic_prefix']}churn.{self.config['run_id']}.{self.worker_id}."
+        created = 0
+        while time.time() < self.end_at:
+            topic_name = f"{prefix}{created}"
+            self.timed("create_topic", {"action": "create_topic", "topic_name": topic_name}, ok=("topic_created",))
+            self.timed("churn.publish", {"action": "publish", "topic_name": topic_name,
+                                         "message": make_message(self.config["message_size"])},
+                       ok=("message_published",), messages=1)
+            self.timed("list_topics", {"action": "list_topics", "prefix": prefix, "limit": 100})
+            created += 1
+            time.sleep(self.config["churn_interval"])
+
+
+def run_process(assignments, config, start_at, results):
+    """Run this process's share of the workers as threads and report their merged stats."""
+    workers = [Worker(kind, worker_id, config, start_at) for kind, worker_id in assignments]
+    threads = [threading.Thread(target=worker.run, daemon=True) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(config["warmup"] + config["duration"] + 4 * config["timeout"] + (start_at - time.time()))
+    merged = {}
+    for worker in workers:
+        for name, stats in worker.stats.items():
+            merged.setdefault(name, OperationStats()).merge(stats)
+    results.put({name: (stats.service.counts, stats.response.counts, stats.count, stats.errors, stats.messages)
+                 for name, stats in merged.items()})
+
+
+def plan_workers(config):
+    """[(kind, worker_id)] for every worker, dealt round-robin to `processes` processes."""
+    counts = (config["producers"], config["consumers"], config["subscribers"], config["churn"])
+    workers = [(kind, worker_id) for kind, count in zip(WORKER_KINDS, counts) for worker_id in range(count)]
+    return [workers[index::config["processes"]] for index in range(config["processes"])]
+
+
+def prepare_topics(config):
+    for index in range(config["topics"]):
+        port = config["ports"][index % len(config["ports"])]
+        client = Client(config["host"], port, timeout=config["timeout"])
+        request = {"action": "create_topic", "topic_name": f"{config['topic_prefix']}{index}"}
+        if config["partitions"]:
+            request["partitions"] = config["partitions"]
+        client.send_request(request)
+        client.close()
+
+
+def server_stats(config):
+    """Each node's request latency metrics at the end of the run, if it answers `stats`."""
+    stats = {}
+    for port in config["ports"]:
+        client = Client(config["host"], port, timeout=config["timeout"])
+        try:
+            response = client.send_request({"action": "stats"})
+        except (OSError, ValueError):
+            continue
+        finally:
+            client.close()
+        if response.get("status") == "ok":
+            stats[str(port)] = {name: response["metrics"].get(name)
+                                for name in ("request_seconds", "lock_wait_seconds", "bytes_in", "bytes_out")}
+    return stats
+
+
+def run_load(config):
+    """Run one load test and return its results as a JSON-serializable dict."""
+    prepare_topics(config)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_at = time.time() + 1.0 + 0.2 * config["processes"]  # Every process starts sending at the same moment
+    processes = [context.Process(target=run_process, args=(assignments, config, start_at, results), daemon=True)
+                 for assignments in plan_workers(config) if assignments]
+    for process in processes:
+        process.start()
+    merged = {}
+    for _ in processes:
+        for name, (service, response, count, errors, messages) in results.get().items():
+            stats = OperationStats()
+            stats.service, stats.response = LatencyHistogram(service), LatencyHistogram(response)
+            stats.count, stats.errors, stats.messages = count, errors, messages
+            merged.setdefault(name, OperationStats()).merge(stats)
+    for process in processes:
+        process.join()
+
+    operations = {}
+    for name, stats in sorted(merged.items()):
+        result = {
+            "count": stats.count,
+            "errors": stats.errors,
+            "throughput": stats.count / config["duration"],
+            "latency_ms": stats.service.summary(),
+            "histogram": sorted(stats.service.counts.items()),
+        }
+        if stats.messages:
+            result["messages_per_sec"] = stats.messages / config["duration"]
+        if stats.response.total:
+            result["response_time_ms"] = stats.response.summary()  # Includes time spent behind schedule
+        elif (name == "publish" or (name == "fetch" and not config["max_wait_ms"])) and stats.count:
+            # Closed loop: correct with the typical service time as the expected interval between requests
+            interval = stats.service.percentile(50) / 1000
+            result["corrected_latency_ms"] = stats.service.corrected(interval).summary()
+        operations[name] = result
+    return {"config": config, "started_at": start_at, "operations": operations, "server_stats": server_stats(config)}
+
+
+def print_report(report, previous=None):
+    print(f"\n{'operation':<18} {'count':>9} {'errors':>7} {'ops/s':>10} {'msg/s':>10} "
+          + " ".join(f"{f'p{p:g}':>8}" for p in PERCENTILES) + f" {'max':>8}  (ms)")
+    for name, result in report["operations"].items():
+        rows = [("", result["latency_ms"])]
+        if "response_time_ms" in result:
+            rows.append(("  response", result["response_time_ms"]))
+        if "corrected_latency_ms" in result:
+            rows.append(("  corrected", result["corrected_latency_ms"]))
+        for suffix, latency in rows:
+            head = (f"{name:<18} {result['count']:>9} {result['errors']:>7} {result['throughput']:>10.1f} "
+                    f"{result.get('messages_per_sec', 0):>10.1f}") if not suffix else f"{suffix:<57}"
+            print(head + " " + " ".join(f"{latency[f'p{p:g}']:>8.3f}" for p in PERCENTILES)
+                  + f" {latency['max']:>8.3f}")
+    if previous:
+        print("\nChange against the previous run:")
+        for name, result in report["operations"].items():
+            before = previous["operations"].get(name)
+            if before is None:
+                continue
+            changes = [f"throughput {_change(before['throughput'], result['throughput'])}"]
+            changes += [f"p{p:g} {_change(before['latency_ms'][f'p{p:g}'], result['latency_ms'][f'p{p:g}'])}"
+                        for p in (50, 99, 99.9)]
+            print(f"  {name:<18} " + ", ".join(changes))
+
+
+def _change(before, after):
+    return f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+
+
+def plot_report(report, path):
+    """Save each operation's latency percentile spectrum to `path` without needing a display."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figure, axis = plt.subplots(figsize=(10, 6))
+    for name, result in report["operations"].items():
+        histogram = LatencyHistogram(dict(result["histogram"]))
+        total = histogram.total
+        if not total:
+            continue
+        points, seen = [], 0
+        for index in sorted(histogram.counts):
+            seen += histogram.counts[index]
+            if seen < total:
+                points.append((1 / (1 - seen / total), LatencyHistogram._value(index) / 1000))
+        if points:
+            axis.plot(*zip(*points), label=name)
+    axis.set_xscale("log")
+    axis.set_xticks([2, 10, 100, 1000, 10000])
+    axis.set_xticklabels(["50%", "90%", "99%", "99.9%", "99.99%"])
+    axis.set_xlabel("Percentile")
+    axis.set_ylabel("Latency (ms)")
+    axis.set_title(f"{report['config']['mode']}-loop load, {report['config']['duration']}s")
+    axis.legend()
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-process load generator for pub/sub nodes")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--ports", type=int, nargs="+", default=[5001], help="Topics are spread across these nodes")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--consumers", type=int, default=2)
+    parser.add_argument("--subscribers", type=int, default=2)
+    parser.add_argument("--churn", type=int, default=0, help="Workers creating and listing short-lived topics")
+    parser.add_argument("--mode", choices=("open", "closed"), default="closed",
+                        help="open: send on a fixed schedule at --rate; closed: send as soon as the last reply arrives")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Messages/sec across all producers (open loop)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of load before measuring")
+    parser.add_argument("--topics", type=int, default=4)
+    parser.add_argument("--topic-prefix", default="loadgen.")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="Create partitioned topics; producers spread over the partitions, consumers read one each")
+    parser.add_argument("--routing", action="store_true", help="Clients send each request to the node serving it")
+    parser.add_argument("--message-size", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=1, help="Messages per publish request")
+    parser.add_argument("--fetch-messages", type=int, default=500)
+    parser.add_argument("--poll-interval", type=float, default=0.005, help="Consumer sleep after an empty fetch")
+    parser.add_argument("--max-wait-ms", type=int, default=0,
+                        help="Long-poll fetches: the node holds each one up to this long for new messages")
+    parser.add_argument("--churn-interval", type=float, default=0.05)
+    parser.add_argument("--max-queue", type=int, default=10000, help="Push subscriber queue size")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against")
+    parser.add_argument("--plot", help="Save a latency percentile plot to this image file")
+    args = parser.parse_args()
+
+    config = {name: value for name, value in vars(args).items() if name not in ("json", "compare", "plot")}
+    config["processes"] = max(1, min(args.processes, args.producers + args.consumers + args.subscribers + args.churn))
+    config["run_id"] = f"{int(time.time())}"
+    print(f"Running {config['mode']}-loop load for {args.warmup}s warmup + {args.duration}s on ports {args.ports} "
+          f"with {config['processes']} processes...")
+    report = run_load(config)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    if args.plot:
+        try:
+            plot_report(report, args.plot)
+            print(f"Latency plot saved to {args.plot}")
+        except ImportError:
+            print("matplotlib is not installed; skipping the plot.")
@@ -0,0 +1,303 @@
+import bisect
+import math
+import threading
+import time
+from itertools import accumulate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.99, 0.999)
+PROMETHEUS_PREFIX = "pubsub_"
+
+
+def _bucket_bounds(low=1e-6, high=100.0, per_doubling=8):
+    """Upper bounds growing by 2**(1/per_doubling), so a quantile is within ~9% of the true value."""
+    bounds = [0.0]
+    bound = low
+    while bound < high:
+        bounds.append(bound)
+        bound *= 2 ** (1 / per_doubling)
+    return bounds
+
+
+BUCKET_BOUNDS = _bucket_bounds()  # Seconds, 1us to 100s
+
+
+class Counter:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """Latency distribution in fixed log-spaced buckets: O(1) memory, a bisect per observation."""
+
+    __slots__ = ("counts", "sum", "max", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # The last bucket holds values past the largest bound
+        self.sum = 0.0
+        self.max = 0.0  # Exact, unlike the bucketed quantiles
+        self.lock = threading.Lock()
+
+    def observe(self, value, _bisect=bisect.bisect_left, _bounds=BUCKET_BOUNDS):
+        index = _bisect(_bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        """Count, sum, largest value and the upper bound of the bucket holding each of QUANTILES."""
+        with self.lock:
+            counts, total, largest = list(self.counts), self.sum, self.max
+        count = sum(counts)
+        snapshot = {"count": count, "sum": total, "max": largest}
+        cumulative = list(accumulate(counts))
+        for q in QUANTILES:
+            index = bisect.bisect_left(cumulative, max(1, math.ceil(q * count))) if count else 0
+            snapshot[_quantile_name(q)] = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else math.inf
+        return snapshot
+
+
+class Meter:
+    """A running total plus its average rate per second over the last `window` whole seconds.
+
+    Counts go into one bucket per second. Marks must be serialized by the
+    caller, e.g. by the topic lock every append already holds.
+    """
+
+    __slots__ = ("total", "buckets", "second", "window")
+
+    def __init__(self, window=60):
+        self.total = 0
+        self.buckets = [0] * (window + 1)  # The current second's bucket plus `window` complete ones
+        self.second = int(time.monotonic())
+        self.window = window
+
+    def mark(self, amount=1):
+        second = int(time.monotonic())
+        if second != self.second:
+            self._advance(second)
+        self.buckets[second % len(self.buckets)] += amount
+        self.total += amount
+
+    def _advance(self, second):
+        for skipped in range(self.second + 1, min(second, self.second + len(self.buckets)) + 1):
+            self.buckets[skipped % len(self.buckets)] = 0
+        self.second = second
+
+    def current_rate(self):
+        second = int(time.monotonic())
+        elapsed = second - self.second  # Seconds since the last mark, whose buckets are empty
+        if elapsed >= self.window:
+            return 0.0
+        buckets = list(self.buckets)
+        complete = sum(buckets[(self.second - i) % len(buckets)] for i in range(max(elapsed, 1) - elapsed,
+                                                                                   self.window - elapsed + 1))
+        return complete / self.window
+
+    def snapshot(self):
+        return {"total": self.total, "rate": self.current_rate()}
+
+
+class TimedLock:
+    """A Lock that records how long contended acquisitions waited.
+
+    Uncontended acquisitions cost one non-blocking attempt and record
+    nothing, so the histogram's count is the number of times a thread had to
+    wait.
+    """
+
+    __slots__ = ("lock", "histogram")
+
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def _quantile_name(q):
+    return "p" + f"{q * 100:g}".replace(".", "")  # 0.5 -> "p50", 0.999 -> "p999"
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+    """Named, labelled metrics of one node.
+
+    Hot paths keep a reference to the metric they update, so recording is a
+    lock-protected increment with no lookup. Values that already live
+    elsewhere, such as replication lag, come from collectors called only when
+    a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.metrics = {}  # {name: (kind, {label key: metric})}
+        self.collectors = []  # Callables returning [(name, labels, value)] gauges
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, kind, factory, name, labels):
+        key = _label_key(labels)
+        family = self.metrics.get(name)
+        if family is not None and key in family[1]:
+            return family[1][key]
+        with self.lock:
+            family = self.metrics.setdefault(name, (kind, {}))
+            if family[0] != kind:
+                raise ValueError(f"Metric '{name}' is a {family[0]}, not a {kind}")
+            metric = family[1].get(key)
+            if metric is None:
+                metric = family[1][key] = factory()
+            return metric
+
+    def counter(self, name, **labels):
+        return self._get("counter", Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get("gauge", Gauge, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get("histogram", Histogram, name, labels)
+
+    def meter(self, name, **labels):
+        return self._get("meter", Meter, name, labels)
+
+    def timed_lock(self, name, **labels):
+        return TimedLock(self.histogram(name, **labels))
+
+    def remove(self, name, **labels):
+        with self.lock:
+            family = self.metrics.get(name)
+            if family is not None:
+                family[1].pop(_label_key(labels), None)
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def _families(self):
+        with self.lock:
+            families = {name: (kind, dict(metrics)) for name, (kind, metrics) in self.metrics.items()}
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                gauge = Gauge()
+                gauge.set(value)
+                families.setdefault(name, ("gauge", {}))[1][_label_key(labels)] = gauge
+        return families
+
+    def snapshot(self):
+        """{name: {"label=value,...": value}}; histograms give count, sum, max and p50/p99/p999."""
+        return {name: {",".join(f"{label}={value}" for label, value in key): metric.snapshot()
+                       for key, metric in sorted(metrics.items())}
+                for name, (kind, metrics) in sorted(self._families().items())}
+
+    def prometheus_text(self):
+        """Every metric in the Prometheus text exposition format.
+
+        Histograms are exported as summaries, with their largest values as a "<name>_max" gauge family.
+        """
+        lines = []
+        for name, (kind, metrics) in sorted(self._families().items()):
+            full_name = PROMETHEUS_PREFIX + name
+            if kind in ("counter", "meter"):
+                full_name += "_total"
+                lines.append(f"# TYPE {full_name} counter")
+            else:
+                lines.append(f"# TYPE {full_name} {'summary' if kind == 'histogram' else 'gauge'}")
+            maxima = []
+            for key, metric in sorted(metrics.items()):
+                if kind == "histogram":
+                    snapshot = metric.snapshot()
+                    for q in QUANTILES:
+                        lines.append(f"{full_name}{_format_labels(key, [('quantile', q)])} "
+                                     f"{snapshot[_quantile_name(q)]}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {snapshot['sum']}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {snapshot['count']}")
+                    maxima.append(f"{full_name}_max{_format_labels(key)} {snapshot['max']}")
+                elif kind == "meter":
+                    lines.append(f"{full_name}{_format_labels(key)} {metric.total}")
+                else:
+                    lines.append(f"{full_name}{_format_labels(key)} {metric.snapshot()}")
+            if maxima:
+                lines.append(f"# TYPE {full_name}_max gauge")
+                lines.extend(maxima)
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}uptime_seconds gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}uptime_seconds {time.time() - self.started}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port, host="localhost"):
+        """Serve `prometheus_text` at http://host:port/metrics from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -1,10 +1,58 @@
+import logging
+import math
 import threading
 import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PhiAccrualDetector:
+    """Phi-accrual failure detector for one node.
+
+    Keeps a window of heartbeat inter-arrival times and turns the time since
+    the last heartbeat into a suspicion level phi: the -log10 probability
+    that a heartbeat would arrive this late if the node were alive. Slow or
+    jittery links raise the expected interval instead of causing false
+    failovers; `acceptable_pause` adds headroom for GC and scheduling pauses.
+    """
+
+    def __init__(self, window=100, min_std=0.1, acceptable_pause=1.0, first_interval=1.0):
+        self.intervals = deque(maxlen=window)
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self.last_arrival = None
+
+    def heartbeat(self, now):
+        if self.last_arrival is None:
+            self.intervals.append(self.first_interval)
+        else:
+            self.intervals.append(now - self.last_arrival)
+        self.last_arrival = now
+
+    def phi(self, now):
+        if self.last_arrival is None:
+            return 0.0
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((interval - mean) ** 2 for interval in self.intervals) / len(self.intervals)
+        std = max(math.sqrt(variance), self.min_std)
+        y = (now - self.last_arrival - mean - self.acceptable_pause) / std
+        y = max(-10.0, min(10.0, y))  # Beyond this phi is saturated either way
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))  # Logistic approximation of the normal CDF
+        p_later = e / (1 + e) if y > 0 else 1 - 1 / (1 + e)
+        return -math.log10(max(p_later, 1e-300))
+
 
 class NodeManager:
-    def __init__(self, peer_list):
+    def __init__(self, peer_list, on_recover=None, phi_threshold=8.0, check_interval=0.5, detector_options=None):
         self.nodes = {peer[0]: "online" for peer in peer_list}
         self.heartbeats = {}
+        self.detectors = {}  # {node_id: PhiAccrualDetector}
+        self.phi_threshold = phi_threshold  # Suspicion level at which a node is marked offline
+        self.check_interval = check_interval
+        self.detector_options = detector_options or {}
+        self.on_recover = on_recover  # Called with the node id once a node rejoins
         self.lock = threading.Lock()
 
     def start_heartbeat_monitor(self):
@@ -12,22 +60,43 @@ class NodeManager:
         threading.Thread(target=self.monitor_heartbeats, daemon=True).start()
 
     def receive_heartbeat(self, node_id):
-        """Update heartbeat timestamp for a node."""
+        """Update heartbeat timestamp for a node, recovering it if it was offline."""
+        now = time.time()
         with self.lock:
-            self.heartbeats[node_id] = time.time()
+            self.heartbeats[node_id] = now
+            detector = self.detectors.get(node_id)
+            if detector is None:
+                detector = self.detectors[node_id] = PhiAccrualDetector(**self.detector_options)
+            detector.heartbeat(now)
+            recovered = self.nodes.get(node_id) == "offline"
+            self.nodes.setdefault(node_id, "online")
+        if recovered:
+            self.recover_node(node_id)
 
     def monitor_heartbeats(self):
-        """Periodically check for missed heartbeats."""
+        """Periodically mark nodes whose phi crossed the threshold offline."""
         while True:
+            now = time.time()
             with self.lock:
-                for node, last_seen in list(self.heartbeats.items()):
-                    if time.time() - last_seen > 5:
+                for node, detector in self.detectors.items():
+                    if self.nodes.get(node) == "online" and detector.phi(now) > self.phi_threshold:
                         self.nodes[node] = "offline"
-                        print(f"Node {node} marked offline.")
-            time.sleep(1)
+                        logger.warning("Node %s marked offline.", node)
+            time.sleep(self.check_interval)
+
+    def membership(self):
+        """Status, phi and seconds since the last heartbeat for every known node."""
+        now = time.time()
+        with self.lock:
+            return {node: {"status": status,
+                           "phi": self.detectors[node].phi(now) if node in self.detectors else None,
+                           "last_seen_s": now - self.heartbeats[node] if node in self.heartbeats else None}
+                    for node, status in self.nodes.items()}
 
     def recover_node(self, node_id):
         """Recover a node and fetch its topics."""
         with self.lock:
             self.nodes[node_id] = "online"
-            print(f"Node {node_id} rejoined and is online.")
+            logger.info("Node %s rejoined and is online.", node_id)
+        if self.on_recover is not None:
+            self.on_recover(node_id)
@@ -0,0 +1,95 @@
+import itertools
+from hash_ring import hash_key
+
+# A topic with N partitions is stored as the ordinary topics "<name>:0" ... "<name>:<N-1>", each with its
+# own log, lock, leader and replica set
+PARTITION_SEPARATOR = ":"
+PARTITIONERS = ("hash", "round_robin")
+PUBLISH_ACTIONS = ("publish", "publish_batch", "publish_records")
+MAX_PARTITIONS = 1024
+
+
+def partition_name(topic_name, partition):
+    return f"{topic_name}{PARTITION_SEPARATOR}{partition}"
+
+
+def place_partitions(topic_name, count, node_ids, primary):
+    """Leader of each partition: the nodes in turn, starting at `primary`, so partitions land on different nodes."""
+    node_ids = sorted(node_ids)
+    start = node_ids.index(primary) if primary in node_ids else hash_key(topic_name) % len(node_ids)
+    return [node_ids[(start + partition) % len(node_ids)] for partition in range(count)]
+
+
+class Partitioner:
+    """Picks the partition of each published message.
+
+    Messages with a key go to the partition of the key's hash, so one key's
+    messages stay in order on one partition; hash_key is the same in every
+    process. Messages without a key, or all of them with "round_robin", go
+    to the partitions in turn. A batch without keys goes whole to one
+    partition, keeping it one append.
+    """
+
+    def __init__(self):
+        self.counters = {}  # {topic_name: itertools.count}, whose next() is atomic
+
+    def next(self, topic_name, count):
+        counter = self.counters.get(topic_name)
+        if counter is None:
+            counter = self.counters.setdefault(topic_name, itertools.count())
+        return next(counter) % count
+
+    def partition(self, topic_name, count, key=None, partitioner="hash"):
+        if key is not None and partitioner == "hash":
+            return hash_key(key) % count
+        return self.next(topic_name, count)
+
+    def split(self, request, count):
+        """Split a publish request on a partitioned topic into [(partition, request on that partition's topic)].
+
+        A request may name its `partition` and choose a `partitioner`. Raises
+        ValueError for an unknown partitioner or partition, or for `keys` that
+        are not a list with one key per message.
+        """
+        topic_name = request["topic_name"]
+        partitioner = request.get("partitioner", "hash")
+        if partitioner not in PARTITIONERS:
+            raise ValueError(f"Unknown partitioner '{partitioner}', expected one of {PARTITIONERS}")
+        partition = request.get("partition")
+        if partition is not None and not (type(partition) is int and 0 <= partition < count):
+            raise ValueError(f"Partition {partition!r} is not in 0..{count - 1}")
+        base = {name: value for name, value in request.items() if name not in ("partition", "partitioner")}
+        keys = request.get("keys")
+        if keys is not None and not (isinstance(keys, (list, tuple)) and len(keys) == len(request.get("messages", ()))):
+            raise ValueError("Expected one key per message")
+        if request["action"] == "publish":
+            if partition is None:
+                partition = self.partition(topic_name, count, request.get("key"), partitioner)
+        elif partition is None and (request["action"] == "publish_records" or partitioner == "round_robin"
+                                    or keys is None):
+            partition = self.next(topic_name, count)
+        if partition is not None:
+            return [(partition, {**base, "topic_name": partition_name(topic_name, partition)})]
+        groups = {}  # {partition: ([messages], [keys])}
+        for message, key in zip(request["messages"], keys):
+            messages, group_keys = groups.setdefault(self.partition(topic_name, count, key), ([], []))
+            messages.append(message)
+            group_keys.append(key)
+        return [(partition, {**base, "topic_name": partition_name(topic_name, partition), "messages": messages,
+                             "keys": group_keys})
+                for partition, (messages, group_keys) in sorted(groups.items())]
+
+
+def merge_published(parts):
+    """Combine the responses of a split publish, given as [(partition, response)]."""
+    if len(parts) == 1:
+        partition, response = parts[0]
+        return {**response, "partition": partition}
+    published = [(partition, response) for partition, response in parts if response.get("status") == "batch_published"]
+    return {
+        "status": "batch_published" if len(published) == len(parts) else "partial_failure",
+        "count": sum(response["count"] for _, response in published),
+        "partitions": [[partition, response["first_offset"], response["count"]] for partition, response in published],
+        "failures": [[partition, response] for partition, response in parts
+                     if response.get("status") != "batch_published"],
+    }
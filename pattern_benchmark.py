@@ -0,0 +1,126 @@
+import argparse
+import gc
+import random
+import time
+from peer import PeerNode
+from topic_trie import TopicTrie, split_topic
+
+METRICS = ("cpu", "mem", "disk", "net", "load", "iops", "temp", "fan", "swap", "uptime")
+LEVELS = ("debug", "info", "warn", "error")
+
+
+def sample_topics(hosts, services):
+    topics = [f"metrics.host{h}.{metric}" for h in range(hosts) for metric in METRICS]
+    topics += [f"logs.svc{s}.{level}" for s in range(services) for level in LEVELS]
+    return topics
+
+
+def sample_patterns(count, hosts, services, rng):
+    """A mix of exact names, one-level and multi-level wildcards over the sample topic space.
+
+    Mostly selective patterns, as most subscribers watch a few hosts or
+    services, plus a sprinkling of broad ones and some that match nothing.
+    """
+    makers = (
+        (30, lambda: f"metrics.host{rng.randrange(hosts)}.*"),
+        (30, lambda: f"metrics.host{rng.randrange(hosts)}.{rng.choice(METRICS)}"),
+        (20, lambda: f"logs.svc{rng.randrange(services)}.#"),
+        (0.01, lambda: f"metrics.*.{rng.choice(METRICS)}"),
+        (0.01, lambda: f"logs.*.{rng.choice(LEVELS)}"),
+        (0.01, lambda: f"logs.#.{rng.choice(LEVELS)}"),
+        (20, lambda: f"app{rng.randrange(count)}.#"),  # Never matches: only costs memory
+    )
+    weights = [weight for weight, _ in makers]
+    chosen = rng.choices([maker for _, maker in makers], weights, k=count)
+    return [(f"sub{i}", maker()) for i, maker in enumerate(chosen)]
+
+
+def linear_match(patterns, topic):
+    """Baseline: test every pattern against the topic."""
+    levels = split_topic(topic)
+
+    def matches(pattern_levels, i, j):
+        if i == len(pattern_levels):
+            return j == len(levels)
+        if pattern_levels[i] == "#":
+            return any(matches(pattern_levels, i + 1, k) for k in range(j, len(levels) + 1))
+        return j < len(levels) and pattern_levels[i] in ("*", levels[j]) and matches(pattern_levels, i + 1, j + 1)
+
+    return [key for key, pattern in patterns if matches(split_topic(pattern), 0, 0)]
+
+
+class _NullSession:
+    """Stands in for a client connection; queued notifications are never sent."""
+
+    def attach(self, queue):
+        pass
+
+
+def publish_rate(node, topics, messages):
+    started = time.perf_counter()
+    for i in range(messages):
+        node.publish_message(topics[i % len(topics)], f"message {i}")
+    return messages / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wildcard subscription matching: topic trie vs linear scan")
+    parser.add_argument("--patterns", type=int, default=100000)
+    parser.add_argument("--hosts", type=int, default=20000)
+    parser.add_argument("--services", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=10000, help="Topics matched through the trie")
+    parser.add_argument("--linear-lookups", type=int, default=20, help="Topics matched by scanning every pattern")
+    parser.add_argument("--messages", type=int, default=20000, help="Publishes timed on an in-process node")
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    topics = sample_topics(args.hosts, args.services)
+    patterns = sample_patterns(args.patterns, args.hosts, args.services, rng)
+    print(f"{len(patterns)} patterns, {len(topics)} topics")
+
+    trie = TopicTrie()
+    started = time.perf_counter()
+    for key, pattern in patterns:
+        trie.add(pattern, key, key)
+    print(f"  build trie:           {(time.perf_counter() - started) * 1e6 / len(patterns):8.2f} us/pattern")
+
+    lookups = [rng.choice(topics) for _ in range(args.lookups)]
+    started = time.perf_counter()
+    matched = sum(len(trie.match(topic)) for topic in lookups)
+    trie_time = (time.perf_counter() - started) / len(lookups)
+    print(f"  trie match:           {trie_time * 1e6:8.2f} us/topic ({matched / len(lookups):.1f} matches/topic)")
+
+    started = time.perf_counter()
+    for topic in lookups[:args.linear_lookups]:
+        assert sorted(linear_match(patterns, topic)) == sorted(trie.match(topic))
+    linear_time = (time.perf_counter() - started) / args.linear_lookups
+    print(f"  linear scan:          {linear_time * 1e6:8.2f} us/topic ({linear_time / trie_time:.0f}x slower)")
+
+    # Fan-out on a node: pattern queues are attached to matching topics up front, so a publish
+    # never consults the patterns. It pays only for delivering to the queues that did match.
+    publish_topics = topics[:: max(1, len(topics) // 200)]
+    unmatched_topics = [f"orders.region{i}" for i in range(len(publish_topics))]
+    baseline = PeerNode(1, 0, [], replication_factor=0)
+    for topic in publish_topics:
+        baseline.create_topic(topic)
+    node = PeerNode(1, 0, [], replication_factor=0)
+    session = _NullSession()
+    started = time.perf_counter()
+    for key, pattern in patterns:
+        node.subscribe_to_pattern(pattern, key, session, max_queue=10)
+    print(f"  subscribe:            {(time.perf_counter() - started) * 1e6 / len(patterns):8.2f} us/pattern")
+    started = time.perf_counter()
+    for topic in publish_topics + unmatched_topics:
+        node.create_topic(topic)
+    created = len(publish_topics) + len(unmatched_topics)
+    attached = sum(len(node.fanouts[topic].pattern_queues) for topic in publish_topics)
+    print(f"  create topic:         {(time.perf_counter() - started) * 1e6 / created:8.2f} us/topic "
+          f"({attached / len(publish_topics):.1f} patterns attached)")
+    # Move the long-lived subscription objects out of the collector's view, as a long-running
+    # server's would be after a few full collections, so the rates below measure publishing.
+    gc.collect()
+    gc.freeze()
+    print(f"  publish, no patterns:           {publish_rate(baseline, publish_topics, args.messages):8.0f} msg/s")
+    print(f"  publish, no pattern matches:    {publish_rate(node, unmatched_topics, args.messages):8.0f} msg/s")
+    print(f"  publish, {attached / len(publish_topics):.1f} pattern matches: "
+          f"{publish_rate(node, publish_topics, args.messages):8.0f} msg/s")
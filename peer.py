@@ -1,30 +1,289 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
 import socket
 import threading
 import time
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from catalog import DEFAULT_PAGE_SIZE, TopicCatalog
+from delivery import AsyncSession, FetchScheduler, ParkedFetch, SubscriberQueue, ThreadedSession, TopicFanout
+from storage import (COMPRESSION_CODECS, STORAGE_BACKENDS, CorruptRecordError, RecordBatch, create_log, load_logs,
+                     validate_topic_config)
+from codec import CODECS, PICKLE, CodecError
+from protocol import (HEADER, Connection, ProtocolError, accept_hello, configure_socket, decode_payload,
+                      encode_response, is_hello, parse_header, recv_raw_frame)
 from replicate import ReplicationManager
 from node_manager import NodeManager
+from gossip import Gossiper
+from groups import DEFAULT_SESSION_TIMEOUT, GroupCoordinator
+from anti_entropy import DEFAULT_RANGE_SIZE, AntiEntropy, range_digests
+from retention import LogCleaner
+from topic_trie import TopicTrie, is_pattern, validate_pattern
+from metrics import MetricsRegistry
+from partitions import (MAX_PARTITIONS, PARTITION_SEPARATOR, PUBLISH_ACTIONS, Partitioner, merge_published,
+                        partition_name, place_partitions)
+from wal import WriteAheadLog
+
+
+SERVER_MODES = ("threaded", "asyncio")
+DEFAULT_FETCH_MESSAGES = 1000
+DEFAULT_FETCH_BYTES = 1024 * 1024
+MAX_FETCH_WAIT_MS = 30000  # Longest a fetch may stay parked
+# Client requests a node passes on to a partition's leader when it holds no copy of the partition
+FORWARDED_ACTIONS = PUBLISH_ACTIONS + ("fetch_messages", "join_group", "group_fetch", "commit_offsets", "leave_group")
+
+logger = logging.getLogger(__name__)
 
 
 class PeerNode:
-    def __init__(self, node_id, port, peer_list):
+    def __init__(self, node_id, port, peer_list, server_mode="threaded", backlog=1024, executor_workers=32,
+                 storage="memory", data_dir=None, storage_options=None, consistency_model="strong",
+                 replication_factor=2, write_quorum=1, replication_options=None, catch_up_options=None,
+                 gossip_options=None, codecs=("binary",), topic_defaults=None, cleaner_options=None,
+                 metrics_port=None, membership_options=None, strict_leadership=True, group_options=None,
+                 wal_options=None):
+        if server_mode not in SERVER_MODES:
+            raise ValueError(f"Unknown server mode '{server_mode}', expected one of {SERVER_MODES}")
+        if any(name not in CODECS for name in codecs):
+            raise ValueError(f"Unknown codec in {codecs}, expected names from {tuple(CODECS)}")
+        if storage not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend '{storage}', expected one of {STORAGE_BACKENDS}")
         self.node_id = node_id
         self.port = port
         self.peer_list = peer_list  # [(peer_id, ip, port)]
-        self.topics = {}  # {topic_name: [messages]}
-        self.subscribers = {}  # {topic_name: [subscriber_ids]}
-        self.replication_manager = ReplicationManager()
-        self.node_manager = NodeManager(peer_list)
-        self.lock = threading.Lock()
+        self.server_mode = server_mode  # "threaded" (thread per connection) or "asyncio" (one event loop)
+        self.backlog = backlog
+        self.executor_workers = executor_workers
+        self.codecs = codecs  # Payload codecs clients may negotiate; "pickle" also admits legacy clients
+        self.executor = None  # Bounded pool for blocking request handling in asyncio mode
+        self.loop = None
+        self.storage = storage  # "memory" or "disk" (segmented log files under data_dir)
+        self.data_dir = data_dir or f"data/node{node_id}"
+        self.storage_options = storage_options or {}  # Passed to SegmentedLog, e.g. fsync_policy
+        self.topics = {}  # {topic_name: MemoryLog or SegmentedLog}
+        self.subscribers = {}  # {topic_name: {subscriber_ids}}
+        self.fanouts = {}  # {topic_name: TopicFanout} for subscribers with an open push connection
+        self.topic_index = TopicTrie()  # Topic names, for finding the topics a new pattern matches
+        self.pattern_index = TopicTrie()  # Wildcard subscriptions: pattern -> {subscriber_id: SubscriberQueue}
+        self.metrics = MetricsRegistry()
+        self.metrics_port = metrics_port  # Serve Prometheus text on http://localhost:<port>/metrics if set
+        self.request_histograms = {}  # {action: Histogram} of request latency
+        self.bytes_in = self.metrics.counter("bytes_in")
+        self.bytes_out = self.metrics.counter("bytes_out")
+        self.topic_locks = {}  # {topic_name: TimedLock} serializing appends to one topic
+        self.topic_meters = {}  # {topic_name: Meter} of messages appended
+        self.catalog = TopicCatalog()  # Per-topic stats for listing topics without reading their logs
+        self.fetch_scheduler = FetchScheduler()  # Answers long-poll fetches parked on their topic
+        self.parked_fetches = self.metrics.counter("fetches_parked")
+        # With a write-ahead log, memory nodes keep their node state on disk like disk nodes do
+        durable = storage == "disk" or wal_options is not None
+        group_options = {"path": f"{self.data_dir}/consumer_offsets.json" if durable else None,
+                         **(group_options or {})}
+        self.groups = GroupCoordinator(**group_options)  # Consumer groups and their committed offsets
+        self.partitioned = {}  # {topic_name: [leader node id of each partition]}
+        self.partitioner = Partitioner()
+        self.partitions_path = f"{self.data_dir}/partitions.json" if durable else None
+        self.strict_leadership = strict_leadership  # Answer writes to replicated-only topics with not_leader
+        self.topic_defaults = topic_defaults or {}  # Config every new topic starts from, e.g. retention limits
+        replication_options = {"spill_dir": f"{self.data_dir}-spill", **(replication_options or {})}
+        self.replication_manager = ReplicationManager(node_id, replication_factor, consistency_model, write_quorum,
+                                                      get_log=self.topics.get, **replication_options)
+        self.node_manager = NodeManager(peer_list, on_recover=self.on_peer_recovered, **(membership_options or {}))
+        self.anti_entropy = AntiEntropy(self, **(catch_up_options or {}))
+        self.log_cleaner = LogCleaner(self, **(cleaner_options or {}))
+        self.gossiper = Gossiper(node_id, 'localhost', port, peer_list, self.node_manager.receive_heartbeat,
+                                 **(gossip_options or {}))
+        self.lock = self.metrics.timed_lock("lock_wait_seconds", lock="node")  # Guards the topic map
+        self.metrics.add_collector(self.collect_gauges)
+        self.peer_connections = {}  # {peer_id: Connection}, kept open between calls
+        self.wal = None  # Logs topic, subscription and (for memory nodes) message changes; see WriteAheadLog
+        if storage == "disk":
+            self.load_topics()
+        if wal_options is not None:
+            self.wal = WriteAheadLog(f"{self.data_dir}-wal", **wal_options)
+            self.recover_state()
+        for topic_name in list(self.topics):
+            if self.catalog.get(topic_name).leader == self.node_id:
+                self.replicate_topic(topic_name)
+        if durable:
+            self.load_partitions()
+
+    def load_topics(self):
+        """Reopen the topics persisted under this node's data directory, each with its recorded leader.
+
+        Topics stored before leaders were recorded are led by this node.
+        Replication starts once recovery is done.
+        """
+        for topic_name, log in load_logs(self.data_dir, **self.storage_options).items():
+            self._add_topic(topic_name, log, self.node_id if log.leader is None else log.leader)
+            logger.info("Loaded topic '%s' with %d messages.", topic_name, log.next_offset - log.start_offset)
+
+    def recover_state(self):
+        """Rebuild topics and subscriptions from the write-ahead log's snapshot and the records after it.
+
+        Memory nodes get their messages back too; disk nodes already reopened
+        them from their segments and take the recorded leader and the
+        subscriptions. Topics this node led are replicated again; the others
+        come back as replicas of their recorded leader and catch up like any
+        rejoining node.
+        """
+        recovered = self.wal.recover()
+        messages = 0
+        for topic_name, topic in recovered.items():
+            if topic_name not in self.topics:
+                log = topic.log if self.storage == "memory" else create_log(topic_name, self.storage, self.data_dir,
+                                                                            topic.config, **self.storage_options)
+                self._add_topic(topic_name, log, topic.leader)
+            else:
+                self.catalog.set_placement(topic_name, topic.leader, ())
+                if self.storage == "disk":
+                    self.topics[topic_name].set_leader(topic.leader)
+            self.subscribers[topic_name] = set(topic.subscribers)
+            self._update_subscriber_count(self.fanouts[topic_name])
+            messages += self.topics[topic_name].next_offset - self.topics[topic_name].start_offset
+        recovery = self.wal.recovery
+        logger.info("Recovered %d topics with %d messages in %.2fs: snapshot at LSN %d, %d log records replayed.",
+                    len(recovered), messages, recovery["seconds"], recovery["snapshot_lsn"],
+                    recovery["replayed_records"])
+
+    def _add_topic(self, topic_name, log, leader):
+        """Register a topic's log with its lock, meter, fanout and catalog entry. Returns the fanout."""
+        self.topics[topic_name] = log
+        self.topic_locks[topic_name] = self.metrics.timed_lock("lock_wait_seconds", lock="topic")
+        self.topic_meters[topic_name] = self.metrics.meter("messages_in", topic=topic_name)
+        self.subscribers[topic_name] = set()
+        fanout = self.fanouts[topic_name] = TopicFanout(topic_name)
+        for queue in self.pattern_index.match(topic_name):
+            fanout.add_pattern(queue)
+        self.topic_index.add(topic_name, topic_name, topic_name)
+        self.catalog.add(topic_name, log, leader)
+        if self.storage == "disk":
+            log.set_leader(leader)
+        self._update_subscriber_count(fanout)
+        return fanout
+
+    def snapshot(self):
+        """Snapshot the node's state and drop the write-ahead log it covers."""
+        if self.wal is None:
+            return {"status": "invalid_request", "error": "This node keeps no write-ahead log"}
+        return {"status": "ok", **self.wal.snapshot(self.read_topic_states)}
+
+    def read_topic_states(self):
+        """Yield each topic's state for a snapshot, read under its lock with the log position it reflects."""
+        with self.lock:
+            topic_names = list(self.topics)
+        for topic_name in topic_names:
+            log, topic_lock, _ = self.get_topic(topic_name)
+            with topic_lock:
+                state = (topic_name, log.config, self.catalog.get(topic_name).leader,
+                         sorted(self.subscribers[topic_name]), log.start_offset, log.next_offset, self.wal.lsn,
+                         list(log.batches) if self.storage == "memory" else [])
+            yield state
 
     def start_server(self):
         """Start the peer server."""
+        self.log_cleaner.start()
+        self.groups.start()
+        if self.wal is not None:
+            self.wal.start(self.read_topic_states)
+        if self.metrics_port is not None:
+            self.metrics.serve_prometheus(self.metrics_port)
+            logger.info("Node %s serves metrics on http://localhost:%d/metrics.", self.node_id, self.metrics_port)
+        if self.server_mode == "asyncio":
+            self.start_async_server()
+            return
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Rebind at once after a restart
         server.bind(('localhost', self.port))
-        server.listen(5)
-        print(f"Node {self.node_id} is online on port {self.port}.")
+        server.listen(self.backlog)
+        logger.info("Node %s is online on port %d.", self.node_id, self.port)
         threading.Thread(target=self.handle_connections, args=(server,), daemon=True).start()
 
+    def start_async_server(self):
+        """Serve all connections from one asyncio event loop running in a background thread."""
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers,
+                                           thread_name_prefix=f"node{self.node_id}-worker")
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        errors = []
+
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(asyncio.start_server(
+                    self.handle_async_client, 'localhost', self.port, backlog=self.backlog))
+            except OSError as e:
+                errors.append(e)
+                ready.set()
+                return
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run_loop, daemon=True).start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        logger.info("Node %s is online on port %d (asyncio mode).", self.node_id, self.port)
+
+    async def handle_async_client(self, reader, writer):
+        """Serve framed requests from one connection on the event loop."""
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            configure_socket(sock)
+        loop = asyncio.get_running_loop()
+        session = AsyncSession(writer, loop)
+        session.on_close = self.detach_subscriber
+        session.bytes_out = self.bytes_out
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id = parse_header(header)
+                payload = await reader.readexactly(length)
+                self.bytes_in.inc(HEADER.size + length)
+                if not self.negotiate(session, request_id, payload, writer.write):
+                    break
+                if is_hello(request_id, payload):
+                    continue
+                data = None
+                try:
+                    data = decode_payload(payload, session.codec)
+                    response = await loop.run_in_executor(self.executor, self.process_request, data, session)
+                except Exception as e:
+                    response = self.request_failed(data, e)
+                if isinstance(response, ParkedFetch):
+                    response.add_done_callback(partial(self.send_parked, session, request_id))
+                    continue
+                frame = encode_response(request_id, response, session.codec)
+                self.bytes_out.inc(len(frame))
+                writer.write(frame)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ProtocolError, OSError):
+            pass
+        finally:
+            session.close()
+
+    def negotiate(self, session, request_id, payload, write):
+        """Settle a connection's codec from its first frame. Returns False to drop the connection.
+
+        Clients open with a hello frame; a connection that starts straight with
+        a request is a legacy pickle client, served only if pickle is allowed.
+        """
+        if session.negotiated:
+            return True
+        session.negotiated = True
+        if is_hello(request_id, payload):
+            session.codec, reply = accept_hello(payload, self.codecs)
+            write(reply)
+            return session.codec is not None
+        session.codec = PICKLE
+        return PICKLE.name in self.codecs
+
     def handle_connections(self, server):
         """Handle incoming connections."""
         while True:
@@ -32,91 +291,1000 @@ class PeerNode:
             threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
 
     def handle_client(self, client):
-        """Handle requests from other nodes/clients."""
+        """Serve framed requests from another node/client until it disconnects."""
+        configure_socket(client)
+        session = ThreadedSession(client)
+        session.on_close = self.detach_subscriber
+        session.bytes_out = self.bytes_out
         try:
-            data = pickle.loads(client.recv(4096))  # Increased buffer size
-            response = self.process_request(data)
-            client.sendall(pickle.dumps(response))  # Use sendall to ensure full data is sent
+            while True:
+                frame = recv_raw_frame(client)
+                if frame is None:
+                    break
+                request_id, payload = frame
+                self.bytes_in.inc(HEADER.size + len(payload))
+                if not self.negotiate(session, request_id, payload, client.sendall):
+                    break
+                if is_hello(request_id, payload):
+                    continue
+                data = None
+                try:
+                    data = decode_payload(payload, session.codec)
+                    response = self.process_request(data, session)
+                except Exception as e:
+                    response = self.request_failed(data, e)
+                if isinstance(response, ParkedFetch):
+                    response.add_done_callback(partial(self.send_parked, session, request_id))
+                    continue
+                session.send(request_id, response)
+        except (ProtocolError, OSError):
+            pass
         finally:
-            client.close()
+            session.close()
+
+    @staticmethod
+    def request_failed(data, error):
+        """Answer a request that could not be decoded or whose handling raised.
+
+        Only that request fails, not the connection it shares: frames are
+        length-delimited, so the next one is still read correctly.
+        """
+        action = data.get("action") if isinstance(data, dict) else None
+        logger.warning("Request %r failed: %r", action, error)
+        return {"status": "invalid_request", "error": f"{type(error).__name__}: {error}"}
+
+    def send_parked(self, session, request_id, response):
+        """Answer a parked fetch once it completes; the connection may have closed meanwhile."""
+        try:
+            session.send(request_id, response)
+        except (OSError, CodecError):
+            pass
+
+    def process_request(self, data, session=None):
+        """Process API actions, recording each one's latency. `session` is the connection it arrived on, if any.
+
+        A long-poll fetch from a connection may return a ParkedFetch, which the
+        connection handler answers when it completes; its wait is not timed.
+        """
+        started = time.perf_counter()
+        response = self.dispatch_request(data, session)
+        action = data.get("action")
+        histogram = self.request_histograms.get(action)
+        if histogram is None:
+            if isinstance(response, dict) and response.get("status") == "unknown_action":
+                action = "unknown"  # Keep arbitrary client input out of metric labels
+            histogram = self.request_histograms[action] = self.metrics.histogram("request_seconds", action=action)
+        histogram.observe(time.perf_counter() - started)
+        return response
 
-    def process_request(self, data):
-        """Process API actions."""
+    def dispatch_request(self, data, session=None):
         action = data.get("action")
+        if action == "partition_map":
+            return self.register_partitions(data['topic_name'], data['leaders'])
+        topic_name = data.get('topic_name')
+        if topic_name in self.partitioned:
+            return self.partitioned_request(data, session)
+        if action in FORWARDED_ACTIONS and topic_name not in self.topics:
+            partition = self._remote_partition(topic_name)
+            if partition is not None:
+                return self.on_partitions(partition[0], [(partition[1], data)])[0]
         if action == "create_topic":
-            return self.create_topic(data['topic_name'])
+            if data.get('partitions') is not None:
+                return self.create_partitioned_topic(data['topic_name'], data['partitions'], data.get('config'))
+            return self.create_topic(data['topic_name'], data.get('replica_of'), data.get('config'))
         elif action == "publish":
-            return self.publish_message(data['topic_name'], data['message'])
+            return self.publish_message(data['topic_name'], data['message'], data.get('key'))
+        elif action == "publish_batch":
+            return self.publish_batch(data['topic_name'], data['messages'], data.get('keys'))
+        elif action == "publish_records":
+            return self.publish_records(data['topic_name'], RecordBatch.from_tuple(data['batch']))
+        elif action == "replicate_append":
+            batches = [RecordBatch.from_tuple(batch) for batch in data['batches']] if 'batches' in data else None
+            return self.replicate_append(data['topic_name'], data['base_offset'], data.get('messages'), batches)
+        elif action == "replication_status":
+            return {"status": "ok", "replicas": self.replication_manager.replica_status(data.get('topic_name'))}
         elif action == "fetch_messages":
-            return self.fetch_messages(data['topic_name'])
+            return self.fetch_messages(data['topic_name'], data.get('from_offset', 0),
+                                       data.get('max_messages', DEFAULT_FETCH_MESSAGES),
+                                       data.get('max_bytes', DEFAULT_FETCH_BYTES), data.get('batches', False),
+                                       data.get('compression'), data.get('min_messages', 1),
+                                       data.get('min_bytes', 0), data.get('max_wait_ms', 0),
+                                       defer=session is not None)
         elif action == "subscribe":
-            return self.subscribe_to_topic(data['topic_name'], data['subscriber_id'])
+            return self.subscribe_to_topic(data['topic_name'], data['subscriber_id'], session,
+                                           data.get('push', False), data.get('max_queue', 1000),
+                                           data.get('overflow_policy', "drop_oldest"))
+        elif action == "unsubscribe":
+            return self.unsubscribe_from_topic(data['topic_name'], data['subscriber_id'])
+        elif action == "subscriber_stats":
+            return self.subscriber_stats(data.get('topic_name'))
+        elif action == "join_group":
+            return self.join_group(data['group_id'], data['topic_name'], data.get('member_id'),
+                                   data.get('session_timeout', DEFAULT_SESSION_TIMEOUT))
+        elif action == "group_fetch":
+            return self.group_fetch(data['group_id'], data['topic_name'], data['member_id'], data.get('commit', ()),
+                                    data.get('max_messages', DEFAULT_FETCH_MESSAGES),
+                                    data.get('max_bytes', DEFAULT_FETCH_BYTES), data.get('max_wait_ms', 0),
+                                    defer=session is not None)
+        elif action == "commit_offsets":
+            return self.commit_offsets(data['group_id'], data['topic_name'], data['member_id'], data['ranges'])
+        elif action == "leave_group":
+            return self.leave_group(data['group_id'], data['topic_name'], data['member_id'], data.get('commit', ()))
+        elif action == "group_stats":
+            return self.group_stats(data.get('topic_name'))
+        elif action == "heartbeat":
+            self.node_manager.receive_heartbeat(data['node_id'])
+            return {"status": "ok"}
+        elif action == "membership":
+            return {"status": "ok", "nodes": self.node_manager.membership(), "gossip": self.gossiper.stats()}
+        elif action == "topic_offsets":
+            return self.topic_offsets()
+        elif action == "topic_digests":
+            return self.topic_digests(data['topic_name'], data['from_offset'], data['end_offset'],
+                                      data.get('range_size', DEFAULT_RANGE_SIZE))
+        elif action == "catch_up":
+            return self.anti_entropy.catch_up()
+        elif action == "catch_up_status":
+            return {"status": "ok", "report": self.anti_entropy.last_report}
+        elif action == "stats":
+            return self.stats(data.get('format', "json"))
+        elif action == "snapshot":
+            return self.snapshot()
+        elif action == "cleaner_status":
+            return {"status": "ok", "topics": dict(self.log_cleaner.stats)}
+        elif action == "update_peers":
+            return self.update_peers([tuple(peer) for peer in data['peer_list']])
+        elif action == "metadata":
+            return self.metadata(data.get('topics', ()))
+        elif action == "list_topics":
+            return self.list_topics(data.get('prefix', ""), data.get('cursor'), data.get('limit', DEFAULT_PAGE_SIZE))
         elif action == "fetch_topics":
-            return self.topics
+            with self.catalog.lock:
+                names = list(self.catalog.names)
+            return {topic_name: self.catalog.get(topic_name).next_offset for topic_name in names}
         return {"status": "unknown_action"}
 
-    def create_topic(self, topic_name):
-        """Create a new topic and replicate it."""
+    def create_topic(self, topic_name, replica_of=None, config=None):
+        """Create a new topic and replicate it.
+
+        When `replica_of` is set the request comes from the topic's leader and
+        the topic is only created locally, with the leader's config. `config`
+        holds per-topic settings on top of the node's `topic_defaults`:
+        "compression", "cleanup_policy" ("delete" or "compact") and the
+        retention limits "retention_ms", "retention_bytes" and "retention_messages".
+        """
+        if is_pattern(topic_name):
+            return {"status": "invalid_request", "error": "Topic names cannot contain wildcard levels"}
+        if replica_of is None:
+            config = {**self.topic_defaults, **(config or {})}
+        error = validate_topic_config(config or {})
+        if error:
+            return {"status": "invalid_request", "error": error}
         with self.lock:
-            if topic_name not in self.topics:
-                self.topics[topic_name] = []
-                self.subscribers[topic_name] = []
-                self.replication_manager.replicate_topic(topic_name, self.peer_list)
+            created = topic_name not in self.topics
+            if created:
+                leader = self.node_id if replica_of is None else replica_of
+                self._add_topic(topic_name, create_log(topic_name, self.storage, self.data_dir, config or {},
+                                                       **self.storage_options), leader)
+                if self.wal is not None:
+                    self.wal.create_topic(topic_name, config or {}, leader)
+        if replica_of is not None:
+            log, topic_lock, _ = self.get_topic(topic_name)
+            if config is not None and config != log.config:
+                with topic_lock:
+                    log.set_config(config)
+                    if self.wal is not None:
+                        self.wal.set_config(topic_name, config)
+            self.set_leader(topic_name, replica_of)
+            return {"status": "topic_created", "topic": topic_name,
+                    "high_watermark": self.topics[topic_name].next_offset}
+        if created:
+            self.replicate_topic(topic_name)
         return {"status": "topic_created", "topic": topic_name}
 
-    def publish_message(self, topic_name, message):
-        """Publish a message to a topic."""
+    def load_partitions(self):
+        """Reopen the partition maps of partitioned topics persisted under this node's data directory."""
+        try:
+            with open(self.partitions_path) as f:
+                self.partitioned = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    def save_partitions(self):
+        if self.partitions_path is not None:
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(f"{self.partitions_path}.tmp", "w") as f:
+                json.dump(self.partitioned, f)
+            os.replace(f"{self.partitions_path}.tmp", self.partitions_path)
+
+    def create_partitioned_topic(self, topic_name, partitions, config=None):
+        """Create a topic split into `partitions` topics named "<topic_name>:<n>".
+
+        Partition leaders are the online nodes in turn, so partitions land on
+        different nodes; each partition is then an ordinary topic with its own
+        log, lock and replica set chosen by its leader. Every node is told the
+        partition map, so publishes, fetches and subscriptions on
+        `topic_name` work through any of them. Creating it again creates any
+        partition that is still missing.
+        """
+        if is_pattern(topic_name) or PARTITION_SEPARATOR in topic_name:
+            return {"status": "invalid_request",
+                    "error": f"Partitioned topic names cannot contain wildcards or '{PARTITION_SEPARATOR}'"}
+        if type(partitions) is not int or not 1 <= partitions <= MAX_PARTITIONS:
+            return {"status": "invalid_request", "error": f"partitions must be an integer in 1..{MAX_PARTITIONS}"}
+        if topic_name in self.topics:
+            return {"status": "invalid_request", "error": f"'{topic_name}' already exists without partitions"}
+        leaders = self.partitioned.get(topic_name)
+        if leaders is None:
+            self.replication_manager.add_peers(self.peer_list)
+            node_ids = {self.node_id} | {peer[0] for peer in self._online_peers()}
+            leaders = place_partitions(topic_name, partitions, node_ids,
+                                       self.replication_manager.placement(topic_name)[0])
+        parts = [(partition, {"action": "create_topic", "topic_name": partition_name(topic_name, partition),
+                              "config": config}) for partition in range(len(leaders))]
+        self.register_partitions(topic_name, leaders)
+        responses = self.on_partitions(topic_name, parts)
+        for peer in self._online_peers():
+            self.send_partition_map(peer, topic_name, leaders)
+        failed = [partition for (partition, _), response in zip(parts, responses)
+                  if response.get("status") != "topic_created"]
+        if failed:
+            return {"status": "partial_failure", "topic": topic_name, "partitions": leaders, "failed": failed}
+        return {"status": "topic_created", "topic": topic_name, "partitions": leaders}
+
+    def _remote_partition(self, topic_name):
+        """(partitioned topic, partition) if `topic_name` is a partition led by another node, else None."""
+        base, separator, partition = str(topic_name).rpartition(PARTITION_SEPARATOR)
+        leaders = self.partitioned.get(base) if separator and partition.isdigit() else None
+        if leaders is None or int(partition) >= len(leaders) or leaders[int(partition)] == self.node_id:
+            return None
+        return base, int(partition)
+
+    def register_partitions(self, topic_name, leaders):
+        """Record where a partitioned topic's partitions are led, as told by the node that created it."""
+        if self.partitioned.get(topic_name) != leaders:
+            self.partitioned[topic_name] = list(leaders)
+            self.save_partitions()
+        return {"status": "ok"}
+
+    def _online_peers(self):
+        membership = self.node_manager.membership()
+        return [peer for peer in self.peer_list
+                if peer[0] != self.node_id and membership.get(peer[0], {}).get("status", "online") == "online"]
+
+    def send_partition_map(self, peer, topic_name, leaders):
+        try:
+            self.get_peer_connection(*peer).request({"action": "partition_map", "topic_name": topic_name,
+                                                     "leaders": leaders})
+        except (ConnectionError, TimeoutError) as e:
+            logger.warning("Could not tell node %s about partitioned topic '%s': %s", peer[0], topic_name, e)
+
+    def on_partitions(self, topic_name, parts, session=None):
+        """Run [(partition, request)] against the partitions' topics and return the responses in order.
+
+        Writes and creates run where the partition is led; reads and
+        subscriptions run on any local copy. Requests for other nodes are
+        sent first and pipelined, so remote partitions are served in parallel
+        with the local ones.
+        """
+        leaders = self.partitioned[topic_name]
+        peers = {peer[0]: peer for peer in self.peer_list}
+        pending = []
+        for partition, request in parts:
+            stats = self.catalog.get(request["topic_name"])
+            if stats is None:
+                local = leaders[partition] == self.node_id
+            else:
+                local = stats.leader == self.node_id or request["action"] not in PUBLISH_ACTIONS
+            if local or leaders[partition] not in peers:
+                pending.append(None)
+                continue
+            try:
+                pending.append(self.get_peer_connection(*peers[leaders[partition]]).send(request))
+            except ConnectionError:
+                pending.append({"status": "connection_failed", "leader": leaders[partition]})
+        responses = []
+        for (partition, request), waiter in zip(parts, pending):
+            if waiter is None:
+                responses.append(self.dispatch_request(request, session))
+            elif isinstance(waiter, dict):
+                responses.append(waiter)
+            else:
+                try:
+                    responses.append(waiter.wait(5.0))
+                except (ConnectionError, TimeoutError):
+                    responses.append({"status": "connection_failed", "leader": leaders[partition]})
+        return responses
+
+    def partitioned_request(self, data, session=None):
+        """Serve a request naming a partitioned topic rather than one of its partitions.
+
+        Publishes go to the partition the key hashes to, or round-robin (see
+        `partitions.Partitioner`). Fetches read every partition from the
+        `offsets` given per partition and answer with one page per partition;
+        only per-partition fetches long-poll. Subscriptions cover the
+        partitions this node holds a copy of. Anything else must name a
+        partition's topic.
+        """
+        action = data.get("action")
+        topic_name = data["topic_name"]
+        count = len(self.partitioned[topic_name])
+        if action == "create_topic":
+            return self.create_partitioned_topic(topic_name, data.get('partitions') or count, data.get('config'))
+        if action in PUBLISH_ACTIONS:
+            try:
+                parts = self.partitioner.split(data, count)
+            except ValueError as e:
+                return {"status": "invalid_request", "error": str(e)}
+            return merge_published([(partition, response) for (partition, _), response
+                                    in zip(parts, self.on_partitions(topic_name, parts))])
+        if action == "fetch_messages":
+            offsets = data.get('offsets') or [0] * count
+            if len(offsets) != count:
+                return {"status": "invalid_request", "error": f"Expected one offset for each of {count} partitions"}
+            request = {name: value for name, value in data.items() if name not in ("offsets", "max_wait_ms")}
+            parts = [(partition, {**request, "topic_name": partition_name(topic_name, partition),
+                                  "from_offset": offsets[partition]}) for partition in range(count)]
+            pages = self.on_partitions(topic_name, parts)
+            return {"status": "ok", "topic": topic_name,
+                    "partitions": [{**page, "partition": partition} for partition, page in enumerate(pages)]}
+        if action in ("subscribe", "unsubscribe"):
+            local = [partition for partition in range(count) if partition_name(topic_name, partition) in self.topics]
+            responses = [self.dispatch_request({**data, "topic_name": partition_name(topic_name, partition)}, session)
+                         for partition in local]
+            status = "subscribed" if action == "subscribe" else "unsubscribed"
+            if not local or any(response.get("status") != status for response in responses):
+                return {"status": responses[0]["status"] if responses else "topic_not_found", "topic": topic_name}
+            return {"status": status, "topic": topic_name, "push": data.get('push', False), "partitions": local}
+        return {"status": "invalid_request",
+                "error": f"'{action}' works on single partitions, e.g. '{partition_name(topic_name, 0)}'"}
+
+    def set_leader(self, topic_name, leader):
+        """Record a topic's new leader in the catalog and wherever this node keeps leaders.
+
+        Taking the topic over starts replicating it; handing it to another
+        node stops this node's replica streams.
+        """
+        log, topic_lock, _ = self.get_topic(topic_name)
+        if log is None or self.catalog.get(topic_name).leader == leader:
+            return
+        with topic_lock:
+            self.catalog.set_placement(topic_name, leader, ())
+            if self.storage == "disk":
+                log.set_leader(leader)
+            if self.wal is not None:
+                self.wal.set_leader(topic_name, leader)
+        if leader == self.node_id:
+            self.replicate_topic(topic_name)
+        else:
+            self.replication_manager.stop_replicating(topic_name)
+        logger.info("Topic '%s' is now led by node %s.", topic_name, leader)
+
+    def replicate_topic(self, topic_name):
+        self.replication_manager.replicate_topic(topic_name, self.peer_list)
+        self._record_placement(topic_name)
+
+    def _record_placement(self, topic_name):
+        replicas = self.replication_manager.topic_replicas.get(topic_name, [])
+        self.catalog.set_placement(topic_name, self.node_id, [peer[0] for peer in replicas])
+
+    def get_topic(self, topic_name):
+        """Look up a topic's log, lock and fanout, holding the topic map lock only for the lookup."""
         with self.lock:
-            if topic_name in self.topics:
-                self.topics[topic_name].append(message)
-                self.replication_manager.synchronize_replicas(topic_name, message)
-                for subscriber in self.subscribers.get(topic_name, []):
-                    print(f"Notification sent to subscriber {subscriber} for topic '{topic_name}'.")
-                return {"status": "message_published"}
+            log = self.topics.get(topic_name)
+            if log is None:
+                return None, None, None
+            return log, self.topic_locks[topic_name], self.fanouts[topic_name]
+
+    def publish_message(self, topic_name, message, key=None):
+        """Publish a message to a topic. Compacted topics keep only the latest message per `key`."""
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        if self.strict_leadership and self.catalog.get(topic_name).leader != self.node_id:
+            return self._not_leader(topic_name)
+        if key is None and log.config.get("cleanup_policy") == "compact":
+            return {"status": "invalid_request", "error": "Messages on a compacted topic need a key"}
+        with topic_lock:
+            batch = RecordBatch.build(log.next_offset, [message], None if key is None else [key],
+                                      compression=log.config.get("compression"))
+            offset = log.append_batch(batch)
+            self._record_append(topic_name, batch)
+            fanout.stage(offset, [message])
+        fanout.dispatch()
+        replication = self.replication_manager.synchronize_batch(topic_name, batch)
+        return {"status": "message_published", "offset": offset, **replication}
+
+    def publish_batch(self, topic_name, messages, keys=None):
+        """Publish a list of messages to a topic with one lock acquisition and one replication round."""
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
             return {"status": "topic_not_found"}
+        if self.strict_leadership and self.catalog.get(topic_name).leader != self.node_id:
+            return self._not_leader(topic_name)
+        if keys is not None and len(keys) != len(messages):
+            return {"status": "invalid_request", "error": "Expected one key per message"}
+        if log.config.get("cleanup_policy") == "compact" and (keys is None or None in keys):
+            return {"status": "invalid_request", "error": "Messages on a compacted topic need a key"}
+        if not messages:
+            return {"status": "batch_published", "count": 0, "first_offset": log.next_offset}
+        with topic_lock:
+            batch = RecordBatch.build(log.next_offset, messages, keys, compression=log.config.get("compression"))
+            first_offset = log.append_batch(batch)
+            self._record_append(topic_name, batch)
+            fanout.stage(first_offset, messages)
+        fanout.dispatch()
+        replication = self.replication_manager.synchronize_batch(topic_name, batch)
+        return {"status": "batch_published", "count": len(messages), "first_offset": first_offset, **replication}
+
+    def publish_records(self, topic_name, batch):
+        """Publish a record batch the client encoded, and possibly compressed, itself.
+
+        The batch is validated without decoding its values, then stored and
+        replicated byte for byte; only its base offset is assigned here.
+        """
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        if self.strict_leadership and self.catalog.get(topic_name).leader != self.node_id:
+            return self._not_leader(topic_name)
+        try:
+            batch.validate(require_keys=log.config.get("cleanup_policy") == "compact")
+        except CorruptRecordError as e:
+            return {"status": "invalid_request", "error": str(e)}
+        if not batch.count:
+            return {"status": "batch_published", "count": 0, "first_offset": log.next_offset}
+        with topic_lock:
+            batch = batch.rebase(log.next_offset)
+            first_offset = log.append_batch(batch)
+            self._record_append(topic_name, batch)
+            fanout.stage_batch(batch)
+        fanout.dispatch()
+        replication = self.replication_manager.synchronize_batch(topic_name, batch)
+        return {"status": "batch_published", "count": batch.count, "first_offset": first_offset, **replication}
 
-    def fetch_messages(self, topic_name):
-        """Fetch all messages from a topic."""
+    def _not_leader(self, topic_name):
+        return {"status": "not_leader", "leader": self.catalog.get(topic_name).leader}
+
+    def _record_append(self, topic_name, batch):
+        """Account for a stored batch in the catalog and metrics. Called under the topic's lock."""
+        self.catalog.record_append(topic_name, batch)
+        self.topic_meters[topic_name].mark(batch.count)
+        if self.wal is not None and self.storage == "memory":
+            self.wal.append(topic_name, batch)
+
+    def record_truncate(self, topic_name, log, offset, messages):
+        """Account for messages truncated away from a topic's log. Called under the topic's lock."""
+        self.catalog.record_removal(topic_name, log, messages)
+        if self.wal is not None and self.storage == "memory":
+            self.wal.truncate(topic_name, offset)
+
+    def record_cleaning(self, topic_name, log, dropped, compacted):
+        """Account for messages the log cleaner dropped or compacted away. Called under the topic's lock."""
+        self.catalog.record_removal(topic_name, log, dropped + compacted)
+        if self.wal is not None and self.storage == "memory":
+            if dropped:
+                self.wal.retain(topic_name, log.start_offset)
+            if compacted:
+                self.wal.compact(topic_name, log.cleaned_offset)
+
+    def replicate_append(self, topic_name, base_offset, messages=None, batches=None):
+        """Apply messages or stored record batches streamed from the topic's leader.
+
+        Records the replica already has are skipped, so resent batches are
+        harmless. A request that starts past the local high watermark is
+        rejected with the high watermark the leader should resend from; gaps
+        between the batches of one request are offsets the leader no longer
+        has (compacted or past retention). Batches are stored exactly as the
+        leader sent them, unless only part of one is new. They are validated
+        first, like client batches, so no pickled value is ever taken from the network.
+        """
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        try:
+            for batch in batches or ():
+                batch.validate()
+        except CorruptRecordError as e:
+            return {"status": "invalid_request", "error": str(e)}
+        with topic_lock:
+            high_watermark = log.next_offset
+            if base_offset > high_watermark:
+                return {"status": "offset_gap", "high_watermark": high_watermark}
+            if batches is None:
+                new_messages = messages[high_watermark - base_offset:]
+                if new_messages:
+                    batches = [RecordBatch.build(high_watermark, new_messages,
+                                                 compression=log.config.get("compression"))]
+            for batch in batches or ():
+                if batch.next_offset <= log.next_offset:
+                    continue
+                if batch.base_offset < log.next_offset:
+                    records = [(key, message) for offset, key, message, _ in batch.records()
+                               if offset >= log.next_offset]
+                    keys = [key for key, _ in records]
+                    batch = RecordBatch.build(log.next_offset, [message for _, message in records],
+                                              keys if any(key is not None for key in keys) else None,
+                                              batch.timestamp, log.config.get("compression"))
+                log.append_batch(batch)
+                self._record_append(topic_name, batch)
+                fanout.stage_batch(batch)
+            high_watermark = log.next_offset
+        fanout.dispatch()
+        return {"status": "replicated", "high_watermark": high_watermark}
+
+    def fetch_messages(self, topic_name, from_offset=0, max_messages=DEFAULT_FETCH_MESSAGES,
+                       max_bytes=DEFAULT_FETCH_BYTES, batches=False, compression=None, min_messages=1, min_bytes=0,
+                       max_wait_ms=0, defer=False):
+        """Fetch one page of messages starting at `from_offset`.
+
+        The page holds at most `max_messages` messages and stops once
+        `max_bytes` is reached, but always contains at least one message when
+        any are available so a consumer can make progress. The response's
+        `next_offset` is the cursor for the following call.
+
+        With `batches` the page is a list of stored record batches instead,
+        sent as they are on disk (the first one may start before
+        `from_offset`). Batches stored uncompressed are compressed with
+        `compression` for this response if they are large enough to gain.
+
+        Reads do not take the topic lock: the page is a snapshot bounded by
+        the high watermark observed when the fetch started.
+
+        With `max_wait_ms` the fetch is a long poll. If fewer than
+        `min_messages` messages lie past `from_offset`, and fewer than
+        `min_bytes` bytes when that is set, the request is parked on the topic
+        until appends bring enough or `max_wait_ms` passes, then answered with
+        whatever is there. Parked fetches hold no thread; with `defer` the
+        ParkedFetch is returned for the connection handler to answer,
+        otherwise this call blocks until it completes.
+        """
+        log, _, fanout = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        if compression not in (None, *COMPRESSION_CODECS):
+            return {"status": "invalid_request", "error": f"Unknown compression '{compression}'"}
+        if max_wait_ms > 0:
+            start = max(log.start_offset, min(from_offset, log.next_offset))
+            ready = partial(self._fetch_ready, log, self.catalog.get(topic_name), start, min_messages, min_bytes)
+            if not ready():
+                read = partial(self.fetch_messages, topic_name, from_offset, max_messages, max_bytes, batches,
+                               compression)
+                fetch = ParkedFetch(ready, read, time.monotonic() + min(max_wait_ms, MAX_FETCH_WAIT_MS) / 1000)
+                self.parked_fetches.inc()
+                self.fetch_scheduler.park(fetch, fanout)
+                return fetch if defer else fetch.wait()
+        high_watermark = log.next_offset
+        from_offset = max(log.start_offset, min(from_offset, high_watermark))
+        if batches:
+            page, next_offset = log.read_batches(from_offset, max_bytes, end_offset=high_watermark)
+            if compression:
+                page = [batch.compress(compression) for batch in page]
+            return {
+                "status": "ok",
+                "topic": topic_name,
+                "batches": [batch.to_tuple() for batch in page],
+                "next_offset": next_offset,
+                "high_watermark": high_watermark,
+            }
+        page, next_offset = log.read(from_offset, max_messages, max_bytes, end_offset=high_watermark)
+        return {
+            "status": "ok",
+            "topic": topic_name,
+            "messages": page,
+            "next_offset": next_offset,
+            "high_watermark": high_watermark,
+        }
+
+    @staticmethod
+    def _fetch_ready(log, stats, from_offset, min_messages, min_bytes):
+        """Whether a long poll can be answered. Bytes are estimated from the topic's average stored message size."""
+        available = log.next_offset - from_offset
+        if min_messages and available >= min_messages:
+            return True
+        if min_bytes:
+            return (available > 0 and stats is not None and stats.messages > 0
+                    and available * stats.size_bytes / stats.messages >= min_bytes)
+        return not min_messages
+
+    def subscribe_to_topic(self, topic_name, subscriber_id, session=None, push=False, max_queue=1000,
+                           overflow_policy="drop_oldest"):
+        """Subscribe a user to a topic.
+
+        With `push`, new messages are delivered over the connection the
+        request arrived on through a bounded per-subscriber queue.
+        A `topic_name` with wildcard levels subscribes to a pattern.
+        """
+        if push and session is None:
+            return {"status": "push_requires_connection"}
+        if is_pattern(topic_name):
+            return self.subscribe_to_pattern(topic_name, subscriber_id, session, push, max_queue, overflow_policy)
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        queue = None
+        if push:
+            try:
+                queue = SubscriberQueue(topic_name, subscriber_id, max_queue, overflow_policy)
+            except ValueError as e:
+                return {"status": "invalid_request", "error": str(e)}
+        with topic_lock:
+            if self.wal is not None and subscriber_id not in self.subscribers[topic_name]:
+                self.wal.subscribe(topic_name, subscriber_id)
+            self.subscribers[topic_name].add(subscriber_id)
+            if queue is not None:
+                fanout.add(queue)
+            self._update_subscriber_count(fanout)
+        if queue is not None:
+            session.attach(queue)
+        return {"status": "subscribed", "topic": topic_name, "push": push}
+
+    def subscribe_to_pattern(self, pattern, subscriber_id, session=None, push=True, max_queue=1000,
+                             overflow_policy="drop_oldest"):
+        """Push new messages of every topic matching `pattern`, now or created later.
+
+        "*" matches one level of a dot-separated topic name and "#" any number
+        of levels, e.g. "metrics.*.cpu" or "logs.#". The subscription's queue is
+        attached to the fanout of each matching topic, found through the topic
+        trie, so publishing never looks at patterns.
+        """
+        error = validate_pattern(pattern)
+        if error:
+            return {"status": "invalid_request", "error": error}
+        if not push:
+            return {"status": "invalid_request", "error": "Pattern subscriptions need push"}
+        if session is None:
+            return {"status": "push_requires_connection"}
+        try:
+            queue = SubscriberQueue(pattern, subscriber_id, max_queue, overflow_policy, pattern=pattern)
+        except ValueError as e:
+            return {"status": "invalid_request", "error": str(e)}
+        with self.lock:
+            previous = self.pattern_index.remove(pattern, subscriber_id)
+            self.pattern_index.add(pattern, subscriber_id, queue)
+            matched = [(self.topic_locks[name], self.fanouts[name]) for name in self.topic_index.expand(pattern)]
+        for topic_lock, fanout in matched:
+            with topic_lock:
+                fanout.add_pattern(queue)
+                self._update_subscriber_count(fanout)
+        if previous is not None:
+            previous.close()
+        session.attach(queue)
+        return {"status": "subscribed", "topic": pattern, "push": True, "matched_topics": len(matched)}
+
+    def unsubscribe_from_pattern(self, pattern, subscriber_id):
         with self.lock:
-            return self.topics.get(topic_name, [])
+            queue = self.pattern_index.remove(pattern, subscriber_id)
+        if queue is None:
+            return {"status": "unsubscribed", "topic": pattern}
+        self._detach_pattern_queue(queue)
+        queue.close()
+        return {"status": "unsubscribed", "topic": pattern}
 
-    def subscribe_to_topic(self, topic_name, subscriber_id):
-        """Subscribe a user to a topic."""
+    def _detach_pattern_queue(self, queue):
         with self.lock:
-            if topic_name in self.subscribers:
-                if subscriber_id not in self.subscribers[topic_name]:
-                    self.subscribers[topic_name].append(subscriber_id)
-                return {"status": "subscribed", "topic": topic_name}
+            if self.pattern_index.get(queue.pattern).get(queue.subscriber_id) is queue:
+                self.pattern_index.remove(queue.pattern, queue.subscriber_id)
+            matched = [(self.topic_locks[name], self.fanouts[name]) for name in self.topic_index.expand(queue.pattern)]
+        for topic_lock, fanout in matched:
+            with topic_lock:
+                fanout.remove(queue)
+                self._update_subscriber_count(fanout)
+
+    def unsubscribe_from_topic(self, topic_name, subscriber_id):
+        """Remove a subscriber and stop pushing messages to it."""
+        if is_pattern(topic_name):
+            return self.unsubscribe_from_pattern(topic_name, subscriber_id)
+        log, topic_lock, fanout = self.get_topic(topic_name)
+        if log is None:
             return {"status": "topic_not_found"}
+        with topic_lock:
+            if self.wal is not None and subscriber_id in self.subscribers[topic_name]:
+                self.wal.unsubscribe(topic_name, subscriber_id)
+            self.subscribers[topic_name].discard(subscriber_id)
+            queue = fanout.queues.pop(subscriber_id, None)
+            self._update_subscriber_count(fanout)
+        if queue is not None:
+            queue.close()
+        return {"status": "unsubscribed", "topic": topic_name}
+
+    def _update_subscriber_count(self, fanout):
+        """Refresh a topic's subscriber count in the catalog. Called under the topic's lock."""
+        topic_name = fanout.topic_name
+        self.catalog.set_subscribers(topic_name, len(self.subscribers[topic_name]) + len(fanout.pattern_queues))
+
+    def detach_subscriber(self, queue):
+        """Drop a push queue whose connection has gone away."""
+        if queue.pattern is not None:
+            self._detach_pattern_queue(queue)
+            return
+        log, topic_lock, fanout = self.get_topic(queue.topic_name)
+        if log is not None:
+            with topic_lock:
+                fanout.remove(queue)
+
+    def join_group(self, group_id, topic_name, member_id=None, session_timeout=DEFAULT_SESSION_TIMEOUT):
+        """Add a member to a consumer group on a topic, starting a new generation.
+
+        Without a `member_id` one is assigned. The group shares the topic's
+        messages between its members through `group_fetch` and resumes from
+        its committed offset when it starts again.
+        """
+        log, _, _ = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        if self.strict_leadership and self.catalog.get(topic_name).leader != self.node_id:
+            return self._not_leader(topic_name)
+        group, member_id = self.groups.join(group_id, topic_name, member_id, session_timeout)
+        return {"status": "joined", "member_id": member_id, "generation": group.generation,
+                "members": len(group.members), "committed": group.committed}
+
+    def group_fetch(self, group_id, topic_name, member_id, commit=(), max_messages=DEFAULT_FETCH_MESSAGES,
+                    max_bytes=DEFAULT_FETCH_BYTES, max_wait_ms=0, defer=False):
+        """Commit a member's finished leases, then lease it the next range of the topic and return its messages.
+
+        The response's `lease` ([start, end]) is what the member commits once
+        it processed the messages, with its next fetch or `commit_offsets`.
+        A member the group dropped gets "unknown_member" and must join again.
+        With `max_wait_ms` an empty fetch is parked until messages arrive,
+        like a long-poll `fetch_messages`.
+        """
+        log, _, fanout = self.get_topic(topic_name)
+        group = self.groups.get(group_id, topic_name)
+        if log is None or group is None:
+            return {"status": "topic_not_found" if log is None else "unknown_member"}
+        with group.lock:
+            group.expire()
+            if not group.touch(member_id):
+                return {"status": "unknown_member", "generation": group.generation}
+            refused = group.commit(member_id, commit)
+            if max_wait_ms > 0 and not group.has_work(log):
+                read = partial(self.group_fetch, group_id, topic_name, member_id, (), max_messages, max_bytes)
+                fetch = ParkedFetch(partial(group.has_work, log), read,
+                                    time.monotonic() + min(max_wait_ms, MAX_FETCH_WAIT_MS) / 1000)
+            else:
+                fetch = None
+                lease = group.lease(member_id, log, max_messages, max_bytes)
+        if fetch is not None:
+            self.parked_fetches.inc()
+            self.fetch_scheduler.park(fetch, fanout)
+            return fetch if defer else fetch.wait()
+        return {
+            "status": "ok",
+            "topic": topic_name,
+            "messages": lease[2] if lease else [],
+            "lease": list(lease[:2]) if lease and lease[2] else None,
+            "generation": group.generation,
+            "committed": group.committed,
+            "refused": refused,
+            "high_watermark": log.next_offset,
+        }
+
+    def commit_offsets(self, group_id, topic_name, member_id, ranges):
+        """Mark a member's leased ranges as processed. Leases it lost to a rebalance are refused."""
+        group = self.groups.get(group_id, topic_name)
+        if group is None:
+            return {"status": "unknown_member"}
+        with group.lock:
+            group.expire()
+            if not group.touch(member_id):
+                return {"status": "unknown_member", "generation": group.generation}
+            refused = group.commit(member_id, ranges)
+        return {"status": "committed", "committed": group.committed, "refused": refused,
+                "generation": group.generation}
+
+    def leave_group(self, group_id, topic_name, member_id, commit=()):
+        """Commit a member's finished leases and remove it; what it still held goes to the other members."""
+        group = self.groups.get(group_id, topic_name)
+        if group is None:
+            return {"status": "unknown_member"}
+        with group.lock:
+            group.commit(member_id, commit)
+            group.leave(member_id)
+        return {"status": "left", "committed": group.committed, "generation": group.generation}
+
+    def group_stats(self, topic_name=None):
+        """Members, generation, committed offset and lag of the consumer groups on this node."""
+        groups = []
+        for group in self.groups.groups_of(topic_name):
+            log, _, _ = self.get_topic(group.topic_name)
+            with group.lock:
+                group.expire()
+                groups.append(group.stats(log))
+        return {"status": "ok", "groups": groups}
+
+    def subscriber_stats(self, topic_name=None):
+        """Return queue depth and lag metrics for push subscribers."""
+        with self.lock:
+            fanouts = dict(self.fanouts) if topic_name is None else {topic_name: self.fanouts.get(topic_name)}
+        if None in fanouts.values():
+            return {"status": "topic_not_found"}
+        return {"status": "ok", "subscribers": {name: fanout.metrics() for name, fanout in fanouts.items()}}
+
+    def list_topics(self, prefix="", cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of topic stats from the catalog, for topics whose names start with `prefix`.
+
+        Pass the response's `next_cursor` back as `cursor` for the next page;
+        it is None once every matching topic was listed.
+        """
+        topics, next_cursor = self.catalog.list(prefix, cursor, limit)
+        return {"status": "ok", "topics": topics, "next_cursor": next_cursor}
+
+    def metadata(self, topics=()):
+        """Nodes as [id, host, port, status] and the placement of those of `topics` held here.
+
+        Addresses are the ones nodes advertise in gossip, so clients reach
+        them directly even where peers are configured to go through proxies.
+        A replica knows a topic's leader but not the other replicas. Those of
+        `topics` that are partitioned are listed under "partitions" with the
+        leader of each partition.
+        """
+        membership = self.node_manager.membership()
+        advertised = self.gossiper.addresses()
+        nodes = []
+        for peer_id, ip, port in self.peer_list:
+            if peer_id == self.node_id:
+                nodes.append([peer_id, self.gossiper.host, self.port, "online"])
+                continue
+            ip, port = advertised.get(peer_id, (ip, port))
+            nodes.append([peer_id, ip, port, membership.get(peer_id, {}).get("status", "online")])
+        placements = {}
+        for topic_name in topics:
+            stats = self.catalog.get(topic_name)
+            if stats is not None:
+                placements[topic_name] = {"leader": stats.leader, "replicas": list(stats.replicas)}
+        partitioned = {topic_name: self.partitioned[topic_name] for topic_name in topics
+                       if topic_name in self.partitioned}
+        return {"status": "ok", "node_id": self.node_id, "nodes": nodes, "topics": placements,
+                "partitions": partitioned}
+
+    def stats(self, format="json"):
+        """This node's metrics: a snapshot dict, or Prometheus text with `format` "prometheus"."""
+        if format == "prometheus":
+            return {"status": "ok", "text": self.metrics.prometheus_text()}
+        return {"status": "ok", "node_id": self.node_id, "uptime_s": time.time() - self.metrics.started,
+                "metrics": self.metrics.snapshot()}
+
+    def collect_gauges(self):
+        """Gauges read from live state when metrics are collected: replication lag and subscriber queues."""
+        gauges = [("topics", {}, len(self.catalog))]
+        if self.wal is not None:
+            gauges.append(("wal_bytes", {}, self.wal.size_bytes))
+        for topic_name, replicas in self.replication_manager.replica_status().items():
+            for peer_id, status in replicas.items():
+                labels = {"topic": topic_name, "replica": peer_id}
+                gauges.append(("replication_lag_messages", labels, status["lag_messages"]))
+                gauges.append(("replication_lag_ms", labels, status["lag_ms"]))
+        with self.lock:
+            fanouts = list(self.fanouts.values())
+        for fanout in fanouts:
+            for subscriber, metrics in fanout.metrics().items():
+                labels = {"topic": fanout.topic_name, "subscriber": subscriber}
+                gauges.append(("subscriber_queue_depth", labels, metrics["queue_depth"]))
+                gauges.append(("subscriber_lag_messages", labels, metrics["lag_messages"]))
+        return gauges
+
+    def topic_offsets(self):
+        """Offsets and placement of every topic, for a rejoining peer to diff against.
+
+        Placement is what this node's catalog records: the leader, and on the
+        leader the replicas it streams to.
+        """
+        with self.lock:
+            topics = dict(self.topics)
+        offsets = {}
+        for name, log in topics.items():
+            stats = self.catalog.get(name)
+            offsets[name] = {"start_offset": log.start_offset, "high_watermark": log.next_offset,
+                             "leader": stats.leader, "replicas": list(stats.replicas)}
+        return {"status": "ok", "topics": offsets}
+
+    def topic_digests(self, topic_name, from_offset, end_offset, range_size=DEFAULT_RANGE_SIZE):
+        """Range digests of a topic, so a peer can find where its copy diverged."""
+        log, _, _ = self.get_topic(topic_name)
+        if log is None:
+            return {"status": "topic_not_found"}
+        end_offset = min(end_offset, log.next_offset)
+        return {"status": "ok", "digests": range_digests(log, from_offset, end_offset, range_size)}
+
+    def start_catch_up(self):
+        """Catch up with every peer in the background, e.g. right after a restart."""
+        self.anti_entropy.start()
+
+    def on_peer_recovered(self, node_id):
+        """A peer came back: pull whatever it holds that this node is missing."""
+        peers = [peer for peer in self.peer_list if peer[0] == node_id]
+        if peers:
+            self.anti_entropy.start(peers)
+            threading.Thread(target=self._send_partition_maps, args=(peers[0],), daemon=True).start()
+
+    def _send_partition_maps(self, peer):
+        """Tell a peer that was away about every partitioned topic."""
+        for topic_name, leaders in list(self.partitioned.items()):
+            self.send_partition_map(peer, topic_name, leaders)
+
+    def update_peers(self, peer_list):
+        """Apply a new cluster membership and move only the topics whose placement changes."""
+        self.peer_list = peer_list
+        self.gossiper.set_peers(peer_list)
+        with self.node_manager.lock:
+            for peer_id, _, _ in peer_list:
+                self.node_manager.nodes.setdefault(peer_id, "online")
+        plan = self.replication_manager.rebalance(peer_list)
+        for topic_name in plan:
+            self._record_placement(topic_name)
+        return {"status": "rebalanced", "moved_topics": len(plan),
+                "moves": {topic: move["new"] for topic, move in plan.items()}}
+
+    def get_peer_connection(self, peer_id, ip, port):
+        """Return the long-lived connection to a peer, creating it on first use."""
+        with self.lock:
+            connection = self.peer_connections.get(peer_id)
+            if connection is None:
+                connection = Connection(ip, port, timeout=2)
+                self.peer_connections[peer_id] = connection
+        return connection
 
     def start_heartbeat_sender(self):
-        """Send heartbeats to other peers."""
-        def send_heartbeat():
-            while True:
-                for peer_id, ip, port in self.peer_list:
-                    try:
-                        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                            client.connect((ip, port))
-                            client.send(pickle.dumps({"action": "heartbeat", "node_id": self.node_id}))
-                    except ConnectionError:
-                        pass
-                time.sleep(3)
+        """Gossip heartbeats to peers over UDP and watch them with the phi-accrual detector."""
+        self.gossiper.start()
+        self.node_manager.start_heartbeat_monitor()
+
 
-        threading.Thread(target=send_heartbeat, daemon=True).start()
+def parse_peer(value):
+    """'2:localhost:5002' -> (2, 'localhost', 5002)"""
+    node_id, ip, port = value.split(":")
+    return int(node_id), ip, int(port)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a pub/sub peer node. Prompts for the basics if --node-id is not given.")
+    parser.add_argument("--node-id", type=int)
+    parser.add_argument("--port", type=int, help="TCP port for clients and peers, and UDP port for gossip")
+    parser.add_argument("--peers", type=parse_peer, nargs="+", metavar="ID:HOST:PORT",
+                        help="Cluster members, this node included (default: nodes 1-8 on ports 5001-5008)")
+    parser.add_argument("--server-mode", choices=SERVER_MODES, default="threaded")
+    parser.add_argument("--storage", choices=STORAGE_BACKENDS, default="memory")
+    parser.add_argument("--data-dir")
+    parser.add_argument("--replication-factor", type=int, default=2)
+    parser.add_argument("--consistency-model", choices=("strong", "eventual"), default="strong")
+    parser.add_argument("--write-quorum", type=int, default=1)
+    parser.add_argument("--gossip-interval", type=float, default=1.0, help="Seconds between heartbeat rounds")
+    parser.add_argument("--phi-threshold", type=float, default=8.0, help="Suspicion level that marks a peer offline")
+    parser.add_argument("--allow-replica-writes", action="store_true",
+                        help="Accept publishes to topics this node only replicates instead of answering not_leader; "
+                             "its copy then diverges from the leader's")
+    parser.add_argument("--metrics-port", type=int)
+    parser.add_argument("--wal", action="store_true",
+                        help="Log changes to a write-ahead log with snapshots under the data directory, so a "
+                             "restarted node recovers its own state")
+    parser.add_argument("--snapshot-interval", type=float, default=300.0, help="Seconds between snapshots")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     print("Welcome to the Peer-to-Peer Pub/Sub System")
 
-    node_id = int(input("Enter your node ID (e.g., 1, 2, 3, ...): "))
-    port = int(input("Enter the port number (e.g., 5001, 5002, ...): "))
+    if args.node_id is None:
+        args.node_id = int(input("Enter your node ID (e.g., 1, 2, 3, ...): "))
+        args.port = int(input("Enter the port number (e.g., 5001, 5002, ...): "))
+        args.server_mode = input("Enter the server mode (threaded/asyncio, default: threaded): ").strip() or "threaded"
+        args.storage = input("Enter the storage backend (memory/disk, default: memory): ").strip() or "memory"
+    if args.port is None:
+        args.port = 5000 + args.node_id
 
-    peer_list = [(i, 'localhost', 5000 + i) for i in range(1, 9)]
+    peer_list = args.peers or [(i, 'localhost', 5000 + i) for i in range(1, 9)]
 
-    node = PeerNode(node_id=node_id, port=port, peer_list=peer_list)
+    node = PeerNode(node_id=args.node_id, port=args.port, peer_list=peer_list, server_mode=args.server_mode,
+                    storage=args.storage, data_dir=args.data_dir, consistency_model=args.consistency_model,
+                    replication_factor=args.replication_factor, write_quorum=args.write_quorum,
+                    gossip_options={"interval": args.gossip_interval},
+                    membership_options={"phi_threshold": args.phi_threshold}, metrics_port=args.metrics_port,
+                    strict_leadership=not args.allow_replica_writes,
+                    wal_options={"snapshot_interval": args.snapshot_interval} if args.wal else None)
     node.start_server()
+    node.start_catch_up()
     node.start_heartbeat_sender()
 
     while True:
         time.sleep(1)
-
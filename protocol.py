@@ -0,0 +1,315 @@
+import itertools
+import socket
+import struct
+import threading
+from codec import BINARY, CODEC_IDS, CODECS, CodecError
+
+# Every frame is a fixed header followed by the encoded payload:
+#   4 bytes payload length | 8 bytes request id | payload
+HEADER = struct.Struct("!IQ")
+PUSH_ID = 0  # Request id used for server-initiated frames (notifications, handshake)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# The first frame on a connection negotiates the payload codec. The client
+# sends id 0 with HANDSHAKE_MAGIC, a version byte, a count and the codec ids it
+# accepts in order of preference; the server answers with HANDSHAKE_MAGIC and
+# the id it picked (0: none acceptable, the connection is closed).
+HANDSHAKE_MAGIC = b"PSUB"
+HANDSHAKE_VERSION = 1
+DEFAULT_CODECS = ("binary",)
+
+
+class ProtocolError(ConnectionError):
+    """Raised when a peer sends a malformed or oversized frame."""
+
+
+def recv_exact(sock, size):
+    """Read exactly `size` bytes, or return None if the peer closed cleanly."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            if received == 0:
+                return None
+            raise ProtocolError("Connection closed in the middle of a frame")
+        received += count
+    return buffer
+
+
+def decode_payload(payload, codec=BINARY):
+    """Deserialize the payload of a received frame."""
+    try:
+        return codec.decode(payload)
+    except CodecError as e:
+        raise ProtocolError(str(e)) from e
+
+
+def parse_header(header):
+    """Return (payload_length, request_id) from a frame header, validating its size."""
+    length, request_id = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return length, request_id
+
+
+def encode_frame(request_id, obj, codec=BINARY):
+    """Serialize a payload into a length-prefixed frame."""
+    payload = codec.encode(obj)
+    return HEADER.pack(len(payload), request_id) + payload
+
+
+def encode_response(request_id, response, codec=BINARY):
+    """Frame a response, replacing one the codec cannot represent with an error response."""
+    try:
+        return encode_frame(request_id, response, codec)
+    except CodecError as e:
+        return encode_frame(request_id, {"status": "encoding_error", "error": str(e)}, codec)
+
+
+def send_frame(sock, request_id, obj, codec=BINARY):
+    """Send one framed payload."""
+    sock.sendall(encode_frame(request_id, obj, codec))
+
+
+def recv_raw_frame(sock):
+    """Receive one frame without decoding it. Returns (request_id, payload) or None on EOF."""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, request_id = parse_header(header)
+    payload = recv_exact(sock, length) if length else bytearray()
+    if payload is None:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return request_id, payload
+
+
+def recv_frame(sock, codec=BINARY):
+    """Receive one frame. Returns (request_id, payload) or None on EOF."""
+    frame = recv_raw_frame(sock)
+    if frame is None:
+        return None
+    return frame[0], decode_payload(frame[1], codec)
+
+
+def hello_frame(codecs=DEFAULT_CODECS):
+    """The client's first frame, offering `codecs` in order of preference."""
+    payload = HANDSHAKE_MAGIC + bytes([HANDSHAKE_VERSION, len(codecs)]) + bytes(CODECS[name].codec_id
+                                                                               for name in codecs)
+    return HEADER.pack(len(payload), PUSH_ID) + payload
+
+
+def is_hello(request_id, payload):
+    return request_id == PUSH_ID and bytes(payload[:len(HANDSHAKE_MAGIC)]) == HANDSHAKE_MAGIC
+
+
+def accept_hello(payload, allowed):
+    """Server side of the handshake: (codec or None, reply frame) for a client's hello payload."""
+    offered = bytes(payload[len(HANDSHAKE_MAGIC) + 2:])
+    codec = next((CODEC_IDS[codec_id] for codec_id in offered
+                  if codec_id in CODEC_IDS and CODEC_IDS[codec_id].name in allowed), None)
+    reply = HANDSHAKE_MAGIC + bytes([codec.codec_id if codec else 0])
+    return codec, HEADER.pack(len(reply), PUSH_ID) + reply
+
+
+def client_handshake(sock, codecs=DEFAULT_CODECS):
+    """Negotiate the payload codec on a freshly connected blocking socket and return it."""
+    sock.sendall(hello_frame(codecs))
+    frame = recv_raw_frame(sock)
+    if frame is None or not is_hello(*frame) or len(frame[1]) != len(HANDSHAKE_MAGIC) + 1:
+        raise ProtocolError("Codec negotiation failed: unexpected handshake reply")
+    codec = CODEC_IDS.get(frame[1][-1])
+    if codec is None or codec.name not in codecs:
+        raise ProtocolError(f"Codec negotiation failed: the server accepts none of {codecs}")
+    return codec
+
+
+def message_size(message):
+    """Approximate the encoded size of a message for batching and paging decisions."""
+    if isinstance(message, (str, bytes, bytearray)):
+        return len(message)
+    return len(repr(message))
+
+
+def configure_socket(sock):
+    """Tune a connected socket for small, latency-sensitive frames."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class PendingResponse:
+    """Handle for a request whose response has not arrived yet."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self._event = threading.Event()
+        self._response = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def set_result(self, response):
+        self._response = response
+        self._finish()
+
+    def set_error(self, error):
+        self._error = error
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call `callback(pending)` once the response or an error arrives."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        """Return the response of a finished request, raising its error if it failed."""
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the response arrives and return it."""
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"No response to request {self.request_id} within {timeout}s")
+        return self.result()
+
+
+class Connection:
+    """Persistent, multiplexed connection to a peer node.
+
+    Requests are tagged with a request id so many of them can be in flight on
+    the same socket. A background reader thread matches responses to their
+    requests and hands server-initiated frames to `on_push`.
+    """
+
+    def __init__(self, host, port, timeout=5.0, on_push=None, codecs=DEFAULT_CODECS):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.on_push = on_push
+        self.codecs = codecs  # Offered in the handshake, most preferred first
+        self.codec = None  # Negotiated on connect
+        self.sock = None
+        self.pending = {}  # {request_id: PendingResponse}
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()  # Guards the socket reference and the pending map
+        self.connect_lock = threading.Lock()
+        self.send_lock = threading.Lock()  # Keeps frames from interleaving
+
+    def connect(self):
+        """Open the socket if it is not already connected."""
+        with self.connect_lock:
+            if self.sock is not None:
+                return
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                raise ConnectionError(f"Cannot connect to {self.host}:{self.port}: {e}") from e
+            try:
+                configure_socket(sock)
+                self.codec = client_handshake(sock, self.codecs)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError(f"Handshake with {self.host}:{self.port} failed: {e}") from e
+            sock.settimeout(None)
+            with self.lock:
+                self.sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+    def send(self, request, wait=True):
+        """Send a request without blocking for its response.
+
+        Returns a PendingResponse, or None when `wait` is False and the
+        response should simply be discarded.
+        """
+        self.connect()
+        request_id = next(self.request_ids)
+        pending = None
+        if wait:
+            pending = PendingResponse(request_id)
+            with self.lock:
+                self.pending[request_id] = pending
+        sock = self.sock
+        try:
+            frame = encode_frame(request_id, request, self.codec)
+        except CodecError:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise
+        try:
+            if sock is None:
+                raise ConnectionError(f"Connection to {self.host}:{self.port} is closed")
+            with self.send_lock:
+                sock.sendall(frame)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            self._fail(sock, e)
+            raise ConnectionError(f"Failed to send to {self.host}:{self.port}: {e}") from e
+        return pending
+
+    def request(self, request, timeout=None):
+        """Send a request and wait for its response."""
+        pending = self.send(request)
+        try:
+            return pending.wait(self.timeout if timeout is None else timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(pending.request_id, None)
+
+    def close(self):
+        """Close the socket and fail any outstanding requests."""
+        self._fail(self.sock, ConnectionError("Connection closed"))
+
+    def _read_loop(self, sock):
+        codec = self.codec
+        try:
+            while True:
+                frame = recv_frame(sock, codec)
+                if frame is None:
+                    break
+                request_id, response = frame
+                if request_id == PUSH_ID:
+                    if self.on_push is not None:
+                        self.on_push(response)
+                    continue
+                with self.lock:
+                    pending = self.pending.pop(request_id, None)
+                if pending is not None:
+                    pending.set_result(response)
+        except OSError as e:
+            self._fail(sock, e)
+            return
+        self._fail(sock, ConnectionError(f"Connection to {self.host}:{self.port} closed by peer"))
+
+    def _fail(self, sock, error):
+        with self.lock:
+            if sock is None or sock is not self.sock:
+                return
+            self.sock = None
+            pending, self.pending = self.pending, {}
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # close() alone leaves the socket open while the reader is in recv
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if not isinstance(error, ConnectionError):
+            error = ConnectionError(str(error))
+        for waiter in pending.values():
+            waiter.set_error(error)
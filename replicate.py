@@ -1,25 +1,510 @@
+import logging
+import os
 import random
+import threading
 import time
+from collections import deque
+from urllib.parse import quote
+from hash_ring import DEFAULT_VNODES, HashRing, plan_rebalance
+from protocol import Connection
+from storage import BATCH_HEADER, RecordBatch
+
+CONSISTENCY_MODELS = ("strong", "eventual")
+SPILL_POLICIES = ("disk", "drop")
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaQueue:
+    """Bounded FIFO of record batches waiting to be sent to one replica.
+
+    Batches are queued exactly as the leader stored them, so compressed
+    batches are never recompressed on their way to a replica. At most
+    `max_messages` messages are held in memory. Beyond that, the "disk" spill
+    policy appends batches to `spill_path` (up to `max_spill_bytes`) and reads
+    them back once memory drains; the "drop" policy discards them. Dropped
+    batches are not lost for the replica: the stream reads any gap back from
+    the leader's log.
+    """
+
+    def __init__(self, spill_path=None, max_messages=100000, spill_policy="disk", max_spill_bytes=1024 ** 3):
+        if spill_policy not in SPILL_POLICIES:
+            raise ValueError(f"Unknown spill policy '{spill_policy}', expected one of {SPILL_POLICIES}")
+        self.spill_path = spill_path
+        self.max_messages = max_messages
+        self.spill_policy = spill_policy
+        self.max_spill_bytes = max_spill_bytes
+        self.memory = deque()  # [RecordBatch]
+        self.memory_messages = 0
+        self.spill_file = None
+        self.spill_read_pos = 0
+        self.spill_write_pos = 0
+        self.spill_entries = 0
+        self.spilled_messages = 0
+        self.dropped_messages = 0
+
+    def __len__(self):
+        return self.memory_messages + self.spilled_messages
+
+    def put(self, batch):
+        if not self.spill_entries and self.memory_messages + batch.count <= self.max_messages:
+            self.memory.append(batch)
+            self.memory_messages += batch.count
+        elif self.spill_policy == "disk" and self.spill_path and self.spill_write_pos < self.max_spill_bytes:
+            self._spill(batch)
+        else:
+            self.dropped_messages += batch.count
+
+    def head_offset(self):
+        """Base offset of the oldest queued batch, or None when empty."""
+        if not self.memory:
+            self._refill()
+        return self.memory[0].base_offset if self.memory else None
+
+    def discard_before(self, offset):
+        """Drop batches that lie entirely below `offset`, which the replica already has."""
+        while self.head_offset() is not None and self.memory[0].next_offset <= offset:
+            self.memory_messages -= self.memory.popleft().count
+
+    def take(self, offset, limit):
+        """Remove and return contiguous batches from the head, the first one holding `offset`.
+
+        Stops before exceeding `limit` messages, but always takes one batch.
+        """
+        taken = []
+        count = 0
+        while self.head_offset() is not None:
+            batch = self.memory[0]
+            if taken:
+                if batch.base_offset != taken[-1].next_offset or count + batch.count > limit:
+                    break
+            elif not batch.base_offset <= offset < batch.next_offset:
+                break
+            self.memory.popleft()
+            self.memory_messages -= batch.count
+            taken.append(batch)
+            count += batch.count
+        return taken
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_messages = 0
+        self._remove_spill()
+
+    def _spill(self, batch):
+        if self.spill_file is None:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            self.spill_file = open(self.spill_path, "w+b")
+        data = batch.encode()
+        self.spill_file.seek(self.spill_write_pos)
+        self.spill_file.write(data)
+        self.spill_write_pos += len(data)
+        self.spill_entries += 1
+        self.spilled_messages += batch.count
+
+    def _refill(self):
+        """Move spilled batches back into memory, oldest first."""
+        while self.spill_entries and self.memory_messages < self.max_messages:
+            self.spill_file.seek(self.spill_read_pos)
+            header = self.spill_file.read(BATCH_HEADER.size)
+            base_offset, length, _, count, timestamp, attributes = BATCH_HEADER.unpack(header)
+            payload = self.spill_file.read(length)
+            self.spill_read_pos += BATCH_HEADER.size + length
+            self.spill_entries -= 1
+            self.spilled_messages -= count
+            self.memory.append(RecordBatch(base_offset, count, payload, timestamp, attributes))
+            self.memory_messages += count
+        if not self.spill_entries and self.spill_file is not None:
+            self._remove_spill()
+
+    def _remove_spill(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+        self.spill_read_pos = self.spill_write_pos = 0
+        self.spill_entries = self.spilled_messages = 0
+
+
+class ReplicaStream:
+    """Replicates one topic to one replica over a dedicated persistent connection.
+
+    Appended record batches wait in a bounded ReplicaQueue and a background
+    sender groups adjacent ones into requests of up to `max_batch_messages`
+    and pipelines up to `max_in_flight` requests waiting for an ack. Batches
+    go out exactly as the leader stored them, compressed or not. Failed
+    connections are retried with jittered exponential backoff. The leader's log is the source of truth: anything
+    that is no longer queued (after a reconnect, or when the replica turns
+    out to be behind) is read back from it.
+    """
+
+    def __init__(self, manager, topic, peer):
+        self.manager = manager
+        self.topic = topic
+        self.peer_id, ip, port = peer
+        self.connection = Connection(ip, port, timeout=manager.connect_timeout)
+        spill_path = None
+        if manager.spill_dir:
+            spill_path = os.path.join(manager.spill_dir, f"{quote(topic, safe='')}.{self.peer_id}.spill")
+        self.queue = ReplicaQueue(spill_path, manager.max_queue_messages, manager.spill_policy)
+        self.in_flight = deque()  # [(from_offset, end_offset)] sent, not acknowledged yet
+        self.append_times = deque()  # [(end_offset, appended_at)] of unacknowledged appends, for lag in ms
+        self.acked_offset = None  # High watermark the replica has confirmed
+        self.next_send_offset = None
+        self.state = "connecting"  # "connecting", "online", "offline" or "rejected" (the replica refused a batch)
+        self.epoch = 0  # Bumped on every reset so acks for abandoned batches are ignored
+        self.retry_delay = manager.retry_backoff_min
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, batch):
+        """Queue a freshly appended batch for sending."""
+        with self.condition:
+            self.queue.put(batch)
+            if len(self.append_times) < 10000:
+                self.append_times.append((batch.next_offset, time.monotonic()))
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+        self.connection.close()
+
+    def status(self):
+        """Replica lag in messages and milliseconds."""
+        log = self.manager.get_log(self.topic)
+        high_watermark = log.next_offset if log is not None else 0
+        with self.condition:
+            acked = self.acked_offset or 0
+            lag_messages = max(0, high_watermark - acked)
+            oldest = self.append_times[0][1] if self.append_times and lag_messages else None
+            return {
+                "state": self.state,
+                "acked_offset": self.acked_offset,
+                "in_flight_batches": len(self.in_flight),
+                "queued_messages": len(self.queue),
+                "spilled_messages": self.queue.spilled_messages,
+                "dropped_from_queue": self.queue.dropped_messages,
+                "lag_messages": lag_messages,
+                "lag_ms": 0.0 if oldest is None else (time.monotonic() - oldest) * 1000,
+            }
+
+    def _run(self):
+        while not self.closed:
+            if self.state == "rejected":
+                with self.condition:
+                    self.condition.wait(self.manager.retry_backoff_max)  # Resending at once would be refused again
+            if self.state != "online" and not self._handshake():
+                self._backoff()
+                continue
+            with self.condition:
+                while not self.closed and self.state == "online" and not self._has_work():
+                    self.condition.wait(0.5)
+                if self.closed or self.state != "online":
+                    continue
+                batches = self._next_batches()
+                epoch = self.epoch
+                if batches:
+                    # The request covers everything from here, including offsets compacted or retained away
+                    base_offset = min(self.next_send_offset, batches[0].base_offset)
+                    self.in_flight.append((base_offset, batches[-1].next_offset))
+                    self.next_send_offset = batches[-1].next_offset
+                else:
+                    # The log changed under the stream, e.g. a truncation: learn the replica's offset again
+                    self.epoch += 1
+                    self.state = "connecting"
+                    self.in_flight.clear()
+            if not batches:
+                logger.info("Replica stream for topic '%s' to node %s found nothing to send at offset %s; "
+                            "resynchronizing.", self.topic, self.peer_id, self.next_send_offset)
+                self._backoff()
+                continue
+            try:
+                pending = self.connection.send({
+                    "action": "replicate_append",
+                    "topic_name": self.topic,
+                    "base_offset": base_offset,
+                    "batches": [batch.to_tuple() for batch in batches],
+                    "leader": self.manager.node_id,
+                })
+            except ConnectionError:
+                self._reset(epoch)
+                continue
+            pending.add_done_callback(lambda response, epoch=epoch: self._on_ack(response, epoch))
+
+    def _has_work(self):
+        log = self.manager.get_log(self.topic)
+        return (log is not None and len(self.in_flight) < self.manager.max_in_flight
+                and self.next_send_offset < log.next_offset)
+
+    def _next_batches(self):
+        """Stored batches from `next_send_offset` on, from the queue when possible, else from the log.
+
+        Offsets retention already dropped are skipped. Empty if the log no
+        longer holds anything to send from there.
+        """
+        log = self.manager.get_log(self.topic)
+        if log is None:
+            return []
+        offset = max(self.next_send_offset, log.start_offset)
+        self.queue.discard_before(offset)
+        head = self.queue.head_offset()
+        if head is not None and head <= offset:
+            batches = self.queue.take(offset, self.manager.max_batch_messages)
+            if batches:
+                return batches
+            head = None  # The queued batches do not hold `offset`: read past them from the log
+        batches, _ = log.read_batches(offset, max_bytes=self.manager.max_batch_bytes, end_offset=head)
+        return batches
+
+    def _handshake(self):
+        """Make sure the topic exists on the replica and learn how far it has got."""
+        try:
+            log = self.manager.get_log(self.topic)
+            response = self.connection.request({
+                "action": "create_topic",
+                "topic_name": self.topic,
+                "replica_of": self.manager.node_id,
+                "config": log.config if log is not None else {},
+            })
+        except (ConnectionError, TimeoutError) as e:
+            logger.debug("Replica stream for topic '%s' to node %s cannot connect: %s", self.topic, self.peer_id, e)
+            with self.condition:
+                self.state = "offline"
+            self.manager.notify_ack(self.topic)
+            return False
+        with self.condition:
+            self.epoch += 1
+            self.acked_offset = response.get("high_watermark", 0)
+            self.next_send_offset = self.acked_offset
+            self.in_flight.clear()
+            self.queue.discard_before(self.acked_offset)
+            self.state = "online"
+            self.retry_delay = self.manager.retry_backoff_min
+        logger.info("Replica stream for topic '%s' to node %s is online at offset %s.", self.topic, self.peer_id,
+                    self.acked_offset)
+        self.manager.notify_ack(self.topic)
+        return True
+
+    def _on_ack(self, pending, epoch):
+        try:
+            response = pending.result()
+        except ConnectionError:
+            self._reset(epoch)
+            return
+        with self.condition:
+            if epoch != self.epoch:
+                return
+            status = response.get("status")
+            if status == "replicated":
+                self.acked_offset = max(self.acked_offset, response["high_watermark"])
+                if self.in_flight:
+                    self.in_flight.popleft()
+                while self.append_times and self.append_times[0][0] <= self.acked_offset:
+                    self.append_times.popleft()
+            elif status == "offset_gap":
+                # The replica is behind the batch we sent: rewind and resend from its high watermark
+                self.epoch += 1
+                self.acked_offset = response["high_watermark"]
+                self.next_send_offset = self.acked_offset
+                self.in_flight.clear()
+            else:
+                if status == "invalid_request":
+                    logger.error("Node %s refused batches of topic '%s': %s", self.peer_id, self.topic,
+                                 response.get("error"))
+                self.epoch += 1
+                self.state = "rejected" if status == "invalid_request" else "connecting"
+                self.in_flight.clear()
+            self.condition.notify_all()
+        self.manager.notify_ack(self.topic)
+
+    def _reset(self, epoch):
+        with self.condition:
+            if epoch != self.epoch:
+                return
+            self.epoch += 1
+            self.state = "offline"
+            self.in_flight.clear()
+            self.condition.notify_all()
+        self.connection.close()
+        self.manager.notify_ack(self.topic)
+
+    def _backoff(self):
+        with self.condition:
+            if not self.closed:
+                self.condition.wait(self.retry_delay * random.uniform(0.5, 1.0))
+            self.retry_delay = min(self.retry_delay * 2, self.manager.retry_backoff_max)
+
 
 class ReplicationManager:
-    def __init__(self, replication_factor=2, consistency_model="strong"):
+    def __init__(self, node_id=None, replication_factor=2, consistency_model="strong", write_quorum=1,
+                 ack_timeout=1.0, get_log=None, max_batch_messages=1000, max_batch_bytes=1024 * 1024, max_in_flight=8,
+                 connect_timeout=1.0, retry_backoff_min=0.05, retry_backoff_max=5.0, max_queue_messages=100000,
+                 spill_policy="disk", spill_dir=None, vnodes=DEFAULT_VNODES, weights=None):
+        if consistency_model not in CONSISTENCY_MODELS:
+            raise ValueError(f"Unknown consistency model '{consistency_model}', expected one of {CONSISTENCY_MODELS}")
+        self.node_id = node_id
         self.replication_factor = replication_factor
         self.consistency_model = consistency_model  # "strong" or "eventual"
+        self.write_quorum = write_quorum  # Replica acks a strong publish waits for
+        self.ack_timeout = ack_timeout
+        self.get_log = get_log or (lambda topic: None)  # Returns the leader's log for a topic
+        self.max_batch_messages = max_batch_messages
+        self.max_batch_bytes = max_batch_bytes  # Bound on batches read back from the log per request
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.retry_backoff_min = retry_backoff_min
+        self.retry_backoff_max = retry_backoff_max
+        self.max_queue_messages = max_queue_messages  # Per replica, before spilling
+        self.spill_policy = spill_policy  # "disk" or "drop" once a replica queue is full
+        self.spill_dir = spill_dir
+        self.weights = weights or {}  # {node_id: ring weight}, default 1
+        self.ring = HashRing(vnodes=vnodes)
+        self.peers = {}  # {peer_id: (peer_id, ip, port)} on the ring
+        if node_id is not None:
+            self.ring.add_node(node_id, self.weights.get(node_id, 1))
         self.topic_replicas = {}  # {topic_name: [peer_list]}
+        self.streams = {}  # {topic_name: [ReplicaStream]}
+        self.ack_conditions = {}  # {topic_name: Condition} notified whenever a replica acks
+        self.lock = threading.Lock()
+
+    def _build_ring(self, peer_list):
+        ring = HashRing(vnodes=self.ring.vnodes)
+        if self.node_id is not None:
+            ring.add_node(self.node_id, self.weights.get(self.node_id, 1))
+        for peer in peer_list:
+            if peer[0] not in ring:
+                ring.add_node(peer[0], self.weights.get(peer[0], 1))
+        return ring
+
+    def add_peers(self, peer_list):
+        """Put peers that are not on the ring yet on it."""
+        with self.lock:
+            self._add_peers(peer_list)
+
+    def _add_peers(self, peer_list):
+        if any(peer[0] not in self.peers for peer in peer_list if peer[0] != self.node_id):
+            self.peers.update({peer[0]: peer for peer in peer_list if peer[0] != self.node_id})
+            self.ring = self._build_ring(self.peers.values())
+
+    def placement(self, topic):
+        """Node ids the ring assigns `topic`, primary first.
+
+        The topic's leader is the node that created it, which need not be the
+        primary; it replicates to the first `replication_factor` of these other
+        than itself. The catalogs record the placement actually in use.
+        """
+        return self.ring.nodes_for(topic, self.replication_factor + 1)
+
+    def _replicas_for(self, topic):
+        replicas = [node_id for node_id in self.placement(topic) if node_id != self.node_id]
+        return [self.peers[node_id] for node_id in replicas[:self.replication_factor]]
 
     def replicate_topic(self, topic, peer_list):
-        """Replicate a topic to the nearest peers."""
-        sorted_peers = sorted(peer_list, key=lambda _: random.randint(1, 100))  # Simulate proximity
-        self.topic_replicas[topic] = sorted_peers[:self.replication_factor]
-        print(f"Replicated topic '{topic}' to {self.topic_replicas[topic]}")
-
-    def synchronize_replicas(self, topic, message):
-        """Synchronize replicas of a topic."""
-        replicas = self.topic_replicas.get(topic, [])
-        if self.consistency_model == "strong":
-            for peer in replicas:
-                print(f"Strong sync: Sending message '{message}' to replica {peer}")
-        elif self.consistency_model == "eventual":
-            for peer in replicas:
-                print(f"Eventual sync: Queuing message '{message}' for replica {peer}")
-                time.sleep(random.uniform(0.1, 0.5))  # Simulate delay
+        """Replicate a topic to the replicas the hash ring assigns it."""
+        with self.lock:
+            if topic in self.streams:
+                return
+            self._add_peers(peer_list)
+            replicas = self._replicas_for(topic)
+            self.topic_replicas[topic] = replicas
+            self.ack_conditions[topic] = threading.Condition()
+            self.streams[topic] = [ReplicaStream(self, topic, peer) for peer in replicas]
+        logger.info("Replicated topic '%s' to %s", topic, self.topic_replicas[topic])
+
+    def stop_replicating(self, topic):
+        """Close a topic's replica streams, e.g. once another node leads it."""
+        with self.lock:
+            streams = self.streams.pop(topic, [])
+            self.topic_replicas.pop(topic, None)
+        for stream in streams:
+            stream.close()
+        if streams:
+            logger.info("Stopped replicating topic '%s'", topic)
+
+    def rebalance(self, peer_list):
+        """Move to a new peer set, re-placing only the topics whose replicas change.
+
+        Streams to replicas that keep a topic are left untouched; new replicas
+        are caught up from the leader's log by their stream's handshake.
+        Returns the plan from `hash_ring.plan_rebalance`.
+        """
+        with self.lock:
+            new_ring = self._build_ring(peer_list)
+            plan = plan_rebalance(self.ring, new_ring, list(self.streams), self.replication_factor + 1)
+            self.ring = new_ring
+            self.peers = {peer[0]: peer for peer in peer_list if peer[0] != self.node_id}
+            closing = []
+            for topic in plan:
+                replicas = self._replicas_for(topic)
+                current = {stream.peer_id: stream for stream in self.streams[topic]}
+                closing.extend(stream for peer_id, stream in current.items()
+                               if peer_id not in {peer[0] for peer in replicas})
+                self.topic_replicas[topic] = replicas
+                self.streams[topic] = [current.get(peer[0]) or ReplicaStream(self, topic, peer) for peer in replicas]
+        for stream in closing:
+            stream.close()
+        for topic, move in plan.items():
+            logger.info("Rebalanced topic '%s' from %s to %s", topic, move["old"], move["new"])
+        return plan
+
+    def synchronize_batch(self, topic, batch):
+        """Synchronize replicas of a topic with a newly appended record batch.
+
+        The batch is forwarded exactly as stored. In "strong" mode this waits
+        until `write_quorum` replicas have acked it, or until every replica
+        that is still reachable has, and returns {"replicas_acked": n,
+        "quorum": bool}. In "eventual" mode it only queues the batch for the
+        background senders and returns at once.
+        """
+        streams = self.streams.get(topic, [])
+        for stream in streams:
+            stream.enqueue(batch)
+        if self.consistency_model == "eventual":
+            return {}
+        return self.wait_for_quorum(topic, batch.next_offset)
+
+    def wait_for_quorum(self, topic, end_offset, timeout=None):
+        streams = self.streams.get(topic, [])
+        required = min(self.write_quorum, len(streams))
+        if required == 0:
+            return {"replicas_acked": 0, "quorum": True}
+        condition = self.ack_conditions[topic]
+        deadline = time.monotonic() + (self.ack_timeout if timeout is None else timeout)
+        with condition:
+            while True:
+                acked = sum(1 for s in streams if s.acked_offset is not None and s.acked_offset >= end_offset)
+                if acked >= required:
+                    return {"replicas_acked": acked, "quorum": True}
+                reachable = sum(1 for s in streams if s.state != "offline")
+                remaining = deadline - time.monotonic()
+                if reachable == 0 or remaining <= 0 or (acked >= reachable and reachable < required):
+                    return {"replicas_acked": acked, "quorum": False}
+                condition.wait(remaining)
+
+    def notify_ack(self, topic):
+        condition = self.ack_conditions.get(topic)
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+
+    def replica_status(self, topic=None):
+        """Return lag per replica: {topic: {peer_id: status}}."""
+        with self.lock:
+            topics = list(self.streams) if topic is None else [topic]
+            streams = {name: list(self.streams.get(name, [])) for name in topics}
+        return {name: {stream.peer_id: stream.status() for stream in topic_streams}
+                for name, topic_streams in streams.items()}
+
+    def close(self):
+        with self.lock:
+            streams = [stream for topic_streams in self.streams.values() for stream in topic_streams]
+        for stream in streams:
+            stream.close()
@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import gc
+import io
+import os
+import shutil
+import tempfile
+import time
+from peer import PeerNode
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) if os.path.isdir(path) else 0
+
+
+class StartupBenchmark:
+    """Restarts an in-process node over the same data directory and times how long it takes to come back."""
+
+    def __init__(self, storage="memory", topics=4, message_size=100, batch_size=100, data_root=None):
+        self.storage = storage
+        self.topic_names = [f"topic_{i}" for i in range(topics)]
+        self.message = "x" * message_size
+        self.batch_size = batch_size
+        self.data_dir = tempfile.mkdtemp(prefix="startup-", dir=data_root)
+        self.node = None
+        self.published = 0
+
+    def start(self):
+        """Open (or reopen) the node. Returns the seconds it took, recovery included."""
+        if self.node is not None:
+            self.node.wal.close()
+            self.node = None
+            gc.collect()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.node = PeerNode(node_id=1, port=0, peer_list=[], storage=self.storage, data_dir=self.data_dir,
+                                 wal_options={"snapshot_interval": float("inf"), "snapshot_bytes": float("inf")})
+        return time.perf_counter() - started
+
+    def publish(self, count):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for topic_name in self.topic_names:
+                self.node.create_topic(topic_name)
+            for i in range(0, count, self.batch_size):
+                topic_name = self.topic_names[(i // self.batch_size) % len(self.topic_names)]
+                self.node.publish_batch(topic_name, [self.message] * min(self.batch_size, count - i))
+        self.published += count
+
+    def restart(self, scenario):
+        """Restart the node and check it came back with every message. Returns a result row."""
+        seconds = self.start()
+        recovered = sum(log.next_offset - log.start_offset for log in self.node.topics.values())
+        if recovered != self.published:
+            raise RuntimeError(f"Recovered {recovered} messages, expected {self.published}")
+        return {"scenario": scenario, "messages": recovered,
+                "replayed_records": self.node.wal.recovery["replayed_records"],
+                "snapshot_mb": directory_bytes(f"{self.data_dir}-wal") / 1e6, "startup_s": seconds}
+
+    def close(self):
+        if self.node is not None:
+            self.node.wal.close()
+            for log in self.node.topics.values():
+                log.close()
+        for path in (self.data_dir, f"{self.data_dir}-wal", f"{self.data_dir}-spill"):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run(messages, tails, storage="memory", topics=4, message_size=100, batch_size=100, data_root=None):
+    """Restart a node holding `messages` messages: from the log alone, then from a snapshot plus each tail."""
+    benchmark = StartupBenchmark(storage, topics, message_size, batch_size, data_root)
+    rows = []
+    try:
+        benchmark.start()
+        benchmark.publish(messages)
+        rows.append(benchmark.restart("log only"))
+        for tail in tails:
+            benchmark.node.snapshot()
+            benchmark.publish(tail)
+            rows.append(benchmark.restart(f"snapshot + {tail} tail"))
+    finally:
+        benchmark.close()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node restart time from the write-ahead log and snapshots")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--tails", type=int, nargs="+", default=[0, 10_000, 100_000],
+                        help="Messages published after the snapshot, one restart each")
+    parser.add_argument("--storage", choices=["memory", "disk"], default="memory")
+    parser.add_argument("--topics", type=int, default=4)
+    parser.add_argument("--message-size", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per publish, one log record each")
+    parser.add_argument("--data-dir", default=None, help="Where the node writes (default: system temp)")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<24} {'messages':>10} {'replayed':>9} {'wal MB':>8} {'startup':>10}")
+    for row in run(args.messages, args.tails, args.storage, args.topics, args.message_size, args.batch_size,
+                   args.data_dir):
+        print(f"{row['scenario']:<24} {row['messages']:>10} {row['replayed_records']:>9} {row['snapshot_mb']:>8.1f} "
+              f"{row['startup_s']:>8.3f} s")
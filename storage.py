@@ -0,0 +1,1096 @@
+import bisect
+import json
+import lzma
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections import deque
+from urllib.parse import quote, unquote
+from codec import CodecError, decode as decode_plain, encode as encode_plain
+
+STORAGE_BACKENDS = ("memory", "disk")
+FSYNC_POLICIES = ("message", "batch", "interval")
+
+# A record batch is a fixed header followed by its records:
+#   base offset | payload length | crc32 of payload | record count | timestamp | attributes
+BATCH_HEADER = struct.Struct("!QIIIdB")
+INDEX_ENTRY = struct.Struct("!II")  # offset relative to the segment base | byte position
+
+# Record batch payloads can be compressed; the codec id is kept in the low
+# bits of the batch attributes. Ids are stored on disk and sent between
+# nodes, so they must never be reused.
+COMPRESSION_MASK = 0x07
+COMPRESSION_CODECS = {}  # {name: (codec_id, compress, decompress)}
+DECOMPRESSORS = {}  # {codec_id: decompress}
+DEFAULT_COMPRESSION_THRESHOLD = 512  # Payloads below this many bytes are stored uncompressed
+
+# Per-topic settings kept in a log's `config`
+CLEANUP_POLICIES = ("delete", "compact")
+TOPIC_CONFIG_KEYS = ("compression", "cleanup_policy", "retention_ms", "retention_bytes", "retention_messages")
+
+VALUE_STR = b"S"
+VALUE_BYTES = b"B"
+VALUE_PICKLE = b"P"  # Only ever written by this node for objects the binary codec cannot encode
+VALUE_PLAIN = b"C"  # Plain data (numbers, lists, dicts, ...) in the binary codec, safe to decode from anywhere
+
+
+class CorruptRecordError(Exception):
+    """Raised when a stored record batch fails validation."""
+
+
+def register_compression(name, codec_id, compress, decompress):
+    """Make a compression codec available to RecordBatch.build under `name`."""
+    if not 0 < codec_id <= COMPRESSION_MASK:
+        raise ValueError(f"Compression codec ids must be between 1 and {COMPRESSION_MASK}")
+    COMPRESSION_CODECS[name] = (codec_id, compress, decompress)
+    DECOMPRESSORS[codec_id] = decompress
+
+
+register_compression("zlib", 1, zlib.compress, zlib.decompress)
+register_compression("lzma", 2, lzma.compress, lzma.decompress)
+
+
+def encode_varint(value, out):
+    """Append an unsigned LEB128 varint to the bytearray `out`."""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buffer, pos):
+    """Read an unsigned varint at `pos`. Returns (value, next_pos)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_value(message):
+    """Encode a message body with a one-byte type tag."""
+    if isinstance(message, str):
+        return VALUE_STR + message.encode("utf-8")
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return VALUE_BYTES + bytes(message)
+    try:
+        return VALUE_PLAIN + encode_plain(message)
+    except CodecError:
+        return VALUE_PICKLE + pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_value(data):
+    """Decode a message body produced by `encode_value`."""
+    tag = data[:1]
+    if tag == VALUE_STR:
+        return str(data[1:], "utf-8")
+    if tag == VALUE_BYTES:
+        return bytes(data[1:])
+    if tag == VALUE_PLAIN:
+        return decode_plain(bytes(data[1:]))
+    return pickle.loads(data[1:])
+
+
+def encode_records(messages, keys=None):
+    """Encode messages (and optional keys) into a record batch payload.
+
+    Each record is a varint key length (0 for no key, otherwise length + 1),
+    the key bytes, a varint value length and the tagged value.
+    """
+    out = bytearray()
+    for i, message in enumerate(messages):
+        key = keys[i] if keys is not None else None
+        if key is None:
+            out.append(0)
+        else:
+            key = key.encode("utf-8") if isinstance(key, str) else bytes(key)
+            encode_varint(len(key) + 1, out)
+            out += key
+        value = encode_value(message)
+        encode_varint(len(value), out)
+        out += value
+    return bytes(out)
+
+
+def decode_records(payload, base_offset):
+    """Decode a batch payload into [(offset, key, message, encoded_size)]."""
+    records = []
+    pos = 0
+    offset = base_offset
+    end = len(payload)
+    while pos < end:
+        start = pos
+        key_length, pos = decode_varint(payload, pos)
+        key = None
+        if key_length:
+            key = bytes(payload[pos:pos + key_length - 1])
+            pos += key_length - 1
+        value_length, pos = decode_varint(payload, pos)
+        message = decode_value(payload[pos:pos + value_length])
+        pos += value_length
+        records.append((offset, key, message, pos - start))
+        offset += 1
+    return records
+
+
+class RecordBatch:
+    """A contiguous run of messages appended together and stored as one unit."""
+
+    __slots__ = ("base_offset", "count", "timestamp", "attributes", "payload")
+
+    def __init__(self, base_offset, count, payload, timestamp=None, attributes=0):
+        self.base_offset = base_offset
+        self.count = count
+        self.payload = payload
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.attributes = attributes
+
+    @classmethod
+    def build(cls, base_offset, messages, keys=None, timestamp=None, compression=None,
+              compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """Encode messages into a batch, compressing the payload with `compression` if it is worth it."""
+        batch = cls(base_offset, len(messages), encode_records(messages, keys), timestamp)
+        return batch.compress(compression, compression_threshold) if compression else batch
+
+    def compress(self, compression, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """This batch with its payload compressed, or itself if it is compressed, small or incompressible."""
+        if compression not in COMPRESSION_CODECS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {tuple(COMPRESSION_CODECS)}")
+        if self.attributes & COMPRESSION_MASK or len(self.payload) < threshold:
+            return self
+        codec_id, compress, _ = COMPRESSION_CODECS[compression]
+        payload = compress(self.payload)
+        if len(payload) >= len(self.payload):
+            return self
+        return RecordBatch(self.base_offset, self.count, payload, self.timestamp, self.attributes | codec_id)
+
+    @classmethod
+    def from_tuple(cls, fields):
+        """Rebuild a batch sent over the wire by `to_tuple`."""
+        base_offset, count, timestamp, attributes, payload = fields
+        if attributes & COMPRESSION_MASK and attributes & COMPRESSION_MASK not in DECOMPRESSORS:
+            raise CorruptRecordError(f"Unknown compression codec {attributes & COMPRESSION_MASK}")
+        return cls(base_offset, count, bytes(payload), timestamp, attributes)
+
+    def to_tuple(self):
+        return (self.base_offset, self.count, self.timestamp, self.attributes, self.payload)
+
+    def rebase(self, base_offset):
+        """The same records at a different base offset; the payload is reused as is."""
+        return RecordBatch(base_offset, self.count, self.payload, self.timestamp, self.attributes)
+
+    @property
+    def next_offset(self):
+        return self.base_offset + self.count
+
+    @property
+    def size(self):
+        return BATCH_HEADER.size + len(self.payload)
+
+    def encode(self):
+        header = BATCH_HEADER.pack(self.base_offset, len(self.payload), zlib.crc32(self.payload),
+                                   self.count, self.timestamp, self.attributes)
+        return header + self.payload
+
+    def decompressed_payload(self):
+        if not self.attributes & COMPRESSION_MASK:
+            return self.payload
+        decompress = DECOMPRESSORS.get(self.attributes & COMPRESSION_MASK)
+        if decompress is None:
+            raise CorruptRecordError(f"Unknown compression codec {self.attributes & COMPRESSION_MASK}")
+        return decompress(self.payload)
+
+    def records(self):
+        return decode_records(self.decompressed_payload(), self.base_offset)
+
+    def validate(self, require_keys=False):
+        """Check a batch built elsewhere, decoding only its plain-data values.
+
+        Only str, bytes and plain-data values are accepted, never pickled ones,
+        so nothing from the network is ever unpickled. Every batch received
+        from a client or another node goes through this before it is stored.
+        Raises CorruptRecordError.
+        """
+        try:
+            payload = self.decompressed_payload()
+        except (lzma.LZMAError, zlib.error) as e:
+            raise CorruptRecordError(f"Cannot decompress batch: {e}") from e
+        pos = count = 0
+        try:
+            while pos < len(payload):
+                key_length, pos = decode_varint(payload, pos)
+                if require_keys and not key_length:
+                    raise CorruptRecordError(f"Record {count} has no key")
+                pos += max(key_length - 1, 0)
+                value_length, pos = decode_varint(payload, pos)
+                tag = payload[pos:pos + 1]
+                if (not value_length or tag not in (VALUE_STR, VALUE_BYTES, VALUE_PLAIN)
+                        or pos + value_length > len(payload)):
+                    raise CorruptRecordError(f"Record {count} is not a str, bytes or plain-data value")
+                if tag == VALUE_PLAIN:
+                    try:
+                        decode_plain(bytes(payload[pos + 1:pos + value_length]))
+                    except CodecError as e:
+                        raise CorruptRecordError(f"Record {count} holds malformed plain data: {e}") from e
+                pos += value_length
+                count += 1
+        except IndexError as e:
+            raise CorruptRecordError("Truncated record batch") from e
+        if count != self.count:
+            raise CorruptRecordError(f"Batch holds {count} records, its header says {self.count}")
+
+
+def collect_records(batches, from_offset, max_messages=None, max_bytes=None, with_keys=False, end_offset=None):
+    """Gather a page of records from an iterator of batches in offset order.
+
+    Returns (records, next_offset). At least one record is returned when any
+    exist at or after `from_offset`, even if it is larger than `max_bytes`.
+    Records at or beyond `end_offset` are left out, so a reader can bound its
+    page by a high watermark it observed earlier.
+    """
+    records = []
+    total_bytes = 0
+    next_offset = from_offset
+    for batch in batches:
+        if batch.next_offset <= from_offset:
+            continue
+        for offset, key, message, size in batch.records():
+            if offset < from_offset:
+                continue
+            if end_offset is not None and offset >= end_offset:
+                return records, next_offset
+            if max_messages is not None and len(records) >= max_messages:
+                return records, next_offset
+            if records and max_bytes is not None and total_bytes + size > max_bytes:
+                return records, next_offset
+            records.append((offset, key, message) if with_keys else (offset, message))
+            total_bytes += size
+            next_offset = offset + 1
+    return records, next_offset
+
+
+def collect_batches(batches, from_offset, max_bytes=None, end_offset=None):
+    """Gather stored batches holding offsets from `from_offset` on, as they are.
+
+    Returns (batches, next_offset). The first batch may start before
+    `from_offset`; readers skip the records they did not ask for. At least
+    one batch is returned when any exist, even if it is larger than `max_bytes`.
+    """
+    result = []
+    total_bytes = 0
+    next_offset = from_offset
+    for batch in batches:
+        if batch.next_offset <= from_offset:
+            continue
+        if end_offset is not None and batch.base_offset >= end_offset:
+            break
+        if result and max_bytes is not None and total_bytes + batch.size > max_bytes:
+            break
+        result.append(batch)
+        total_bytes += batch.size
+        next_offset = batch.next_offset
+    return result, next_offset
+
+
+def retention_count(units, config, size_bytes, next_offset, now, unit_size, unit_timestamp):
+    """How many of the oldest `units` (batches or segments) the retention settings in `config` drop.
+
+    A unit goes once it is older than "retention_ms", or while the log stays
+    at or above "retention_bytes" / "retention_messages" without it. The
+    newest unit is always kept.
+    """
+    retention_ms = config.get("retention_ms")
+    retention_bytes = config.get("retention_bytes")
+    retention_messages = config.get("retention_messages")
+    if retention_ms is None and retention_bytes is None and retention_messages is None:
+        return 0
+    drop = 0
+    for unit, following in zip(units, units[1:]):
+        size_bytes -= unit_size(unit)
+        remaining = next_offset - following.base_offset
+        if not ((retention_ms is not None and unit_timestamp(unit) < now - retention_ms / 1000)
+                or (retention_bytes is not None and size_bytes >= retention_bytes)
+                or (retention_messages is not None and remaining >= retention_messages)):
+            break
+        drop += 1
+    return drop
+
+
+def coalesce_batches(batches, max_bytes):
+    """Merge runs of adjacent uncompressed batches into batches of up to `max_bytes` of payload.
+
+    Payloads are concatenated as they are. A merged batch has the newest
+    timestamp of its run, so time-based retention may keep its records longer.
+    """
+    run = []
+    size = 0
+    for batch in batches:
+        if run and ((batch.attributes | run[-1].attributes) & COMPRESSION_MASK
+                    or batch.base_offset != run[-1].next_offset or size + len(batch.payload) > max_bytes):
+            yield _merge_run(run)
+            run, size = [], 0
+        run.append(batch)
+        size += len(batch.payload)
+    if run:
+        yield _merge_run(run)
+
+
+def _merge_run(run):
+    if len(run) == 1:
+        return run[0]
+    return RecordBatch(run[0].base_offset, sum(batch.count for batch in run),
+                       b"".join(batch.payload for batch in run), run[-1].timestamp, run[0].attributes)
+
+
+def validate_topic_config(config):
+    """Return an error message for an invalid topic config, or None."""
+    unknown = set(config) - set(TOPIC_CONFIG_KEYS)
+    if unknown:
+        return f"Unknown topic settings {sorted(unknown)}, expected some of {TOPIC_CONFIG_KEYS}"
+    if config.get("compression") not in (None, *COMPRESSION_CODECS):
+        return f"Unknown compression '{config['compression']}', expected one of {tuple(COMPRESSION_CODECS)}"
+    if config.get("cleanup_policy", "delete") not in CLEANUP_POLICIES:
+        return f"Unknown cleanup policy '{config['cleanup_policy']}', expected one of {CLEANUP_POLICIES}"
+    for name in ("retention_ms", "retention_bytes", "retention_messages"):
+        value = config.get(name)
+        if value is not None and (type(value) is not int or value < 0):
+            return f"{name} must be a non-negative integer"
+    return None
+
+
+def latest_offsets(batches):
+    """Map every record key in `batches` to the offset of its latest record."""
+    latest = {}
+    for batch in batches:
+        for offset, key, _, _ in batch.records():
+            if key is not None:
+                latest[key] = offset
+    return latest
+
+
+def compact_batch(batch, latest, compression=None):
+    """Drop the records of `batch` that a later record with the same key supersedes.
+
+    Returns the surviving records as batches of consecutive offsets, each at
+    its original offset; the batch itself is returned when nothing changes.
+    Records without a key are kept.
+    """
+    records = batch.records()
+    if all(key is None or latest.get(key) == offset for offset, key, _, _ in records):
+        return [batch]
+    runs = []
+    for offset, key, message, _ in records:
+        if key is not None and latest.get(key) != offset:
+            continue
+        if runs and runs[-1][0] + len(runs[-1][1]) == offset:
+            runs[-1][1].append((key, message))
+        else:
+            runs.append((offset, [(key, message)]))
+    return [RecordBatch.build(base, [message for _, message in run], [key for key, _ in run], batch.timestamp,
+                              compression)
+            for base, run in runs]
+
+
+class MemoryLog:
+    """Keeps a topic's record batches in memory. Used for tests and ephemeral nodes.
+
+    Appends must be serialized by the caller. Reads may run concurrently with
+    an append: a batch is visible in `batches` before `next_offset` moves.
+    """
+
+    def __init__(self, topic_name, config=None):
+        self.topic_name = topic_name
+        self.config = config or {}  # Per-topic settings such as "compression"
+        self.batches = []
+        self.base_offsets = []  # Parallel to `batches`, for bisecting by offset
+        self.start_offset = 0
+        self.next_offset = 0  # High watermark: the offset the next message will get
+        self.size_bytes = 0
+        self.cleaned_offset = 0  # Everything below this offset has been compacted
+        self.cleaned_messages = 0  # Records left below `cleaned_offset` by the last compaction
+
+    def append(self, messages, keys=None, timestamp=None):
+        """Append messages as one batch and return the offset of the first one."""
+        if not messages:
+            return self.next_offset
+        return self.append_batch(RecordBatch.build(self.next_offset, messages, keys, timestamp,
+                                                   self.config.get("compression")))
+
+    def append_batch(self, batch):
+        self.batches.append(batch)
+        self.base_offsets.append(batch.base_offset)
+        self.next_offset = batch.next_offset
+        self.size_bytes += batch.size
+        return batch.base_offset
+
+    def restore(self, batches, start_offset, next_offset):
+        """Replace the log's contents with batches loaded from a snapshot."""
+        self.batches = batches
+        self.base_offsets = [batch.base_offset for batch in batches]
+        self.start_offset = start_offset
+        self.next_offset = next_offset
+        self.size_bytes = sum(batch.size for batch in batches)
+
+    def batches_from(self, from_offset):
+        batches = self.batches  # Retention and compaction swap in new lists; keep iterating this one
+        index = max(0, min(bisect.bisect_right(self.base_offsets, from_offset), len(batches)) - 1)
+        while index > 0 and batches[index].base_offset > from_offset:
+            index -= 1  # The offsets list was swapped between the two reads
+        while index < len(batches):
+            yield batches[index]
+            index += 1
+
+    def read(self, from_offset, max_messages=None, max_bytes=None, with_keys=False, end_offset=None):
+        """Return ([(offset, message)], next_offset) starting at `from_offset`."""
+        end_offset = self.next_offset if end_offset is None else end_offset
+        return collect_records(self.batches_from(from_offset), max(from_offset, self.start_offset),
+                               max_messages, max_bytes, with_keys, end_offset)
+
+    def read_batches(self, from_offset, max_bytes=None, end_offset=None):
+        """Return (stored batches, next_offset) starting at the batch that holds `from_offset`."""
+        end_offset = self.next_offset if end_offset is None else end_offset
+        return collect_batches(self.batches_from(from_offset), max(from_offset, self.start_offset),
+                               max_bytes, end_offset)
+
+    def set_config(self, config):
+        self.config = config
+
+    def truncate(self, offset):
+        """Drop every message at or after `offset`. Must be serialized with appends."""
+        if offset >= self.next_offset:
+            return
+        index = max(0, bisect.bisect_right(self.base_offsets, offset) - 1)
+        if self.batches[index].next_offset <= offset:
+            index += 1  # `offset` falls in a gap left by compaction
+        batch = self.batches[index]
+        prefix = [(key, message) for record_offset, key, message, _ in batch.records() if record_offset < offset]
+        self.next_offset = min(batch.base_offset, offset)
+        self.batches = self.batches[:index]
+        self.base_offsets = self.base_offsets[:index]
+        self.size_bytes = sum(batch.size for batch in self.batches)
+        self.cleaned_offset = min(self.cleaned_offset, self.next_offset)
+        if prefix:
+            self.append([message for _, message in prefix], [key for key, _ in prefix], batch.timestamp)
+
+    def apply_retention(self, now=None):
+        """Drop the oldest batches past the topic's retention limits. Must be serialized with appends.
+
+        Whole batches are dropped, never the newest one, and offsets of the
+        remaining messages do not change. Returns the number of offsets dropped.
+        """
+        drop = retention_count(self.batches, self.config, self.size_bytes, self.next_offset,
+                               time.time() if now is None else now,
+                               lambda batch: batch.size, lambda batch: batch.timestamp)
+        if not drop:
+            return 0
+        start_offset = self.start_offset
+        self.size_bytes -= sum(batch.size for batch in self.batches[:drop])
+        self.batches = self.batches[drop:]
+        self.base_offsets = self.base_offsets[drop:]
+        self.start_offset = self.batches[0].base_offset
+        return self.start_offset - start_offset
+
+    def drop_before(self, offset):
+        """Start the log at `offset`, dropping the batches wholly below it, as a past retention pass did.
+
+        Must be serialized with appends. Used to replay retention from a write-ahead log.
+        """
+        offset = min(offset, self.next_offset)
+        if offset <= self.start_offset:
+            return
+        index = bisect.bisect_left([batch.next_offset for batch in self.batches], offset + 1)
+        self.size_bytes -= sum(batch.size for batch in self.batches[:index])
+        self.batches = self.batches[index:]
+        self.base_offsets = self.base_offsets[index:]
+        self.start_offset = offset
+
+    def compact(self, end_offset=None):
+        """Keep only the latest record per key in the batches below `end_offset`, by default all but the newest.
+
+        Must be serialized with appends. Surviving records keep their offsets.
+        Returns the number of records removed.
+        """
+        if end_offset is None:
+            end_offset = self.batches[-1].base_offset if self.batches else 0
+        split = bisect.bisect_right([batch.next_offset for batch in self.batches], end_offset)
+        if not split or split == len(self.batches):
+            return 0
+        latest = latest_offsets(self.batches)
+        compression = self.config.get("compression")
+        cleaned = []
+        for batch in self.batches[:split]:
+            cleaned.extend(compact_batch(batch, latest, compression))
+        kept = self.batches[split:]
+        removed = sum(batch.count for batch in self.batches[:split]) - sum(batch.count for batch in cleaned)
+        self.cleaned_messages = sum(batch.count for batch in cleaned)
+        self.batches = cleaned + kept
+        self.base_offsets = [batch.base_offset for batch in self.batches]
+        self.size_bytes = sum(batch.size for batch in self.batches)
+        self.cleaned_offset = kept[0].base_offset
+        return removed
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Segment:
+    """One segment file of a SegmentedLog plus its sparse offset index."""
+
+    def __init__(self, directory, base_offset, suffix=""):
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, f"{base_offset:020d}.log{suffix}")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}.index{suffix}")
+        self.next_offset = base_offset
+        self.size = 0
+        self.index_offsets = []  # Relative offsets of indexed batches
+        self.index_positions = []  # Byte positions of indexed batches
+        self.bytes_since_index = 0
+        self.max_timestamp = 0.0
+        self.file = None
+        self.index_file = None
+        self.read_fd = None
+        self.mmap = None
+        self.reader_lock = threading.Lock()
+
+    def open_for_append(self):
+        self.file = open(self.path, "ab", buffering=0)
+        self.index_file = open(self.index_path, "ab")
+
+    def seal(self):
+        """Stop appending to this segment; later reads go through mmap."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def append(self, data, batch, index_interval_bytes):
+        position = self.size
+        self.file.write(data)
+        self.size += len(data)
+        self.next_offset = batch.next_offset
+        self.max_timestamp = max(self.max_timestamp, batch.timestamp)
+        if not self.index_offsets or self.bytes_since_index >= index_interval_bytes:
+            self.add_index_entry(batch.base_offset - self.base_offset, position, write=True)
+            self.bytes_since_index = 0
+        self.bytes_since_index += len(data)
+
+    def add_index_entry(self, relative_offset, position, write=False):
+        self.index_positions.append(position)  # Positions first so concurrent readers never see a dangling offset
+        self.index_offsets.append(relative_offset)
+        if write:
+            self.index_file.write(INDEX_ENTRY.pack(relative_offset, position))
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+        if self.index_file is not None:
+            self.index_file.flush()
+
+    def read_at(self, position, length):
+        """Read bytes from the segment: through mmap once sealed, with pread while active."""
+        if self.file is None:
+            if self.mmap is None:
+                with self.reader_lock:
+                    if self.mmap is None:
+                        with open(self.path, "rb") as f:
+                            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mmap[position:position + length]
+        if self.read_fd is None:
+            with self.reader_lock:
+                if self.read_fd is None:
+                    self.read_fd = os.open(self.path, os.O_RDONLY)
+        return os.pread(self.read_fd, length, position)
+
+    def position_for(self, offset):
+        """Byte position of the last indexed batch at or before `offset`."""
+        index = bisect.bisect_right(self.index_offsets, offset - self.base_offset) - 1
+        return self.index_positions[index] if index >= 0 else 0
+
+    def batches_from(self, offset):
+        position = self.position_for(offset)
+        end = self.size
+        while position < end:
+            batch, position = self.read_batch(position, end)
+            if batch.next_offset > offset:
+                yield batch
+
+    def read_batch(self, position, end, validate=False):
+        header = self.read_at(position, BATCH_HEADER.size)
+        if len(header) < BATCH_HEADER.size:
+            raise CorruptRecordError(f"Truncated batch header at {self.path}:{position}")
+        base_offset, length, crc, count, timestamp, attributes = BATCH_HEADER.unpack(header)
+        if position + BATCH_HEADER.size + length > end:
+            raise CorruptRecordError(f"Truncated batch at {self.path}:{position}")
+        payload = self.read_at(position + BATCH_HEADER.size, length)
+        if validate and zlib.crc32(payload) != crc:
+            raise CorruptRecordError(f"Checksum mismatch at {self.path}:{position}")
+        batch = RecordBatch(base_offset, count, payload, timestamp, attributes)
+        return batch, position + BATCH_HEADER.size + length
+
+    def recover(self):
+        """Load the index, then scan and validate everything after the last indexed batch.
+
+        A torn write at the end of the segment is truncated away.
+        """
+        self.size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            for pos in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+                relative_offset, position = INDEX_ENTRY.unpack_from(data, pos)
+                if position >= self.size:
+                    break
+                self.add_index_entry(relative_offset, position)
+        while True:
+            start = position = self.index_positions[-1] if self.index_positions else 0
+            valid_end = position
+            while position < self.size:
+                try:
+                    batch, next_position = self.read_batch(position, self.size, validate=True)
+                except CorruptRecordError:
+                    break
+                if not self.index_offsets:
+                    self.add_index_entry(batch.base_offset - self.base_offset, position)
+                self.next_offset = batch.next_offset
+                self.max_timestamp = max(self.max_timestamp, batch.timestamp)
+                position = valid_end = next_position
+            if valid_end == start < self.size and self.index_positions:
+                # The last indexed batch itself is damaged: rescan from the previous entry
+                self.index_offsets.pop()
+                self.index_positions.pop()
+                continue
+            break
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if valid_end < self.size:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+            self.size = valid_end
+        self.bytes_since_index = self.size - (self.index_positions[-1] if self.index_positions else 0)
+        with open(self.index_path, "wb") as f:
+            for relative_offset, position in zip(self.index_offsets, self.index_positions):
+                f.write(INDEX_ENTRY.pack(relative_offset, position))
+
+    def truncate(self, offset):
+        """Cut the segment at the batch holding `offset` and reopen it for appends.
+
+        Returns [(key, message)] of that batch that come before `offset`, for
+        the caller to append again.
+        """
+        position = self.position_for(offset)
+        end = self.size
+        prefix = []
+        while position < end:
+            batch, next_position = self.read_batch(position, end)
+            if batch.next_offset > offset:
+                prefix = [(key, message) for record_offset, key, message, _ in batch.records()
+                          if record_offset < offset]
+                self.next_offset = min(batch.base_offset, offset)  # `offset` may fall in a compaction gap
+                break
+            position = next_position
+        self.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(position)
+        self.size = position
+        while self.index_positions and self.index_positions[-1] >= position:
+            self.index_positions.pop()
+            self.index_offsets.pop()
+        self.bytes_since_index = self.size - (self.index_positions[-1] if self.index_positions else 0)
+        with open(self.index_path, "wb") as f:
+            for relative_offset, index_position in zip(self.index_offsets, self.index_positions):
+                f.write(INDEX_ENTRY.pack(relative_offset, index_position))
+        self.open_for_append()
+        return prefix
+
+    def close(self):
+        self.seal()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+    def pin(self):
+        """Map a sealed segment so readers already holding it keep working once its files are removed."""
+        if self.size:
+            self.read_at(0, 0)
+
+    def remove_files(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class _IntervalSyncer:
+    """Single background thread that fsyncs every log using the "interval" policy."""
+
+    def __init__(self):
+        self.logs = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, log):
+        with self.lock:
+            self.logs.add(log)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                logs = list(self.logs)
+            now = time.monotonic()
+            for log in logs:
+                if log.dirty and now - log.last_sync >= log.fsync_interval:
+                    log.flush()
+            time.sleep(0.01)
+
+
+_interval_syncer = _IntervalSyncer()
+
+
+class SegmentedLog:
+    """Stores a topic as rolling append-only segment files on disk.
+
+    Appends must be serialized by the caller; reads can run alongside them.
+
+    Each segment holds record batches back to back and has a sparse index
+    that maps an offset to a byte position every `index_interval_bytes`.
+    Sealed segments are read through mmap; only the tail of the active
+    segment (`tail_cache_bytes`) is kept in memory for hot reads.
+
+    `fsync_policy` trades durability against publish latency:
+    "message" syncs after every append, "batch" after every
+    `fsync_messages` messages and "interval" every `fsync_interval_ms`.
+    """
+
+    def __init__(self, topic_name, data_dir, segment_bytes=64 * 1024 * 1024, index_interval_bytes=4096,
+                 tail_cache_bytes=1024 * 1024, fsync_policy="interval", fsync_messages=1000,
+                 fsync_interval_ms=200, config=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {FSYNC_POLICIES}")
+        self.topic_name = topic_name
+        self.directory = os.path.join(data_dir, quote(topic_name, safe=""))
+        self.segment_bytes = segment_bytes
+        self.index_interval_bytes = index_interval_bytes
+        self.tail_cache_bytes = tail_cache_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_messages = fsync_messages
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.segments = []
+        self.segment_bases = []  # Parallel to `segments`, for bisecting by offset
+        self.tail = deque()  # Most recent batches of the active segment
+        self.tail_bytes = 0
+        self.tail_lock = threading.Lock()  # Lets readers copy the tail while an append runs
+        self.unsynced_messages = 0
+        self.dirty = False
+        self.last_sync = time.monotonic()
+        self.sync_lock = threading.Lock()
+        self.cleaned_offset = 0  # Sealed segments below this offset have been compacted
+        self.cleaned_messages = 0  # Records left in them by the last compaction
+        os.makedirs(self.directory, exist_ok=True)
+        self.config_path = os.path.join(self.directory, "config.json")
+        if config is not None:
+            self.set_config(config)
+        elif os.path.exists(self.config_path):
+            with open(self.config_path) as f:
+                self.config = json.load(f)
+        else:
+            self.config = {}
+        self.leader_path = os.path.join(self.directory, "leader.json")
+        self.leader = None  # Node id of the topic's leader, as the node that owns this log last recorded it
+        if os.path.exists(self.leader_path):
+            with open(self.leader_path) as f:
+                self.leader = json.load(f)
+        self._load_segments()
+        if fsync_policy == "interval":
+            _interval_syncer.register(self)
+
+    def _load_segments(self):
+        self._finish_swaps()
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for base in bases:
+            segment = Segment(self.directory, base)
+            segment.recover()
+            self.segments.append(segment)
+            self.segment_bases.append(base)
+        if not self.segments:
+            self._roll(0)
+        else:
+            self.segments[-1].open_for_append()
+
+    def _finish_swaps(self):
+        """Complete compactions that were interrupted after their cleaned segment was written.
+
+        A ".swap" segment replaces every segment whose base offset falls in its
+        offset range; ".cleaned" files are leftovers of an unfinished rewrite.
+        """
+        names = os.listdir(self.directory)
+        for name in names:
+            if name.endswith(".cleaned") or (name.endswith(".index.swap") and name[:20] + ".log.swap" not in names):
+                os.remove(os.path.join(self.directory, name))
+        for name in sorted(name for name in names if name.endswith(".log.swap")):
+            swap = Segment(self.directory, int(name[:20]), ".swap")
+            swap.recover()
+            for other in names:
+                if other.endswith(".log") and swap.base_offset <= int(other[:20]) < swap.next_offset:
+                    Segment(self.directory, int(other[:20])).remove_files()
+            final = Segment(self.directory, swap.base_offset)
+            os.replace(swap.index_path, final.index_path)
+            os.replace(swap.path, final.path)
+
+    def _roll(self, base_offset):
+        if self.segments:
+            self.flush()
+            self.segments[-1].seal()
+        segment = Segment(self.directory, base_offset)
+        segment.open_for_append()
+        with self.tail_lock:
+            self.segments.append(segment)
+            self.segment_bases.append(base_offset)
+            self.tail.clear()
+            self.tail_bytes = 0
+
+    @property
+    def start_offset(self):
+        return self.segments[0].base_offset
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].next_offset
+
+    @property
+    def size_bytes(self):
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, messages, keys=None, timestamp=None):
+        """Append messages as one batch and return the offset of the first one."""
+        if not messages:
+            return self.next_offset
+        return self.append_batch(RecordBatch.build(self.next_offset, messages, keys, timestamp,
+                                                   self.config.get("compression")))
+
+    def append_batch(self, batch):
+        data = batch.encode()
+        active = self.segments[-1]
+        if active.size and active.size + len(data) > self.segment_bytes:
+            self._roll(batch.base_offset)
+            active = self.segments[-1]
+        active.append(data, batch, self.index_interval_bytes)
+        with self.tail_lock:
+            self.tail.append(batch)
+            self.tail_bytes += batch.size
+            while self.tail_bytes > self.tail_cache_bytes and len(self.tail) > 1:
+                self.tail_bytes -= self.tail.popleft().size
+        self.dirty = True
+        self.unsynced_messages += batch.count
+        if self.fsync_policy == "message" or (
+                self.fsync_policy == "batch" and self.unsynced_messages >= self.fsync_messages):
+            self.flush()
+        return batch.base_offset
+
+    def batches_from(self, from_offset):
+        with self.tail_lock:
+            tail = list(self.tail) if self.tail and self.tail[0].base_offset <= from_offset else None
+            segments = list(self.segments)
+            segment_bases = list(self.segment_bases)
+        if tail is not None:
+            yield from tail
+            return
+        index = max(0, bisect.bisect_right(segment_bases, from_offset) - 1)
+        for segment in segments[index:]:
+            yield from segment.batches_from(from_offset)
+
+    def read(self, from_offset, max_messages=None, max_bytes=None, with_keys=False, end_offset=None):
+        """Return ([(offset, message)], next_offset) starting at `from_offset`."""
+        end_offset = self.next_offset if end_offset is None else end_offset
+        from_offset = max(from_offset, self.start_offset)
+        return collect_records(self.batches_from(from_offset), from_offset, max_messages, max_bytes, with_keys,
+                               end_offset)
+
+    def read_batches(self, from_offset, max_bytes=None, end_offset=None):
+        """Return (stored batches, next_offset) starting at the batch that holds `from_offset`."""
+        end_offset = self.next_offset if end_offset is None else end_offset
+        from_offset = max(from_offset, self.start_offset)
+        return collect_batches(self.batches_from(from_offset), from_offset, max_bytes, end_offset)
+
+    def set_config(self, config):
+        """Replace the topic's settings and persist them next to its segments."""
+        self.config = config
+        with open(self.config_path + ".tmp", "w") as f:
+            json.dump(config, f)
+        os.replace(self.config_path + ".tmp", self.config_path)
+
+    def set_leader(self, leader):
+        """Persist the node id of the topic's leader next to its segments."""
+        if leader != self.leader:
+            self.leader = leader
+            with open(self.leader_path + ".tmp", "w") as f:
+                json.dump(leader, f)
+            os.replace(self.leader_path + ".tmp", self.leader_path)
+
+    def truncate(self, offset):
+        """Drop every message at or after `offset`. Must be serialized with appends."""
+        if offset >= self.next_offset:
+            return
+        offset = max(offset, self.start_offset)
+        index = max(0, bisect.bisect_right(self.segment_bases, offset) - 1)
+        with self.tail_lock:
+            dropped = self.segments[index + 1:]
+            del self.segments[index + 1:]
+            del self.segment_bases[index + 1:]
+            self.tail.clear()
+            self.tail_bytes = 0
+        for segment in dropped:
+            segment.close()
+            os.remove(segment.path)
+            os.remove(segment.index_path)
+        prefix = self.segments[-1].truncate(offset)
+        self.cleaned_offset = min(self.cleaned_offset, self.segments[-1].base_offset)
+        if prefix:
+            self.append([message for _, message in prefix], [key for key, _ in prefix])
+        self.flush()
+
+    def apply_retention(self, now=None):
+        """Delete the oldest sealed segments past the topic's retention limits.
+
+        Must be serialized with appends. The active segment is never deleted
+        and remaining offsets do not change. Returns the number of offsets dropped.
+        """
+        with self.tail_lock:
+            segments = list(self.segments)
+        drop = retention_count(segments, self.config, self.size_bytes, self.next_offset,
+                               time.time() if now is None else now,
+                               lambda segment: segment.size, lambda segment: segment.max_timestamp)
+        if not drop:
+            return 0
+        start_offset = self.start_offset
+        for segment in segments[:drop]:
+            segment.pin()
+        with self.tail_lock:
+            del self.segments[:drop]
+            del self.segment_bases[:drop]
+        for segment in segments[:drop]:
+            segment.remove_files()
+        return self.start_offset - start_offset
+
+    def compact(self):
+        """Keep only the latest record per key in the sealed segments.
+
+        Must be serialized with appends. Surviving records keep their offsets;
+        adjacent segments that shrank are merged while they fit in
+        `segment_bytes`. Does nothing until a segment was sealed since the last
+        run. Returns the number of records removed.
+        """
+        if len(self.segments) < 2 or self.segments[-1].base_offset <= self.cleaned_offset:
+            return 0
+        latest = latest_offsets(self.batches_from(self.start_offset))
+        compression = self.config.get("compression")
+        groups = []  # [[segments], [cleaned batches], size, removed records]
+        for segment in self.segments[:-1]:
+            batches = []
+            removed = 0
+            for batch in segment.batches_from(segment.base_offset):
+                cleaned = compact_batch(batch, latest, compression)
+                removed += batch.count - sum(cleaned_batch.count for cleaned_batch in cleaned)
+                batches.extend(cleaned)
+            size = sum(batch.size for batch in batches)
+            if groups and groups[-1][2] + size <= self.segment_bytes:
+                groups[-1][0].append(segment)
+                groups[-1][1].extend(batches)
+                groups[-1][2] += size
+                groups[-1][3] += removed
+            else:
+                groups.append([[segment], batches, size, removed])
+        for segments, batches, _, removed in groups:
+            if removed or len(segments) > 1:
+                self._replace_segments(segments, batches)
+        self.cleaned_offset = self.segments[-1].base_offset
+        self.cleaned_messages = sum(sum(batch.count for batch in group[1]) for group in groups)
+        return sum(group[3] for group in groups)
+
+    def _replace_segments(self, old, batches):
+        """Swap consecutive sealed segments for one holding `batches`.
+
+        The cleaned segment is written under a ".cleaned" name and renamed to
+        ".swap" once complete, so a crash at any point either leaves the old
+        segments in place or is finished by `_finish_swaps` on restart.
+        """
+        base_offset = old[0].base_offset
+        if batches:
+            cleaned = Segment(self.directory, base_offset, ".cleaned")
+            cleaned.open_for_append()
+            for batch in batches:
+                cleaned.append(batch.encode(), batch, self.index_interval_bytes)
+            cleaned.sync()
+            cleaned.close()
+            swap = Segment(self.directory, base_offset, ".swap")
+            os.replace(cleaned.index_path, swap.index_path)
+            os.replace(cleaned.path, swap.path)
+        for segment in old:
+            segment.pin()
+            segment.remove_files()
+        new = []
+        if batches:
+            os.replace(swap.index_path, old[0].index_path)
+            os.replace(swap.path, old[0].path)
+            segment = Segment(self.directory, base_offset)
+            segment.recover()
+            new = [segment]
+        with self.tail_lock:
+            index = self.segments.index(old[0])
+            self.segments[index:index + len(old)] = new
+            self.segment_bases[index:index + len(old)] = [segment.base_offset for segment in new]
+
+    def flush(self):
+        """fsync the active segment."""
+        with self.sync_lock:
+            self.segments[-1].sync()
+            self.dirty = False
+            self.unsynced_messages = 0
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+
+
+def create_log(topic_name, backend="memory", data_dir=None, config=None, **options):
+    """Create the storage for a new topic."""
+    if backend == "memory":
+        return MemoryLog(topic_name, config)
+    if backend == "disk":
+        return SegmentedLog(topic_name, data_dir, config=config, **options)
+    raise ValueError(f"Unknown storage backend '{backend}', expected one of {STORAGE_BACKENDS}")
+
+
+def load_logs(data_dir, **options):
+    """Reopen every topic stored under `data_dir`. Returns {topic_name: SegmentedLog}."""
+    logs = {}
+    if not os.path.isdir(data_dir):
+        return logs
+    for name in sorted(os.listdir(data_dir)):
+        if os.path.isdir(os.path.join(data_dir, name)):
+            topic_name = unquote(name)
+            logs[topic_name] = SegmentedLog(topic_name, data_dir, **options)
+    return logs
@@ -0,0 +1,75 @@
+import logging
+import socket
+import unittest
+from peer import PeerNode
+
+logging.disable(logging.WARNING)
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("localhost", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def log_contents(node, topic_name):
+    log = node.topics[topic_name]
+    records, _ = log.read(log.start_offset, max_messages=log.next_offset, max_bytes=2 ** 40, with_keys=True)
+    return log.start_offset, log.next_offset, records
+
+
+class ThreeNodeReplicationTest(unittest.TestCase):
+    """Three nodes on localhost, each topic on its leader and two replicas, publishes acked by both."""
+
+    @classmethod
+    def setUpClass(cls):
+        peers = [(node_id, "localhost", port) for node_id, port in zip((1, 2, 3), free_ports(3))]
+        cls.nodes = [PeerNode(node_id, port, peers, replication_factor=2, consistency_model="strong",
+                              write_quorum=2) for node_id, _, port in peers]
+        for node in cls.nodes:
+            node.start_server()
+        cls.leader, *cls.replicas = cls.nodes
+
+    def create_topic(self, topic_name, config=None):
+        self.assertEqual(self.leader.create_topic(topic_name, config=config)["status"], "topic_created")
+        self.assertEqual(sorted(self.leader.catalog.get(topic_name).replicas), [2, 3])
+
+    def assert_replicas_match(self, topic_name):
+        expected = log_contents(self.leader, topic_name)
+        for replica in self.replicas:
+            self.assertEqual(log_contents(replica, topic_name), expected, f"node {replica.node_id}")
+
+    def test_publishes_are_acked_by_a_quorum(self):
+        self.create_topic("quorum")
+        response = self.leader.publish_message("quorum", "first")
+        self.assertEqual((response["status"], response["offset"]), ("message_published", 0))
+        self.assertEqual((response["replicas_acked"], response["quorum"]), (2, True))
+        response = self.leader.publish_batch("quorum", [f"message {i}" for i in range(100)])
+        self.assertEqual((response["status"], response["first_offset"]), ("batch_published", 1))
+        self.assertEqual((response["replicas_acked"], response["quorum"]), (2, True))
+        self.assert_replicas_match("quorum")
+
+    def test_replicas_hold_the_leaders_log(self):
+        self.create_topic("mixed", config={"compression": "zlib"})
+        for i in range(20):
+            self.assertTrue(self.leader.publish_message("mixed", {"n": i, "payload": "x" * 100})["quorum"])
+            self.assertTrue(self.leader.publish_batch("mixed", [b"bytes", f"text {i}" * 200, i])["quorum"])
+        self.assert_replicas_match("mixed")
+        self.assertEqual(log_contents(self.leader, "mixed")[1], 80)
+
+    def test_replicas_refuse_writes(self):
+        self.create_topic("leader_only")
+        self.assertTrue(self.leader.publish_message("leader_only", "kept")["quorum"])
+        for replica in self.replicas:
+            self.assertEqual(replica.publish_message("leader_only", "stray"), {"status": "not_leader", "leader": 1})
+            self.assertEqual(replica.publish_batch("leader_only", ["stray"])["status"], "not_leader")
+        self.assert_replicas_match("leader_only")
+        self.assertEqual(log_contents(self.leader, "leader_only")[2], [(0, None, "kept")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import logging
+import shutil
+import tempfile
+import unittest
+from peer import PeerNode
+from test_replication import free_ports
+
+logging.disable(logging.WARNING)
+
+
+class RestartTest(unittest.TestCase):
+    """A node restarted over the same data directory keeps each topic's leader."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix="restart-")
+        self.peers = [(1, "localhost", free_ports(1)[0])]  # Never started: the leader of the replica topics
+        self.node = None
+
+    def tearDown(self):
+        self.stop()
+        for path in (self.data_dir, f"{self.data_dir}-wal"):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def start(self, **options):
+        self.stop()
+        self.node = PeerNode(2, 0, self.peers, replication_factor=1, data_dir=self.data_dir, **options)
+        return self.node
+
+    def stop(self):
+        if self.node is not None:
+            if self.node.wal is not None:
+                self.node.wal.close()
+            for log in self.node.topics.values():
+                log.close()
+            self.node = None
+
+    def assert_restarts_as_replica(self, **options):
+        node = self.start(**options)
+        self.assertEqual(node.create_topic("replica", replica_of=1)["status"], "topic_created")
+        self.assertEqual(node.replicate_append("replica", 0, messages=["a", "b"])["status"], "replicated")
+        self.assertEqual(node.create_topic("led")["status"], "topic_created")
+        node = self.start(**options)
+        self.assertEqual(node.catalog.get("replica").leader, 1)
+        self.assertEqual(node.publish_message("replica", "stray"), {"status": "not_leader", "leader": 1})
+        self.assertEqual(node.topics["replica"].next_offset, 2)
+        self.assertNotIn("replica", node.replication_manager.streams)
+        self.assertEqual(node.catalog.get("led").leader, 2)
+        self.assertIn("led", node.replication_manager.streams)
+        self.assertEqual(node.publish_message("led", "kept")["status"], "message_published")
+
+    def test_disk_node_with_wal_keeps_replica_topics(self):
+        self.assert_restarts_as_replica(storage="disk", wal_options={})
+
+    def test_disk_node_keeps_replica_topics(self):
+        self.assert_restarts_as_replica(storage="disk")
+
+    def test_memory_node_with_wal_keeps_replica_topics(self):
+        self.assert_restarts_as_replica(wal_options={})
+
+
+class CatchUpLeadershipTest(unittest.TestCase):
+    """A memory node that lost its topics takes back the ones it led from their replicas."""
+
+    def test_restarted_leader_takes_its_topics_back(self):
+        peers = [(node_id, "localhost", port) for node_id, port in zip((1, 2), free_ports(2))]
+        leader, replica = (PeerNode(node_id, port, peers, replication_factor=1, consistency_model="strong")
+                           for node_id, _, port in peers)
+        replica.start_server()
+        leader.create_topic("events")
+        for i in range(20):
+            self.assertEqual(leader.publish_message("events", f"m{i}")["replicas_acked"], 1)
+        self.assertEqual(replica.catalog.get("events").leader, 1)
+        leader.replication_manager.close()
+
+        restarted = PeerNode(1, free_ports(1)[0], peers, replication_factor=1, consistency_model="strong")
+        report = restarted.anti_entropy.catch_up()
+        self.assertEqual(report["topics"]["events"]["messages_pulled"], 20)
+        self.assertEqual(restarted.catalog.get("events").leader, 1)
+        self.assertEqual(restarted.catalog.get("events").replicas, (2,))
+        self.assertEqual(replica.catalog.get("events").leader, 1)
+        self.assertEqual(replica.publish_message("events", "stray"), {"status": "not_leader", "leader": 1})
+        response = restarted.publish_message("events", "after restart")
+        self.assertEqual((response["offset"], response["replicas_acked"]), (20, 1))
+        self.assertEqual(replica.topics["events"].next_offset, 21)
+
+
+if __name__ == "__main__":
+    unittest.main()
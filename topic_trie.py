@@ -0,0 +1,142 @@
+SEPARATOR = "."
+SINGLE_WILDCARD = "*"  # Matches exactly one level
+MULTI_WILDCARD = "#"  # Matches zero or more levels
+
+
+def split_topic(name):
+    return name.split(SEPARATOR)
+
+
+def is_pattern(name):
+    """Whether `name` has a wildcard level, e.g. "metrics.*.cpu" or "logs.#"."""
+    return any(level in (SINGLE_WILDCARD, MULTI_WILDCARD) for level in split_topic(name))
+
+
+def validate_pattern(pattern):
+    """Return an error message for a malformed pattern, or None."""
+    for level in split_topic(pattern):
+        if not level:
+            return f"Empty level in '{pattern}'"
+        if level not in (SINGLE_WILDCARD, MULTI_WILDCARD) and (SINGLE_WILDCARD in level or MULTI_WILDCARD in level):
+            return f"Wildcards must be a whole level, got '{level}' in '{pattern}'"
+    return None
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}  # {level: _Node}
+        self.values = {}  # {key: value} stored at the name ending here
+
+
+class TopicTrie:
+    """Index of dot-separated names, one trie level per name level.
+
+    Holding subscription patterns, `match(topic)` returns the values of every
+    pattern that matches a topic, visiting only trie branches that can still
+    match: cost grows with the topic's depth and the number of matching
+    patterns, not with the number of patterns stored. Holding topic names,
+    `expand(pattern)` returns the stored names a pattern matches.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, name, key, value):
+        node = self.root
+        for level in split_topic(name):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if key not in node.values:
+            self.size += 1
+        node.values[key] = value
+
+    def remove(self, name, key):
+        """Remove one value, pruning branches left empty. Returns the value, or None."""
+        path = [self.root]
+        levels = split_topic(name)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return None
+            path.append(node)
+        value = path[-1].values.pop(key, None)
+        if value is None:
+            return None
+        self.size -= 1
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+        return value
+
+    def get(self, name):
+        """{key: value} stored under exactly `name`."""
+        node = self.root
+        for level in split_topic(name):
+            node = node.children.get(level)
+            if node is None:
+                return {}
+        return dict(node.values)
+
+    def match(self, topic):
+        """Values of every stored pattern that matches the concrete `topic`."""
+        levels = split_topic(topic)
+        depth = len(levels)
+        matches = []
+        seen = set()
+        stack = [(self.root, 0, False)]  # (node, levels consumed, node was reached through "#")
+        while stack:
+            node, index, multi = stack.pop()
+            if (id(node), index) in seen:
+                continue
+            seen.add((id(node), index))
+            if index == depth:
+                matches.extend(node.values.values())
+            else:
+                child = node.children.get(levels[index])
+                if child is not None:
+                    stack.append((child, index + 1, False))
+                child = node.children.get(SINGLE_WILDCARD)
+                if child is not None:
+                    stack.append((child, index + 1, False))
+                if multi:
+                    stack.append((node, index + 1, True))  # "#" swallows one more level
+            child = node.children.get(MULTI_WILDCARD)
+            if child is not None:
+                stack.append((child, index, True))  # "#" matching zero levels
+        return matches
+
+    def expand(self, pattern):
+        """Values of every stored concrete name that `pattern` matches."""
+        levels = split_topic(pattern)
+        depth = len(levels)
+        matches = []
+        seen = set()
+        stack = [(self.root, 0)]
+        while stack:
+            node, index = stack.pop()
+            if (id(node), index) in seen:
+                continue
+            seen.add((id(node), index))
+            if index == depth:
+                matches.extend(node.values.values())
+                continue
+            level = levels[index]
+            if level == MULTI_WILDCARD:
+                stack.append((node, index + 1))
+                stack.extend((child, index) for child in node.children.values())
+            elif level == SINGLE_WILDCARD:
+                stack.extend((child, index + 1) for child in node.children.values())
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, index + 1))
+        return matches
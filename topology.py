@@ -0,0 +1,406 @@
+import queue
+import threading
+import time
+from collections import deque
+from partitions import PUBLISH_ACTIONS, Partitioner, merge_published, partition_name
+from protocol import DEFAULT_CODECS, Connection
+from topic_trie import is_pattern
+
+# Requests sent to the topic's leader; fetches go to any copy, leader first
+LEADER_ACTIONS = ("publish", "publish_batch", "publish_records", "subscribe", "unsubscribe",
+                  "join_group", "group_fetch", "commit_offsets", "leave_group")
+READ_ACTIONS = ("fetch_messages",)
+DEFAULT_HEDGE_AFTER = 0.05  # Seconds, until enough reads were timed to use their p95
+MIN_HEDGE_AFTER = 0.005
+HEDGE_SAMPLES = 200
+
+
+class ClusterNode:
+    __slots__ = ("node_id", "address", "status", "down_until")
+
+    def __init__(self, node_id, address, status="online"):
+        self.node_id = node_id
+        self.address = address  # (host, port)
+        self.status = status  # As the cluster's failure detector sees it
+        self.down_until = 0.0  # Monotonic time before which this client will not try the node
+
+
+class ClusterMap:
+    """Client-side cache of the cluster's nodes and of where topics live.
+
+    The map is learned from the `metadata` action, starting from `seeds`
+    ([(host, port)]), and kept fresh by a background refresh every
+    `refresh_interval` seconds. A topic's placement is looked up on first use
+    and dropped when its leader cannot be reached or answers "not_leader".
+
+    Writes and subscriptions go straight to the topic's leader. A leader that
+    refused a connection is skipped for `retry_after` seconds, so requests
+    fail at once instead of stalling on it; a write is only retried when it
+    certainly did not reach a node. Fetches go to the leader first and are
+    hedged: if no answer came within the p95 of recent fetch latencies, the
+    same fetch is sent to the next replica and the first good answer wins. A
+    failed fetch moves on to the next copy immediately.
+
+    Publishes to a partitioned topic are split by partition here and sent to
+    each partition's leader, and fetching it reads every partition from the
+    node serving that partition.
+    """
+
+    def __init__(self, seeds, timeout=5.0, codecs=DEFAULT_CODECS, on_push=None, refresh_interval=30.0,
+                 retry_after=1.0):
+        self.seeds = list(seeds)
+        self.timeout = timeout
+        self.codecs = codecs
+        self.on_push = on_push
+        self.refresh_interval = refresh_interval
+        self.retry_after = retry_after
+        self.nodes = {}  # {node_id: ClusterNode}
+        self.placements = {}  # {topic_name: (leader, (replica ids))}
+        self.partitions = {}  # {partitioned topic_name: [leader of each partition]}
+        self.partitioner = Partitioner()
+        self.connections = {}  # {(host, port): Connection}
+        self.read_latencies = deque(maxlen=HEDGE_SAMPLES)
+        self.hedge_after = DEFAULT_HEDGE_AFTER
+        self.reads_timed = 0
+        self.hedged_reads = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.refresher = None
+
+    def connection(self, address):
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is None:
+                connection = self.connections[address] = Connection(*address, timeout=self.timeout,
+                                                                    on_push=self.on_push, codecs=self.codecs)
+        return connection
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            connections, self.connections = list(self.connections.values()), {}
+        for connection in connections:
+            connection.close()
+
+    def start(self):
+        """Refresh the map in the background until `close`."""
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.refresher.start()
+
+    def _refresh_loop(self):
+        while not self.closed.wait(self.refresh_interval):
+            with self.lock:
+                topics = list(self.placements)
+            self.refresh(topics)
+
+    def available(self, node_id):
+        node = self.nodes.get(node_id)
+        return node is not None and node.down_until <= time.monotonic()
+
+    def mark_down(self, node_id):
+        node = self.nodes.get(node_id)
+        if node is not None:
+            node.down_until = time.monotonic() + self.retry_after
+
+    def invalidate(self, topic_name):
+        with self.lock:
+            self.placements.pop(topic_name, None)
+
+    def _addresses(self):
+        """Addresses to ask for metadata: usable nodes first, then seeds."""
+        nodes = sorted(self.nodes.values(), key=lambda node: (not self.available(node.node_id),
+                                                               node.status != "online"))
+        addresses = [node.address for node in nodes]
+        return addresses + [seed for seed in self.seeds if seed not in addresses]
+
+    def refresh(self, topics=(), everywhere=False):
+        """Ask nodes for the membership and the placement of `topics`.
+
+        Stops at the first node that answers, or with `everywhere` asks all of
+        them, since a node only knows the placement of topics it holds.
+        Returns the placements learned.
+        """
+        addresses = self._addresses()
+        pending = []
+        for address in addresses if everywhere else []:
+            try:
+                pending.append(self.connection(address).send({"action": "metadata", "topics": list(topics)}))
+            except ConnectionError:
+                self._mark_address_down(address)
+        responses = []
+        for waiter in pending:
+            try:
+                responses.append(waiter.wait(self.timeout))
+            except (ConnectionError, TimeoutError):
+                continue
+        if not everywhere:
+            for address in addresses:
+                try:
+                    responses.append(self.connection(address).request({"action": "metadata",
+                                                                        "topics": list(topics)}))
+                    break
+                except (ConnectionError, TimeoutError):
+                    self._mark_address_down(address)
+        return self._merge(responses)
+
+    def _mark_address_down(self, address):
+        for node in list(self.nodes.values()):
+            if node.address == address:
+                self.mark_down(node.node_id)
+
+    def _merge(self, responses):
+        """Apply metadata responses. A topic's leader knows its replicas; a replica only knows itself."""
+        claims = {}  # {topic_name: {leader: [replica ids]}}
+        confirmed = set()  # (topic_name, leader) where the leader itself answered
+        for response in responses:
+            if response.get("status") != "ok":
+                continue
+            for node_id, host, port, status in response["nodes"]:
+                node = self.nodes.get(node_id)
+                if node is None:
+                    self.nodes[node_id] = ClusterNode(node_id, (host, port), status)
+                else:
+                    node.address, node.status = (host, port), status
+            with self.lock:
+                self.partitions.update(response.get("partitions", {}))
+            responder = response["node_id"]
+            for topic_name, placement in response["topics"].items():
+                leader = placement["leader"]
+                replicas = claims.setdefault(topic_name, {}).setdefault(leader, [])
+                if responder == leader:
+                    replicas.extend(placement["replicas"])
+                    confirmed.add((topic_name, leader))
+                else:
+                    replicas.append(responder)
+        learned = {}
+        for topic_name, by_leader in claims.items():
+            leader = next((leader for leader in by_leader if (topic_name, leader) in confirmed), next(iter(by_leader)))
+            learned[topic_name] = (leader, tuple(dict.fromkeys(r for r in by_leader[leader] if r != leader)))
+        with self.lock:
+            self.placements.update(learned)
+        return learned
+
+    def placement(self, topic_name):
+        """(leader, replicas) of a topic, asking every node if it is not cached. None if no node has it."""
+        placement = self.placements.get(topic_name)
+        if placement is None:
+            placement = self.refresh([topic_name], everywhere=True).get(topic_name)
+        return placement
+
+    def partition_count(self, topic_name):
+        """Number of partitions of a topic, 0 if it is not partitioned or not found."""
+        if topic_name in self.partitions:
+            return len(self.partitions[topic_name])
+        if topic_name in self.placements or is_pattern(topic_name):
+            return 0
+        self.placement(topic_name)  # Asks every node, which also report partitioned topics
+        return len(self.partitions.get(topic_name, ()))
+
+    def node_connection(self, node_id):
+        return self.connection(self.nodes[node_id].address)
+
+    def request(self, request):
+        """Send a request to the node that should serve it and return the response."""
+        if not self.nodes:
+            self.refresh()
+        if self._routed(request) and self.partition_count(request["topic_name"]):
+            return self.request_partitioned(request)
+        if self._routed(request):
+            if request["action"] in READ_ACTIONS:
+                return self.request_read(request)
+            return self.request_leader(request)
+        response = self.request_any(request)
+        if request.get("action") == "create_topic":
+            self.invalidate(request.get("topic_name"))
+        return response
+
+    def request_partitioned(self, request):
+        """Send a request on a partitioned topic to the partitions' own topics."""
+        topic_name = request["topic_name"]
+        count = self.partition_count(topic_name)
+        if request["action"] in PUBLISH_ACTIONS:
+            try:
+                parts = self.partitioner.split(request, count)
+            except ValueError as e:
+                return {"status": "invalid_request", "error": str(e)}
+            responses = self.request_many([part for _, part in parts])
+            return merge_published([(partition, response) for (partition, _), response in zip(parts, responses)])
+        if request["action"] in READ_ACTIONS:
+            offsets = request.get("offsets") or [0] * count
+            if len(offsets) != count:
+                return {"status": "invalid_request", "error": f"Expected one offset for each of {count} partitions"}
+            fields = {name: value for name, value in request.items() if name not in ("offsets", "max_wait_ms")}
+            pages = self.request_many([{**fields, "topic_name": partition_name(topic_name, partition),
+                                        "from_offset": offsets[partition]} for partition in range(count)])
+            return {"status": "ok", "topic": topic_name,
+                    "partitions": [{**page, "partition": partition} for partition, page in enumerate(pages)]}
+        return self.request_any(request)  # Any node serves the rest for the whole topic
+
+    @staticmethod
+    def _routed(request):
+        """Whether a request goes to the nodes holding its topic rather than to any node."""
+        topic_name = request.get("topic_name")
+        return (topic_name is not None and not is_pattern(topic_name)
+                and request.get("action") in LEADER_ACTIONS + READ_ACTIONS)
+
+    def request_many(self, requests):
+        """Pipeline requests to the nodes that serve them and return the responses in order.
+
+        Each request goes to its topic's leader, or to any node if it names no
+        topic. Requests that could not be sent, and any answered with
+        not_leader, are then routed one at a time like `request`.
+        """
+        if not self.nodes:
+            self.refresh()
+        pending = []
+        for request in requests:
+            if self._routed(request):
+                placement = self.placement(request["topic_name"])
+                address = self.nodes[placement[0]].address if placement and self.available(placement[0]) else None
+            else:
+                address = next(iter(self._addresses()), None)
+            waiter = None
+            if address is not None:
+                connection = self.connection(address)
+                try:
+                    connection.connect()
+                except ConnectionError:
+                    self._mark_address_down(address)
+                else:
+                    try:
+                        waiter = connection.send(request)
+                    except ConnectionError as e:
+                        waiter = e  # May have been sent: not retried
+            pending.append(waiter)
+        responses = []
+        for request, waiter in zip(requests, pending):
+            if waiter is None:
+                responses.append(self.request(request))
+                continue
+            try:
+                if isinstance(waiter, ConnectionError):
+                    raise waiter
+                response = waiter.wait(self.timeout)
+            except (ConnectionError, TimeoutError):
+                response = {"status": "connection_failed"}
+            if response.get("status") == "not_leader":
+                self.invalidate(request["topic_name"])
+                response = self.request(request)
+            responses.append(response)
+        return responses
+
+    def request_any(self, request):
+        """Send to the first node that accepts a connection, seeds and healthy nodes first."""
+        for address in self._addresses():
+            connection = self.connection(address)
+            try:
+                connection.connect()
+            except ConnectionError:
+                self._mark_address_down(address)
+                continue
+            try:
+                return connection.request(request)
+            except (ConnectionError, TimeoutError):
+                self._mark_address_down(address)
+                return {"status": "connection_failed"}
+        return {"status": "connection_failed"}
+
+    def request_leader(self, request, attempts=3):
+        topic_name = request["topic_name"]
+        for _ in range(attempts):
+            placement = self.placement(topic_name)
+            if placement is None:
+                return {"status": "topic_not_found"}
+            leader = placement[0]
+            if not self.available(leader):
+                return {"status": "connection_failed", "leader": leader}
+            connection = self.node_connection(leader)
+            try:
+                connection.connect()
+            except ConnectionError:
+                self.mark_down(leader)
+                self.invalidate(topic_name)  # The topic may have moved; a refreshed placement is tried next
+                continue
+            try:
+                response = connection.request(request, self.timeout + request.get("max_wait_ms", 0) / 1000)
+            except (ConnectionError, TimeoutError):
+                self.mark_down(leader)  # The request may have been applied: not retried
+                return {"status": "connection_failed", "leader": leader}
+            if response.get("status") != "not_leader":
+                return response
+            self.invalidate(topic_name)
+            if response.get("leader") is not None and response["leader"] in self.nodes:
+                with self.lock:
+                    self.placements[topic_name] = (response["leader"], placement[1])
+        return {"status": "connection_failed"}
+
+    def request_read(self, request):
+        """Fetch from the leader or a replica, hedging slow reads. Copies this client saw fail are tried last.
+
+        Long polls (`max_wait_ms`) are slow on purpose: they are not hedged or
+        timed, only moved to the next copy when one fails.
+        """
+        placement = self.placement(request["topic_name"])
+        if placement is None:
+            return {"status": "topic_not_found"}
+        copies = sorted([placement[0], *placement[1]],
+                        key=lambda node_id: (not self.available(node_id), self.nodes[node_id].status != "online"))
+        answers = queue.Queue()
+        started = time.monotonic()
+        long_poll = request.get("max_wait_ms", 0) / 1000
+        deadline = started + self.timeout + long_poll
+        outstanding = 0
+        next_copy = 0
+        fallback = None
+
+        def send_next():
+            nonlocal next_copy, outstanding
+            while next_copy < len(copies):
+                node_id = copies[next_copy]
+                next_copy += 1
+                try:
+                    pending = self.node_connection(node_id).send(request)
+                except ConnectionError:
+                    self.mark_down(node_id)
+                    continue
+                pending.add_done_callback(lambda done, node_id=node_id: answers.put((node_id, done)))
+                outstanding += 1
+                return True
+            return False
+
+        send_next()
+        while outstanding:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait = deadline - now
+            if next_copy < len(copies) and not long_poll:
+                wait = min(wait, max(0.0, started + self.hedge_after * next_copy - now))
+            try:
+                node_id, done = answers.get(timeout=wait)
+            except queue.Empty:
+                if next_copy < len(copies) and not long_poll and send_next():
+                    self.hedged_reads += 1
+                continue
+            outstanding -= 1
+            try:
+                response = done.result()
+            except ConnectionError:
+                self.mark_down(node_id)
+                send_next()
+                continue
+            if response.get("status") == "ok":
+                if not long_poll:
+                    self._record_read(time.monotonic() - started)
+                return response
+            fallback = response  # E.g. a replica that has not created the topic yet
+            send_next()
+        return fallback or {"status": "connection_failed"}
+
+    def _record_read(self, elapsed):
+        self.read_latencies.append(elapsed)
+        self.reads_timed += 1
+        if self.reads_timed % 20 == 0:  # Re-estimate the p95 every 20 reads
+            latencies = sorted(self.read_latencies)
+            self.hedge_after = max(MIN_HEDGE_AFTER, latencies[int(len(latencies) * 0.95)])
@@ -0,0 +1,340 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from codec import CodecError, decode, encode
+from storage import BATCH_HEADER, CorruptRecordError, MemoryLog, RecordBatch, coalesce_batches
+
+# Log records and snapshot entries are framed as payload length | crc32 of payload, followed by the payload:
+# the binary codec's encoding of a tuple. Log records are (lsn, kind, topic_name, *fields).
+FRAME = struct.Struct("!II")
+CREATE, CONFIG, APPEND, TRUNCATE, SUBSCRIBE, UNSUBSCRIBE, RETAIN, COMPACT, LEADER = range(9)
+WAL_FSYNC_POLICIES = ("message", "interval")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_NAME = "snapshot.dat"
+
+logger = logging.getLogger(__name__)
+
+
+class RecoveredTopic:
+    """A topic as the snapshot and the log records after it left it."""
+
+    __slots__ = ("config", "leader", "subscribers", "log", "lsn")
+
+    def __init__(self, topic_name, config, leader, lsn=0):
+        self.config = config
+        self.leader = leader
+        self.subscribers = set()
+        self.log = MemoryLog(topic_name, config)  # Messages, for nodes that keep them in memory
+        self.lsn = lsn  # Records of this topic up to this LSN are already in the snapshot
+
+
+class WriteAheadLog:
+    """Write-ahead log of a node's topic, subscription and message changes, with periodic snapshots.
+
+    Each change is appended as a record numbered with the next log sequence
+    number (LSN) to the current "wal-<first LSN>.log" file, under the same
+    lock that orders the change itself. A snapshot stores every topic as of
+    the LSN it was read at, is written to a temporary file and renamed over
+    "snapshot.dat", and the log files before it are then deleted. On startup
+    the node loads the snapshot and replays only the records after it, so a
+    restart takes time proportional to the writes since the last snapshot,
+    not to the topics' whole history.
+
+    A snapshot is taken every `snapshot_interval` seconds when anything was
+    logged, and sooner once the log files reach `snapshot_bytes`. Snapshots
+    are compact: adjacent uncompressed batches are stored merged into batches
+    of up to `snapshot_batch_bytes`, so a topic published one message at a
+    time loads as a few large batches.
+    `fsync_policy` is "message" (fsync every record) or "interval" (every
+    `fsync_interval_ms`; a crash can lose the last interval of changes).
+    """
+
+    def __init__(self, directory, snapshot_interval=300.0, snapshot_bytes=64 * 1024 * 1024,
+                 snapshot_batch_bytes=1024 * 1024, fsync_policy="interval", fsync_interval_ms=200):
+        if fsync_policy not in WAL_FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {WAL_FSYNC_POLICIES}")
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.snapshot_batch_bytes = snapshot_batch_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.lsn = 0  # LSN of the last record written
+        self.file = None
+        self.files = []  # Log file paths, oldest first; the last one is written to
+        self.size_bytes = 0  # Of all log files
+        self.dirty = False
+        self.lock = threading.Lock()  # Orders records and guards the file
+        self.snapshot_lock = threading.Lock()
+        self.last_snapshot = time.monotonic()
+        self.snapshots = 0
+        self.recovery = {}  # What the last `recover` loaded and how long it took
+        self.thread = None
+
+    def recover(self):
+        """Load the snapshot and replay the log records after it. Returns {topic_name: RecoveredTopic}.
+
+        Call once, before writing anything. A damaged or torn record ends the
+        replay: its file is truncated there and later files are deleted.
+        """
+        started = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        topics, self.lsn = self._load_snapshot()
+        snapshot_lsn = self.lsn
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith("wal-") and name.endswith(".log"))
+        paths = [os.path.join(self.directory, name) for name in names]
+        replayed = 0
+        for index, path in enumerate(paths):
+            count, damaged = self._replay(path, topics)
+            replayed += count
+            if damaged:
+                for later in paths[index + 1:]:
+                    os.remove(later)
+                del paths[index + 1:]
+                break
+        self.files = paths
+        self.size_bytes = sum(os.path.getsize(path) for path in paths)
+        self._open()
+        self.recovery = {"snapshot_lsn": snapshot_lsn, "replayed_records": replayed, "lsn": self.lsn,
+                         "topics": len(topics), "seconds": time.monotonic() - started}
+        return topics
+
+    def _load_snapshot(self):
+        """Returns ({topic_name: RecoveredTopic}, highest LSN) from the snapshot file, if there is one."""
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))  # A snapshot that was never completed
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}, 0
+        (version, lsn, topic_count), pos = _read_entry(data, 0)
+        if version != SNAPSHOT_VERSION:
+            raise CorruptRecordError(f"Unknown snapshot version {version} in {self.snapshot_path}")
+        topics = {}
+        for _ in range(topic_count):
+            fields, pos = _read_entry(data, pos)
+            topic_name, config, leader, subscribers, start_offset, next_offset, topic_lsn, batch_count = fields
+            topic = topics[topic_name] = RecoveredTopic(topic_name, config, leader, topic_lsn)
+            topic.subscribers.update(subscribers)
+            batches = []
+            for _ in range(batch_count):
+                base_offset, length, crc, count, timestamp, attributes = BATCH_HEADER.unpack_from(data, pos)
+                pos += BATCH_HEADER.size
+                payload = data[pos:pos + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    raise CorruptRecordError(f"Damaged batch in {self.snapshot_path} at byte {pos}")
+                batches.append(RecordBatch(base_offset, count, payload, timestamp, attributes))
+                pos += length
+            topic.log.restore(batches, start_offset, next_offset)
+            lsn = max(lsn, topic_lsn)
+        return topics, lsn
+
+    def _replay(self, path, topics):
+        """Apply the records of one log file. Returns (records applied, whether the file was damaged)."""
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = count = 0
+        while pos < len(data):
+            try:
+                (lsn, kind, topic_name, *fields), end = _read_entry(data, pos)
+            except (CorruptRecordError, CodecError, ValueError) as e:
+                logger.warning("Write-ahead log %s is damaged at byte %d (%s); later records are dropped.", path,
+                               pos, e)
+                with open(path, "r+b") as f:
+                    f.truncate(pos)
+                return count, True
+            pos = end
+            self.lsn = max(self.lsn, lsn)
+            topic = topics.get(topic_name)
+            if kind == CREATE:
+                if topic is None:
+                    config, leader = fields
+                    topics[topic_name] = RecoveredTopic(topic_name, config, leader)
+                continue
+            if topic is None or lsn <= topic.lsn:
+                continue
+            if kind == APPEND:
+                batch = RecordBatch.from_tuple(fields[0])
+                if batch.next_offset > topic.log.next_offset:
+                    topic.log.append_batch(batch)
+            elif kind == TRUNCATE:
+                topic.log.truncate(fields[0])
+            elif kind == RETAIN:
+                topic.log.drop_before(fields[0])
+            elif kind == COMPACT:
+                topic.log.compact(fields[0])
+            elif kind == LEADER:
+                topic.leader = fields[0]
+            elif kind == CONFIG:
+                topic.config = fields[0]
+                topic.log.set_config(fields[0])
+            elif kind == SUBSCRIBE:
+                topic.subscribers.add(fields[0])
+            elif kind == UNSUBSCRIBE:
+                topic.subscribers.discard(fields[0])
+            count += 1
+        return count, False
+
+    def _open(self):
+        """Start a new log file for the records from the next LSN on. Called with `lock` held or before use."""
+        path = os.path.join(self.directory, f"wal-{self.lsn + 1:020d}.log")
+        self.file = open(path, "ab", buffering=0)
+        if path not in self.files:  # An empty file left by the last run starts at the same LSN
+            self.files.append(path)
+
+    def write(self, kind, topic_name, *fields):
+        with self.lock:
+            self.lsn += 1
+            payload = encode((self.lsn, kind, topic_name, *fields))
+            self.file.write(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.size_bytes += FRAME.size + len(payload)
+            if self.fsync_policy == "message":
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+
+    def create_topic(self, topic_name, config, leader):
+        self.write(CREATE, topic_name, config, leader)
+
+    def set_config(self, topic_name, config):
+        self.write(CONFIG, topic_name, config)
+
+    def append(self, topic_name, batch):
+        self.write(APPEND, topic_name, batch.to_tuple())
+
+    def truncate(self, topic_name, offset):
+        self.write(TRUNCATE, topic_name, offset)
+
+    def retain(self, topic_name, start_offset):
+        """Retention dropped the messages below `start_offset`."""
+        self.write(RETAIN, topic_name, start_offset)
+
+    def compact(self, topic_name, end_offset):
+        """Compaction cleaned the batches below `end_offset`; replay compacts the same records again."""
+        self.write(COMPACT, topic_name, end_offset)
+
+    def set_leader(self, topic_name, leader):
+        self.write(LEADER, topic_name, leader)
+
+    def subscribe(self, topic_name, subscriber_id):
+        self.write(SUBSCRIBE, topic_name, subscriber_id)
+
+    def unsubscribe(self, topic_name, subscriber_id):
+        self.write(UNSUBSCRIBE, topic_name, subscriber_id)
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def snapshot(self, read_topics):
+        """Write a snapshot and delete the log files it covers. Returns what it wrote.
+
+        `read_topics()` yields (topic_name, config, leader, subscribers,
+        start_offset, next_offset, lsn, batches) for every topic, each read
+        under the topic's lock together with the LSN it reflects. The log is
+        switched to a new file first, so every record in the older files is
+        covered by the topics read afterwards.
+        """
+        with self.snapshot_lock:
+            started = time.monotonic()
+            with self.lock:
+                if self.dirty:
+                    os.fsync(self.file.fileno())
+                    self.dirty = False
+                self.file.close()
+                previous = self.files
+                self.files = []
+                self._open()
+                covered = [path for path in previous if path != self.files[-1]]  # Reopened if it held no records
+                lsn = self.lsn
+            topics = list(read_topics())
+            temporary = f"{self.snapshot_path}.tmp"
+            messages = 0
+            with open(temporary, "wb") as f:
+                f.write(_entry((SNAPSHOT_VERSION, lsn, len(topics))))
+                for *fields, batches in topics:
+                    batches = list(coalesce_batches(batches, self.snapshot_batch_bytes))
+                    f.write(_entry((*fields, len(batches))))
+                    for batch in batches:
+                        f.write(batch.encode())
+                        messages += batch.count
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.snapshot_path)
+            _fsync_directory(self.directory)
+            removed = 0
+            for path in covered:
+                removed += os.path.getsize(path)
+                os.remove(path)
+            with self.lock:
+                self.size_bytes -= removed
+            self.last_snapshot = time.monotonic()
+            self.snapshots += 1
+            result = {"lsn": lsn, "topics": len(topics), "messages": messages,
+                      "snapshot_bytes": os.path.getsize(self.snapshot_path), "log_bytes_removed": removed,
+                      "seconds": time.monotonic() - started}
+        logger.info("Wrote snapshot at LSN %d: %d topics, %d messages in %.2fs; removed %d log bytes.", lsn,
+                    len(topics), messages, result["seconds"], removed)
+        return result
+
+    def start(self, read_topics):
+        """fsync the log and take snapshots in a background thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, args=(read_topics,), daemon=True)
+            self.thread.start()
+
+    def _run(self, read_topics):
+        while True:
+            time.sleep(min(self.fsync_interval, 1.0))
+            try:
+                self.flush()
+                idle = time.monotonic() - self.last_snapshot
+                if self.size_bytes >= self.snapshot_bytes or (self.size_bytes and idle >= self.snapshot_interval):
+                    self.snapshot(read_topics)
+            except OSError as e:
+                logger.warning("Write-ahead log maintenance in %s failed: %s", self.directory, e)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+                self.dirty = False
+
+    def stats(self):
+        return {"lsn": self.lsn, "log_files": len(self.files), "log_bytes": self.size_bytes,
+                "snapshots": self.snapshots, "last_snapshot_age_s": time.monotonic() - self.last_snapshot}
+
+
+def _entry(fields):
+    payload = encode(fields)
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_entry(data, pos):
+    """Decode the framed entry at `pos`. Returns (fields, position after it); raises CorruptRecordError."""
+    if pos + FRAME.size > len(data):
+        raise CorruptRecordError("Truncated entry header")
+    length, crc = FRAME.unpack_from(data, pos)
+    payload = data[pos + FRAME.size:pos + FRAME.size + length]
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        raise CorruptRecordError("Truncated or damaged entry")
+    return decode(payload), pos + FRAME.size + length
+
+
+def _fsync_directory(directory):
+    """Make a rename in `directory` durable."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)